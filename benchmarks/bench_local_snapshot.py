@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015-2016, Mirantis, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+'''Compares local snapshot by rsync --link-dest and by "hardlink" engine
+
+Creates the source tree of small files, its previous snapshot, changes
+some of the files and makes new snapshot by both engines:
+
+    python benchmarks/bench_local_snapshot.py --files 200000 --workers 16
+'''
+
+import argparse
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+
+from trsync.objects.local_snapshot import LocalSnapshot
+from trsync.objects.rsync_remote import RsyncRemote
+from trsync.utils.changes import ChangeRecords
+from trsync.utils.changes import ItemizeParser
+from trsync.utils.stats import StatsParser
+
+
+def make_tree(root, files, per_dir, size):
+    for number in range(files):
+        dirname = os.path.join(root, 'd{:04d}'.format(number // per_dir))
+        if number % per_dir == 0:
+            os.makedirs(dirname)
+        with open(os.path.join(dirname, 'f{:06d}'.format(number)), 'w') as f:
+            f.write('x' * size)
+
+
+def change_files(root, every):
+    changed = 0
+    for dirpath, dirnames, filenames in os.walk(root):
+        for name in filenames[::every]:
+            path = os.path.join(dirpath, name)
+            with open(path, 'a') as f:
+                f.write('changed')
+            changed += 1
+    return changed
+
+
+def rsync_snapshot(source, dest, link_dest):
+    cmd = ['rsync'] + RsyncRemote.push_opts + \
+        ['--no-owner', '--no-group', '--link-dest={}'.format(link_dest),
+         source + '/', dest + '/']
+    with open(os.devnull, 'w') as devnull:
+        subprocess.check_call(cmd, stdout=devnull)
+
+
+def engine_snapshot(source, dest, link_dest, workers):
+    stats, records = StatsParser(), ChangeRecords()
+    LocalSnapshot(source, dest, link_dest, workers=workers).run(
+        [ItemizeParser([stats], [records])])
+    return len(records)
+
+
+def timed(func, *args):
+    started = time.time()
+    func(*args)
+    return time.time() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--files', type=int, default=100000)
+    parser.add_argument('--per-dir', type=int, default=500)
+    parser.add_argument('--size', type=int, default=512)
+    parser.add_argument('--change-every', type=int, default=100,
+                        help='Every N-th file of the source is changed')
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--dir', default=None,
+                        help='Directory for the trees (on the filesystem '
+                        'to measure), temporary directory by default')
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp(prefix='trsync-bench-', dir=args.dir)
+    try:
+        source = os.path.join(root, 'source')
+        latest = os.path.join(root, 'latest')
+        make_tree(source, args.files, args.per_dir, args.size)
+        engine_snapshot(source, latest, None, args.workers)
+        changed = change_files(source, args.change_every)
+        print('{} files, {} changed'.format(args.files, changed))
+
+        results = dict()
+        results['hardlink'] = timed(engine_snapshot, source,
+                                    os.path.join(root, 'engine'), latest,
+                                    args.workers)
+        try:
+            results['rsync'] = timed(rsync_snapshot, source,
+                                     os.path.join(root, 'rsync'), latest)
+        except OSError:
+            print('rsync is not found, only hardlink engine is measured')
+        for engine, seconds in sorted(results.items()):
+            print('{:10} {:8.2f} s {:10.0f} files/s'
+                  ''.format(engine, seconds, args.files / seconds))
+        if len(results) == 2:
+            print('speedup    {:8.2f}x'
+                  ''.format(results['rsync'] / results['hardlink']))
+    finally:
+        shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015-2016, Mirantis, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+'''Measures RsyncUrl parsing and path joins on removal lists of snapshots
+
+Builds the paths of snapshots and their diff files to remove for several
+mirrors like TRsync prune does, and urls of them like RsyncOps does:
+
+    python benchmarks/bench_rsync_url.py --snapshots 5000
+'''
+
+import argparse
+import timeit
+
+from trsync.objects.rsync_url import RsyncUrl
+
+
+MIRRORS = [
+    'rsync://mirror.example.com/mirror/ubuntu',
+    'user@mirror.example.com:/srv/mirror/ubuntu',
+    'mirror.example.com::mirror/centos',
+    '/srv/mirror/debian',
+]
+
+
+def removal_list(mirror, snapshots):
+    url = RsyncUrl(mirror)
+    snapshots_dir = url.a_dir('snapshots')
+    names = list()
+    for number in range(snapshots):
+        path = url.a_file(snapshots_dir,
+                          'repo-2016-01-{:02d}-{:06d}'.format(number % 28 + 1,
+                                                              number))
+        names.extend([path, path + '.diff.txt', path + '.changes.jsonl.gz'])
+    urls = [RsyncUrl(url.url_file(_)).url for _ in names]
+    relative = [url.path_relative(_, 'snapshots/repo-latest')
+                for _ in names[::3]]
+    return len(urls) + len(relative)
+
+
+def parse(number):
+    for mirror in MIRRORS:
+        for _ in range(number):
+            RsyncUrl(mirror)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--snapshots', type=int, default=5000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    seconds = min(timeit.repeat(lambda: parse(args.snapshots),
+                                number=1, repeat=args.repeat))
+    print('parse           {:8.3f} s {:10.0f} urls/s'
+          ''.format(seconds, args.snapshots * len(MIRRORS) / seconds))
+    seconds = min(timeit.repeat(
+        lambda: [removal_list(_, args.snapshots) for _ in MIRRORS],
+        number=1, repeat=args.repeat))
+    print('removal lists   {:8.3f} s {:10.0f} snapshots/s'
+          ''.format(seconds, args.snapshots * len(MIRRORS) / seconds))
+
+
+if __name__ == '__main__':
+    main()
@@ -15,8 +15,10 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import json
 import logging
 import os
+import re
 import sys
 
 from cliff import app
@@ -25,9 +27,399 @@ from cliff import commandmanager
 
 import trsync
 
+from trsync.objects import fanout
+from trsync.objects import local_ops
 from trsync.objects import rsync_mirror
-from trsync.objects import rsync_ops
 from trsync.objects import rsync_url
+from trsync.objects import source_cache
+from trsync.utils import retry as retry
+from trsync.utils import utils as utils
+from trsync.utils.tempfiles import TempFiles
+
+
+def add_parallel_arguments(parser):
+    parser.add_argument('--parallel',
+                        type=int,
+                        required=False,
+                        default=1,
+                        help='Number of destinations processed '
+                        'concurrently. 1 (sequential) by default.')
+    parser.add_argument('--log-dir',
+                        required=False,
+                        default=None,
+                        help='If specified, log of every destination will '
+                        'be written to separate file in this directory.')
+    return parser
+
+
+def add_ssh_arguments(parser):
+    parser.add_argument('--ssh-command',
+                        required=False,
+                        default=None,
+                        help='Remote shell used by rsync for ssh urls '
+                        '(like "ssh -i key"). "ssh" by default.')
+    parser.add_argument('--no-ssh-multiplexing',
+                        dest='ssh_multiplexing',
+                        action='store_false',
+                        required=False,
+                        default=True,
+                        help='If specified, every rsync call opens its own '
+                        'ssh connection instead of sharing one persistent '
+                        'master connection per destination.')
+    return parser
+
+
+def add_retry_arguments(parser):
+    parser.add_argument('--retries',
+                        type=int,
+                        required=False,
+                        default=0,
+                        help='Number of retries of rsync calls failed with '
+                        'transient exit codes (see --retry-exit-codes). '
+                        '0 (no retries) by default.')
+    parser.add_argument('--retry-backoff',
+                        type=float,
+                        required=False,
+                        default=1.0,
+                        help='Seconds to wait before the first retry, the '
+                        'delay is doubled for every next one and randomly '
+                        'changed by up to a half. 1 by default.')
+    parser.add_argument('--retry-max-backoff',
+                        type=float,
+                        required=False,
+                        default=60.0,
+                        help='The longest delay between retries (seconds). '
+                        '60 by default.')
+    parser.add_argument('--retry-exit-codes',
+                        type=int,
+                        nargs='+',
+                        required=False,
+                        default=sorted(retry.RSYNC_TRANSIENT),
+                        help='rsync exit codes which are retried. {} by '
+                        'default.'.format(' '.join(
+                            [str(_) for _ in sorted(retry.RSYNC_TRANSIENT)])))
+    return parser
+
+
+def retry_policy(properties):
+    '''Pops options of add_retry_arguments, returns RetryPolicy'''
+    return retry.RetryPolicy(
+        attempts=properties.pop('retries') + 1,
+        backoff=properties.pop('retry_backoff'),
+        max_backoff=properties.pop('retry_max_backoff'),
+        exitcodes=properties.pop('retry_exit_codes'))
+
+
+def add_timeout_arguments(parser):
+    parser.add_argument('--timeout',
+                        dest='io_timeout',
+                        type=int,
+                        required=False,
+                        default=600,
+                        help='rsync I/O timeout: rsync exits when no data is '
+                        'transferred for this number of seconds. 600 by '
+                        'default, 0 disables it.')
+    parser.add_argument('--contimeout',
+                        dest='connect_timeout',
+                        type=int,
+                        required=False,
+                        default=60,
+                        help='Timeout of connection to rsync daemon or ssh '
+                        'server (seconds). 60 by default, 0 disables it.')
+    parser.add_argument('--deadline',
+                        type=int,
+                        required=False,
+                        default=None,
+                        help='If specified, the operation on every '
+                        'destination is aborted after this number of '
+                        'seconds, running rsync is killed.')
+    parser.add_argument('--probe-timeout',
+                        type=int,
+                        required=False,
+                        default=30,
+                        help='All the destinations are probed concurrently '
+                        'before the operation, unreachable ones are skipped '
+                        'and reported as failed. Seconds given to the '
+                        'probe, 30 by default, 0 disables probing.')
+    return parser
+
+
+def destination_prober(properties):
+    '''Pops options of probing, returns probe for run_on_servers or None'''
+    probe_timeout = properties.pop('probe_timeout')
+    if not probe_timeout:
+        return None
+
+    def probe(server):
+        with local_ops.ops_for_url(
+                server,
+                ssh_command=properties.get('ssh_command'),
+                ssh_multiplexing=False,
+                io_timeout=probe_timeout,
+                connect_timeout=(properties.get('connect_timeout') or
+                                 probe_timeout),
+                deadline=probe_timeout) as ops:
+            return ops.probe()
+    return probe
+
+
+def add_catalog_arguments(parser):
+    parser.add_argument('--no-catalog',
+                        dest='catalog',
+                        action='store_false',
+                        required=False,
+                        default=True,
+                        help='If specified, the catalog of snapshots '
+                        '("{snapshots-dir}/.catalog.json") is not used and '
+                        'not updated, remote directories are listed '
+                        'instead.')
+    parser.add_argument('--catalog-max-age',
+                        type=int,
+                        required=False,
+                        default=86400,
+                        help='The catalog updated more than specified number '
+                        'of seconds ago is rebuilt by listing of remote '
+                        'directories. 86400 by default.')
+    return parser
+
+
+class ThreadLogHandler(logging.FileHandler):
+    '''Writes records emitted in the logging context only
+
+    The records are filtered by utils.log_context() of the emitting
+    thread, so the records of the worker threads started by the work of
+    the context (see utils.with_log_context) are written too.
+    '''
+
+    def __init__(self, filename, context):
+        super(ThreadLogHandler, self).__init__(filename)
+        self.setFormatter(logging.Formatter(
+            '%(asctime)s %(levelname)s %(name)s: %(message)s'))
+        self._context = context
+
+    def filter(self, record):
+        if utils.log_context() != self._context:
+            return False
+        return super(ThreadLogHandler, self).filter(record)
+
+
+def run_on_servers(servers, function, parallel=1, log_dir=None,
+                   probe=None):
+    '''Calls function(server) for every server
+
+    Up to "parallel" servers are processed concurrently. Returns report
+    dict {server: {'success': bool, 'result': result or 'log': str}} and
+    exit code. If probe is specified, all the servers are probed by
+    probe(server) -> (reachable, message) concurrently first, unreachable
+    ones are skipped and reported as failed with 'skipped': True.
+    '''
+    if parallel < 1:
+        raise RuntimeError('--parallel should be positive, but it is {}'
+                           ''.format(parallel))
+    if log_dir is not None and not os.path.isdir(log_dir):
+        os.makedirs(log_dir)
+
+    def logged_function(server):
+        if log_dir is None:
+            return function(server)
+        log_file = os.path.join(
+            log_dir, '{}.log'.format(re.sub(r'[^\w.-]+', '_', server)))
+        handler = ThreadLogHandler(log_file, server)
+        utils.logger.addHandler(handler)
+        try:
+            with utils.logging_context(server):
+                return function(server)
+        finally:
+            utils.logger.removeHandler(handler)
+            handler.close()
+    logged_function.__name__ = function.__name__
+
+    report = dict()
+    exitcode = 0
+    if probe is not None:
+        servers = probe_servers(servers, probe, report)
+        if len(report):
+            exitcode = 1
+    for server, success, result in utils.run_parallel(logged_function,
+                                                      servers,
+                                                      workers=parallel):
+        report[server] = dict()
+        report[server]['success'] = success
+        if success:
+            report[server]['result'] = result
+        else:
+            report[server]['log'] = str(result)
+            exitcode = 1
+    return report, exitcode
+
+
+def probe_servers(servers, probe, report):
+    '''Returns reachable servers, adds unreachable ones to report'''
+    reachable = list()
+    for server, success, result in utils.run_parallel(
+            probe, servers, workers=len(servers)):
+        if success:
+            success, message = result
+        else:
+            message = str(result)
+        if success:
+            reachable.append(server)
+            continue
+        message = 'Destination {} is unreachable, skipped: {}'\
+                  ''.format(server, message)
+        utils.logger.error(message)
+        report[server] = dict(success=False, skipped=True, log=message)
+    return reachable
+
+
+def run_batch_push(servers, push, repos, batch_dir, parallel=1,
+                   log_dir=None, probe=None):
+    '''Calls push(server, write_batch, read_batch) in rsync batch mode
+
+    The first reachable server is the reference: the transfers of repos
+    to it are written to batch files in batch_dir, then they are read to
+    push the repos to the other servers which hold the same snapshots
+    (see TRsync.push_many). Returns report and exit code like
+    run_on_servers.
+    '''
+    report = dict()
+    if probe is not None:
+        servers = probe_servers(servers, probe, report)
+    exitcode = 1 if report else 0
+    if not servers:
+        return report, exitcode
+    files = dict([(name, os.path.join(
+        batch_dir, '{}.batch'.format(re.sub(r'[^\w.-]+', '_', name))))
+        for name in repos])
+
+    def push_reference(server):
+        return push(server, write_batch=files)
+    reference_report, reference_exitcode = run_on_servers(
+        servers[:1], push_reference, log_dir=log_dir)
+    report.update(reference_report)
+
+    read_batch = dict()
+    msg = reference_report[servers[0]]
+    if msg['success']:
+        results = msg['result']
+        if not isinstance(results, dict):
+            results = {repos[0]: results}
+        read_batch = dict([(name, (files[name], results[name].batch_signature))
+                           for name in repos
+                           if results[name].batch == 'write'])
+    else:
+        utils.logger.warn('Batch is not written by {}, other destinations '
+                          'are pushed from the sources'.format(servers[0]))
+
+    def push_replay(server):
+        return push(server, read_batch=read_batch)
+    others_report, others_exitcode = run_on_servers(
+        servers[1:], push_replay, parallel=parallel, log_dir=log_dir)
+    report.update(others_report)
+    return report, max(exitcode, reference_exitcode, others_exitcode)
+
+
+def run_relay_push(servers, push, fan_out, make_relay, parallel=1,
+                   log_dir=None, probe=None):
+    '''Calls push(server, relay) in fan-out topology
+
+    The first fan_out reachable servers (first tier) are pushed from the
+    sources with relay None. Each other server (second tier) is assigned
+    to the first tier one round robin, it is pushed with relay
+    make_relay(first tier server, its push result) (see fanout.Relay)
+    after that one succeeds, and from the sources otherwise. Returns report
+    and exit code like run_on_servers.
+    '''
+    report = dict()
+    if probe is not None:
+        servers = probe_servers(servers, probe, report)
+    exitcode = 1 if report else 0
+    if not servers:
+        return report, exitcode
+    first, second = servers[:fan_out], servers[fan_out:]
+    first_report, first_exitcode = run_on_servers(
+        first, push, parallel=parallel, log_dir=log_dir)
+    report.update(first_report)
+
+    seeds = dict([(server, first[index % len(first)])
+                  for index, server in enumerate(second)])
+    relays = dict()
+    try:
+        for seed in first:
+            if not first_report[seed]['success']:
+                continue
+            try:
+                relays[seed] = make_relay(seed, first_report[seed]['result'])
+            except RuntimeError as e:
+                utils.logger.error('{} can not relay the push: {}'
+                                   ''.format(seed, e))
+
+        def push_second(server):
+            relay = relays.get(seeds[server])
+            if relay is None:
+                utils.logger.warn('{} is not pushed, {} is pushed from the '
+                                  'sources'.format(seeds[server], server))
+            return push(server, relay=relay)
+        second_report, second_exitcode = run_on_servers(
+            second, push_second, parallel=parallel, log_dir=log_dir)
+    finally:
+        for relay in relays.values():
+            relay.close()
+    report.update(second_report)
+    return report, max(exitcode, first_exitcode, second_exitcode)
+
+
+def parse_sources(sources, snapshot_name=''):
+    '''Returns [(source url dir, snapshot name)] for push
+
+    Every source is url or "url:name" pair, url of the pair should contain
+    "/" (so "host:path" is ssh url). snapshot_name is used for single
+    source without name, source dir name is used otherwise.
+    '''
+    result = list()
+    for source in sources:
+        url, name = source, ''
+        if ':' in source:
+            head, tail = source.rsplit(':', 1)
+            if '/' in head and tail and '/' not in tail:
+                url, name = head, tail
+        if not name and len(sources) == 1:
+            name = snapshot_name.strip(' /')
+        url = rsync_url.RsyncUrl(url)
+        if not name:
+            name = os.path.basename(url.path.rstrip('/'))
+        if not name:
+            raise RuntimeError("Can't detect 'snapshot_name' of {}. "
+                               "Use '-n' option or url:name to specify it."
+                               "".format(source))
+        result.append((url.url_dir(), name))
+    names = [_[1] for _ in result]
+    if len(set(names)) != len(names):
+        raise RuntimeError('Snapshot names should be unique: {}'
+                           ''.format(names))
+    return result
+
+
+def write_metrics(filename, servers, report):
+    '''Writes metrics of push results in report to JSON file
+
+    Results of multi-repo push are written as {"repos": {name: metrics}}.
+    '''
+    metrics = dict()
+    for server in servers:
+        metrics[server] = dict(success=report[server]['success'])
+        if not report[server]['success']:
+            if report[server].get('skipped'):
+                metrics[server]['skipped'] = True
+            continue
+        result = report[server]['result']
+        if isinstance(result, dict):
+            metrics[server]['repos'] = dict(
+                [(name, _.metrics()) for name, _ in result.items()])
+        else:
+            metrics[server].update(result.metrics())
+    with open(filename, 'w') as outfile:
+        json.dump(metrics, outfile, indent=2, sort_keys=True)
 
 
 class PushCmd(command.Command):
@@ -39,12 +431,19 @@ class PushCmd(command.Command):
     def get_parser(self, prog_name):
         parser = super(PushCmd, self).get_parser(prog_name)
         parser.add_argument('source',
+                            nargs='+',
                             help='Source rsync url (local, rsyncd, remote '
-                            'shell). Mean that it is a directory, not a file.')
+                            'shell). Mean that it is a directory, not a file. '
+                            'Several sources may be specified as '
+                            '"{url}:{snapshot-name}" pairs (url should '
+                            'contain "/"), they are pushed to every '
+                            'destination as single transaction: symlinks of '
+                            'all of them are switched together.')
         parser.add_argument('-n', '--snapshot-name',
                             default='',
                             required=False,
-                            help='Snapshot name. Source url directory name by '
+                            help='Snapshot name of single source without '
+                            'name. Source url directory name by '
                             'default. Will contain the source/ '
                             'content on remote. Full snapshot name will be '
                             '"{snapshot-name}-{timestamp}". Snapshot will be '
@@ -81,6 +480,30 @@ class PushCmd(command.Command):
                             'default. 0 mean that old snapshots will not be '
                             'deleted, "None" mean that all snapshots '
                             'excluding latest will be deleted')
+        parser.add_argument('--resumable',
+                            action='store_true',
+                            required=False,
+                            default=False,
+                            help='If specified, failed push leaves incomplete '
+                            'snapshot (never linked by symlinks) and next '
+                            'push links its files (--link-dest) into the new '
+                            'snapshot instead of transferring them again, '
+                            'the incomplete one is removed after success.')
+        parser.add_argument('--incomplete-max-age',
+                            type=int,
+                            required=False,
+                            default=172800,
+                            help='Incomplete snapshots older than specified '
+                            'number of seconds are not resumed and are '
+                            'removed by pruning. 172800 (2 days) by default.')
+        parser.add_argument('--no-prune',
+                            dest='prune',
+                            action='store_false',
+                            required=False,
+                            default=True,
+                            help='If specified, old snapshots are not removed '
+                            'after the push, "trsync prune" may remove them '
+                            'later.')
         parser.add_argument('--latest-successful-postfix',
                             required=False,
                             default='latest',
@@ -93,6 +516,23 @@ class PushCmd(command.Command):
                             default=[],
                             help='Update additional symlinks relative '
                             'destination. Only "latest" by default.')
+        parser.add_argument('--link-dest-repo',
+                            dest='link_dest_repos',
+                            nargs='+',
+                            required=False,
+                            default=[],
+                            help='Sibling repos (snapshot names) on the '
+                            'destinations which snapshots are also used as '
+                            '--link-dest, so files shared with them are '
+                            'hardlinked instead of transferred.')
+        parser.add_argument('--link-dest-depth',
+                            type=int,
+                            required=False,
+                            default=4,
+                            help='Number of the newest snapshots of the repo '
+                            '(and of every --link-dest-repo) used as '
+                            '--link-dest besides the latest one. Up to 20 '
+                            '--link-dest are passed to rsync. 4 by default.')
         parser.add_argument('--extra',
                             required=False,
                             default='',
@@ -100,15 +540,120 @@ class PushCmd(command.Command):
                             'For example it may be "\--dry-run '
                             '--any-rsync-option".Use "\\" to disable '
                             'argparse to parse extra value.')
+        parser.add_argument('--engine',
+                            required=False,
+                            default='rsync',
+                            choices=['rsync', 'hardlink'],
+                            help='Push engine. "hardlink" makes snapshots of '
+                            'local source on local destinations in-process: '
+                            'unchanged files are hardlinked to the latest '
+                            'snapshot, changed ones are copied by worker '
+                            'threads. Other pushes (and pushes with --extra) '
+                            'are made by rsync anyway. "rsync" by default.')
+        parser.add_argument('--engine-workers',
+                            type=int,
+                            required=False,
+                            default=8,
+                            help='Number of worker threads of "hardlink" '
+                            'engine. 8 by default.')
+        parser.add_argument('--no-legacy-diff',
+                            dest='legacy_diff',
+                            action='store_false',
+                            required=False,
+                            default=True,
+                            help='If specified, only itemized changes '
+                            '"{snapshot}.changes.jsonl.gz" are stored next '
+                            'to the snapshot, without text '
+                            '"{snapshot}.diff.txt".')
+        parser.add_argument('--metrics-file',
+                            required=False,
+                            default=None,
+                            help='If specified, transfer statistics and '
+                            'timings of push phases are written to this '
+                            'file as JSON {destination: metrics}.')
+        parser.add_argument('--batch',
+                            action='store_true',
+                            required=False,
+                            default=False,
+                            help='If specified, the transfer is computed '
+                            'once: it is written to batch file by push to '
+                            'the first destination (rsync --write-batch), '
+                            'then the file is replayed to the others '
+                            '(--read-batch). Destinations which snapshots '
+                            'differ from the first one are pushed from the '
+                            'source.')
+        parser.add_argument('--batch-dir',
+                            required=False,
+                            default=None,
+                            help='Directory for batch files (they are about '
+                            'the size of the transferred data), they are '
+                            'kept there. Temporary directory removed after '
+                            'the push by default.')
+        parser.add_argument('--fan-out',
+                            type=int,
+                            required=False,
+                            default=0,
+                            help='If specified, only the first N '
+                            'destinations (first tier) are pushed from the '
+                            'source. Each other destination (second tier) is '
+                            'assigned to the first tier one round robin and '
+                            'is pushed from the snapshot on it after it '
+                            'succeeds: rsync is launched on the host of the '
+                            'first tier destination over ssh, so the first '
+                            'tier should be ssh (or local) urls and the '
+                            'second tier urls should be reachable from it. 0 '
+                            '(all the destinations from the source) by '
+                            'default.')
+        parser.add_argument('--source-cache',
+                            required=False,
+                            default=None,
+                            help='If specified, remote sources are pulled '
+                            'once to persistent cache in this directory and '
+                            'all the destinations are pushed from there. '
+                            'Every pull is new generation of the source '
+                            'hardlinked to the previous one, so only the '
+                            'changes are read from the source.')
+        parser.add_argument('--source-cache-size',
+                            type=int,
+                            required=False,
+                            default=0,
+                            help='Size limit of --source-cache (MiB). The '
+                            'oldest generations, then the least recently '
+                            'pulled sources are evicted to fit it, the '
+                            'sources of the push are kept anyway. 0 '
+                            '(unlimited) by default.')
+        parser.add_argument('--source-cache-keep',
+                            type=int,
+                            required=False,
+                            default=2,
+                            help='Number of generations of every source '
+                            'kept in --source-cache. 2 by default.')
+        add_catalog_arguments(parser)
+        add_parallel_arguments(parser)
+        add_ssh_arguments(parser)
+        add_retry_arguments(parser)
+        add_timeout_arguments(parser)
 
         return parser
 
     def take_action(self, parsed_args):
         properties = vars(parsed_args)
-        source_url = properties.pop('source', None)
-        snapshot_name = properties.pop('snapshot_name', '').strip(' /')
+        properties['retry'] = retry_policy(properties)
+        probe = destination_prober(properties)
+        cache_dir = properties.pop('source_cache')
+        cache_size = properties.pop('source_cache_size')
+        cache_keep = properties.pop('source_cache_keep')
+        parallel = properties.pop('parallel')
+        log_dir = properties.pop('log_dir')
+        metrics_file = properties.pop('metrics_file')
+        batch = properties.pop('batch')
+        batch_dir = properties.pop('batch_dir')
+        fan_out = properties.pop('fan_out')
+        sources = parse_sources(properties.pop('source'),
+                                properties.pop('snapshot_name', ''))
         symlinks = properties.pop('symlinks', None)
         servers = properties.pop('dest', None)
+        prune = properties.pop('prune')
         if properties['extra'].startswith('\\'):
             properties['extra'] = properties['extra'][1:]
         properties['rsync_extra_params'] = properties.pop('extra')
@@ -116,31 +661,108 @@ class PushCmd(command.Command):
             None if properties['snapshot_lifetime'] == 'None' \
             else int(properties['snapshot_lifetime'])
 
-        source = rsync_ops.RsyncOps(source_url)
-        source_url = source.url.url_dir()
-        if not snapshot_name:
-            snapshot_name = os.path.basename(source.url.path)
-        if not snapshot_name:
-            raise RuntimeError("Can't detect 'snapshot_name'. "
-                               "Use '-n' option to specify it.")
+        if symlinks and len(sources) > 1:
+            raise RuntimeError("'-s' option may be used with single source "
+                               "only.")
+        if batch and fan_out:
+            raise RuntimeError("'--batch' and '--fan-out' options may not be "
+                               "used together.")
+        if 0 < fan_out < len(servers) and \
+                [_ for _ in servers[:fan_out]
+                 if rsync_url.RsyncUrl(_).url_type not in ('ssh', 'path')]:
+            raise RuntimeError("First tier destinations should be ssh or "
+                               "local urls for '--fan-out'.")
+        source_url = ', '.join([_[0] for _ in sources])
 
-        report = dict()
-        exitcode = 0
+        cache = None
+        if cache_dir is not None:
+            cache = source_cache.SourceCache(
+                cache_dir, max_size=cache_size * 1024 * 1024 or None,
+                keep=cache_keep,
+                ssh_command=properties['ssh_command'],
+                ssh_multiplexing=properties['ssh_multiplexing'],
+                retry=properties['retry'],
+                io_timeout=properties['io_timeout'],
+                connect_timeout=properties['connect_timeout'],
+                deadline=properties['deadline'])
 
-        for server in servers:
-            report[server] = dict()
-            try:
-                remote = rsync_mirror.TRsync(server, **properties)
-                remote.push(source_url, snapshot_name, symlinks=symlinks)
-                report[server]['success'] = True
-            except Exception as e:
-                report[server]['success'] = False
-                report[server]['log'] = e.message
-                exitcode = 1
+        # the same snapshot name on every server, also TimeStamp is shared
+        # between TRsync objects, so it should not be changed during pushes
+        if not properties['timestamp']:
+            properties['timestamp'] = str(utils.TimeStamp())
+
+        def push(server, write_batch=None, read_batch=None, relay=None):
+            options, push_sources = properties, sources
+            if relay is not None:
+                options = dict(properties, relay=relay.ssh)
+                push_sources = relay.sources(sources)
+            with rsync_mirror.TRsync(server, **options) as remote:
+                results = remote.push_many(
+                    push_sources, dict([(_[1], symlinks) for _ in sources]),
+                    keep_changes=False, prune=prune,
+                    write_batch=write_batch, read_batch=read_batch)
+            if relay is not None:
+                for result in results.values():
+                    result.relay = str(relay)
+            if len(sources) == 1:
+                return results[sources[0][1]]
+            return results
+
+        def make_relay(server, results):
+            if not isinstance(results, dict):
+                results = {sources[0][1]: results}
+            return fanout.Relay(
+                server, results,
+                rsync_extra_params=properties['rsync_extra_params'],
+                ssh_command=properties['ssh_command'],
+                ssh_multiplexing=properties['ssh_multiplexing'],
+                retry=properties['retry'],
+                io_timeout=properties['io_timeout'],
+                connect_timeout=properties['connect_timeout'],
+                deadline=properties['deadline'])
+
+        try:
+            if cache is not None:
+                # the cache is kept locked until the pushes are done
+                sources = cache.sources(sources)
+            if 0 < fan_out < len(servers):
+                report, exitcode = run_relay_push(
+                    servers, push, fan_out, make_relay, parallel=parallel,
+                    log_dir=log_dir, probe=probe)
+            elif batch and len(servers) > 1:
+                with TempFiles() as tmp:
+                    if batch_dir is None:
+                        batch_dir = tmp.get_temp_dir()
+                    elif not os.path.isdir(batch_dir):
+                        os.makedirs(batch_dir)
+                    report, exitcode = run_batch_push(
+                        servers, push, [_[1] for _ in sources], batch_dir,
+                        parallel=parallel, log_dir=log_dir, probe=probe)
+            else:
+                report, exitcode = run_on_servers(servers, push,
+                                                  parallel=parallel,
+                                                  log_dir=log_dir,
+                                                  probe=probe)
+        finally:
+            if cache is not None:
+                cache.close()
+        if metrics_file is not None:
+            write_metrics(metrics_file, servers, report)
 
-        for srv, msg in report.items():
+        for srv in servers:
+            msg = report[srv]
             if msg['success']:
                 self.log.info('Push %s to %s: SUCCESS' % (source_url, srv))
+                results = msg['result']
+                if not isinstance(results, dict):
+                    results = {sources[0][1]: results}
+                for name in sorted(results):
+                    stats = results[name].stats
+                    if 'linked_file_size' in stats:
+                        self.log.info('Push %s to %s: hardlinked %s bytes, '
+                                      'transferred %s bytes'
+                                      % (name, srv, stats.linked_file_size,
+                                         stats.transferred_file_size))
             else:
                 self.log.error('Push %s to %s: FAILED' % (source_url, srv))
                 self.log.error(msg['log'])
@@ -185,11 +807,19 @@ class SymlinkCmd(command.Command):
                             'For example it may be "\--dry-run '
                             '--any-rsync-option".Use "\\" to disable '
                             'argparse to parse extra value.')
+        add_parallel_arguments(parser)
+        add_ssh_arguments(parser)
+        add_retry_arguments(parser)
+        add_timeout_arguments(parser)
 
         return parser
 
     def take_action(self, parsed_args):
         properties = vars(parsed_args)
+        properties['retry'] = retry_policy(properties)
+        probe = destination_prober(properties)
+        parallel = properties.pop('parallel')
+        log_dir = properties.pop('log_dir')
         symlinks = properties.pop('symlinks', [])
         for symlink in symlinks:
             if symlink.startswith('/') or symlink.startswith('../'):
@@ -204,22 +834,18 @@ class SymlinkCmd(command.Command):
         properties['rsync_extra_params'] = properties.pop('extra')
         update = properties.pop('update', None)
 
-        report = dict()
-        exitcode = 0
+        def symlink(server):
+            with local_ops.ops_for_url(server, **properties) as remote:
+                remote.symlinks([(_, target) for _ in symlinks],
+                                update=update)
 
-        for server in servers:
-            report[server] = dict()
-            try:
-                remote = rsync_ops.RsyncOps(server, **properties)
-                for symlink in symlinks:
-                    remote.symlink(symlink, target, update=update)
-                report[server]['success'] = True
-            except Exception as e:
-                report[server]['success'] = False
-                report[server]['log'] = e.message
-                exitcode = 1
+        report, exitcode = run_on_servers(servers, symlink,
+                                          parallel=parallel,
+                                          log_dir=log_dir,
+                                          probe=probe)
 
-        for srv, msg in report.items():
+        for srv in servers:
+            msg = report[srv]
             if msg['success']:
                 self.log.info('Creating symlinks %s targeted to %s on %s: '
                               'SUCCESS' % (str(symlinks), target, srv))
@@ -254,31 +880,36 @@ class RemoveCmd(command.Command):
                             'For example it may be "\--dry-run '
                             '--any-rsync-option". Use "\\" to disable '
                             'argparse to parse extra value.')
+        add_parallel_arguments(parser)
+        add_ssh_arguments(parser)
+        add_retry_arguments(parser)
+        add_timeout_arguments(parser)
         return parser
 
     def take_action(self, parsed_args):
         properties = vars(parsed_args)
+        properties['retry'] = retry_policy(properties)
+        probe = destination_prober(properties)
+        parallel = properties.pop('parallel')
+        log_dir = properties.pop('log_dir')
         servers = properties.pop('dest', None)
         path = properties.pop('path', None)
         if properties['extra'].startswith('\\'):
             properties['extra'] = properties['extra'][1:]
         properties['rsync_extra_params'] = properties.pop('extra')
 
-        report = dict()
-        exitcode = 0
-        for server in servers:
-            report[server] = dict()
-            self.log.info("Removing items {}".format(str(path)))
-            try:
-                remote = rsync_ops.RsyncOps(server, **properties)
+        def remove(server):
+            self.log.info("Removing items {} on {}".format(str(path), server))
+            with local_ops.ops_for_url(server, **properties) as remote:
                 remote.rm_all(path)
-                report[server]['success'] = True
-            except Exception as e:
-                report[server]['success'] = False
-                report[server]['log'] = e.message
-                exitcode = 1
 
-        for srv, msg in report.items():
+        report, exitcode = run_on_servers(servers, remove,
+                                          parallel=parallel,
+                                          log_dir=log_dir,
+                                          probe=probe)
+
+        for srv in servers:
+            msg = report[srv]
             if msg['success']:
                 self.log.info('Remove %s: SUCCESS' % (path))
             else:
@@ -298,7 +929,11 @@ class GetTargetCmd(command.Command):
         parser = super(GetTargetCmd, self).get_parser(prog_name)
 
         parser.add_argument('symlink_url',
-                            help='Symlink url to resolve (supported by rsync)')
+                            nargs='+',
+                            help='Symlink url(s) to resolve (supported by '
+                            'rsync). Symlinks of the same rsync root are '
+                            'resolved at once, several symlinks are printed '
+                            'as "symlink_url -> target".')
         parser.add_argument('-r', '--recursive',
                             action='store_true',
                             required=False,
@@ -307,17 +942,232 @@ class GetTargetCmd(command.Command):
                             'recursively (if the symlink targeted to other '
                             'symlinks tree - they will be resolved too). '
                             'Disabled by default.')
+        parser.add_argument('-m', '--mirror',
+                            required=False,
+                            default=None,
+                            help='Mirror url (destination of trsync push). '
+                            'If specified, symlink_url is the symlink name '
+                            'relative the mirror.')
+        parser.add_argument('--snapshots-dir', '--snapshot-dir',
+                            required=False,
+                            default='snapshots',
+                            help='Directory name for snapshots relative '
+                            'the mirror. "snapshots" by default')
+        add_ssh_arguments(parser)
         return parser
 
     def take_action(self, parsed_args):
         properties = vars(parsed_args)
-        symlink_url = properties.pop('symlink_url', None)
+        symlink_urls = properties.pop('symlink_url', None)
         recursive = properties.pop('recursive', False)
+        mirror = properties.pop('mirror', None)
+        mirror_properties = dict(
+            snapshots_dir=properties.pop('snapshots_dir'), catalog=False)
+
+        targets = dict()
+        if mirror is not None:
+            mirror_properties.update(properties)
+            with rsync_mirror.TRsync(mirror, init_directory_structure=False,
+                                     **mirror_properties) as remote:
+                targets = remote.resolve_many(symlink_urls,
+                                              recursive=recursive)
+        else:
+            roots = dict()
+            for symlink_url in symlink_urls:
+                url = rsync_url.RsyncUrl(symlink_url)
+                roots.setdefault(url.root, dict())[url.path] = symlink_url
+            for root, paths in roots.items():
+                with local_ops.ops_for_url(root, ls_cache=True,
+                                           **properties) as remote:
+                    resolved = remote.resolve_many(list(paths),
+                                                   recursive=recursive)
+                for path, target in resolved.items():
+                    targets[paths[path]] = target
+
+        if len(symlink_urls) == 1:
+            print(targets[symlink_urls[0]])
+            return
+        for symlink_url in symlink_urls:
+            print('{} -> {}'.format(symlink_url, targets[symlink_url]))
+
+
+class ListCmd(command.Command):
+    log = logging.getLogger(__name__)
+
+    def get_description(self):
+        return "List snapshots and their symlinks on several DST"
+
+    def get_parser(self, prog_name):
+        parser = super(ListCmd, self).get_parser(prog_name)
+        parser.add_argument('-d', '--dest',
+                            nargs='+',
+                            required=True,
+                            help='Destination rsync url(s)')
+        parser.add_argument('-n', '--snapshot-name',
+                            required=False,
+                            default=None,
+                            help='List snapshots of specified name only.')
+        parser.add_argument('--snapshots-dir', '--snapshot-dir',
+                            required=False,
+                            default='snapshots',
+                            help='Directory name for snapshots relative '
+                            '"destination". "snapshots" by default')
+        parser.add_argument('--json',
+                            action='store_true',
+                            required=False,
+                            default=False,
+                            help='If specified, catalogs are printed as JSON '
+                            '{destination: catalog}.')
+        add_catalog_arguments(parser)
+        add_ssh_arguments(parser)
+        return parser
+
+    def take_action(self, parsed_args):
+        properties = vars(parsed_args)
+        servers = properties.pop('dest')
+        snapshot_name = properties.pop('snapshot_name')
+        as_json = properties.pop('json')
+
+        catalogs = dict()
+        for server in servers:
+            with rsync_mirror.TRsync(server, init_directory_structure=False,
+                                     **properties) as remote:
+                catalog = remote.load_catalog().to_dict()
+            if snapshot_name is not None:
+                catalog['snapshots'] = dict(
+                    [(_, info) for _, info in catalog['snapshots'].items()
+                     if info['repo'] == snapshot_name])
+            catalogs[server] = catalog
+
+        if as_json:
+            print(json.dumps(catalogs, indent=2, sort_keys=True))
+            return
+        for server in servers:
+            print('{}:'.format(server))
+            snapshots = catalogs[server]['snapshots']
+            for name in sorted(snapshots):
+                info = snapshots[name]
+                stats = info.get('stats') or {}
+                print('  {}  files: {}  size: {}  symlinks: {}'
+                      ''.format(name, stats.get('files', '-'),
+                                stats.get('total_file_size', '-'),
+                                ', '.join(info['symlinks']) or '-'))
+
 
-        url = rsync_url.RsyncUrl(symlink_url)
-        remote = rsync_ops.RsyncOps(url.root, **properties)
-        target = remote.symlink_target(url.path, recursive=recursive)
-        print(target)
+class PruneCmd(command.Command):
+    log = logging.getLogger(__name__)
+
+    def get_description(self):
+        return "Remove old snapshots of several repos on several DST"
+
+    def get_parser(self, prog_name):
+        parser = super(PruneCmd, self).get_parser(prog_name)
+        parser.add_argument('-d', '--dest',
+                            nargs='+',
+                            required=True,
+                            help='Destination rsync url(s)')
+        parser.add_argument('-n', '--snapshot-name',
+                            dest='repos',
+                            nargs='+',
+                            required=False,
+                            default=None,
+                            help='Prune snapshots of specified names only. '
+                            'All the repos found in "--snapshots-dir" by '
+                            'default.')
+        parser.add_argument('--snapshots-dir', '--snapshot-dir',
+                            required=False,
+                            default='snapshots',
+                            help='Directory name for snapshots relative '
+                            '"destination". "snapshots" by default')
+        parser.add_argument('--snapshot-lifetime', '--save-latest-days',
+                            required=False,
+                            default=61,
+                            help='Snapshots for specified number of days will '
+                            'be saved. All older will be removed. 61 by '
+                            'default. "None" mean that all snapshots '
+                            'excluding linked ones will be deleted')
+        parser.add_argument('--io-workers',
+                            type=int,
+                            required=False,
+                            default=4,
+                            help='Number of concurrent deletions on every '
+                            'destination. 4 by default.')
+        parser.add_argument('--dry-run',
+                            action='store_true',
+                            required=False,
+                            default=False,
+                            help='If specified, snapshots to remove and the '
+                            'space to reclaim are reported only.')
+        parser.add_argument('--json',
+                            action='store_true',
+                            required=False,
+                            default=False,
+                            help='If specified, reports are printed as JSON '
+                            '{destination: report}.')
+        add_catalog_arguments(parser)
+        add_parallel_arguments(parser)
+        add_ssh_arguments(parser)
+        add_retry_arguments(parser)
+        add_timeout_arguments(parser)
+        return parser
+
+    def take_action(self, parsed_args):
+        properties = vars(parsed_args)
+        properties['retry'] = retry_policy(properties)
+        probe = destination_prober(properties)
+        parallel = properties.pop('parallel')
+        log_dir = properties.pop('log_dir')
+        servers = properties.pop('dest')
+        repos = properties.pop('repos')
+        io_workers = properties.pop('io_workers')
+        dry_run = properties.pop('dry_run')
+        as_json = properties.pop('json')
+        snapshot_lifetime = properties.pop('snapshot_lifetime')
+        snapshot_lifetime = \
+            None if snapshot_lifetime == 'None' else int(snapshot_lifetime)
+        if snapshot_lifetime == 0:
+            raise RuntimeError('--snapshot-lifetime 0 means no pruning')
+
+        def prune(server):
+            with rsync_mirror.TRsync(server, init_directory_structure=False,
+                                     snapshot_lifetime=snapshot_lifetime,
+                                     **properties) as remote:
+                report = remote.prune_repos(repos, io_workers=io_workers,
+                                            dry_run=dry_run)
+            return dict(snapshots=report.snapshots, removed=report.removed,
+                        failed=report.failed, reclaimed=report.reclaimed,
+                        exact=report.exact)
+
+        report, exitcode = run_on_servers(servers, prune, parallel=parallel,
+                                          log_dir=log_dir, probe=probe)
+        for srv in servers:
+            msg = report[srv]
+            if msg['success'] and msg['result']['failed']:
+                exitcode = 1
+        if as_json:
+            print(json.dumps(report, indent=2, sort_keys=True))
+            sys.exit(exitcode)
+
+        for srv in servers:
+            msg = report[srv]
+            if not msg['success']:
+                self.log.error('Prune %s: FAILED' % srv)
+                self.log.error(msg['log'])
+                continue
+            result = msg['result']
+            reclaimed = result['reclaimed']
+            if reclaimed is None:
+                reclaimed = 'unknown'
+            elif not result['exact']:
+                reclaimed = '~{}'.format(reclaimed)
+            print('{}: {} {} snapshots, {} failed, reclaimed {} bytes'
+                  ''.format(srv, 'would remove' if dry_run else 'removed',
+                            len(result['snapshots'] if dry_run
+                                else result['removed']),
+                            len(result['failed']), reclaimed))
+            for name in result['failed']:
+                self.log.error('Prune %s: %s is not removed' % (srv, name))
+        sys.exit(exitcode)
 
 
 class TRsyncApp(app.App):
@@ -20,6 +20,7 @@ import os
 import sys
 
 from trsync.objects.rsync_mirror import TRsync
+from trsync.utils import utils as utils
 
 
 def get_argparser():
@@ -84,6 +85,13 @@ def get_argparser():
                         'example it may be "\--dry-run --any-rsync-option".'
                         'Use "\\" to disable argparse to parse extra value.')
 
+    parser.add_argument('--parallel',
+                        type=int,
+                        required=False,
+                        default=1,
+                        help='Number of destinations processed concurrently. '
+                        '1 (sequential) by default.')
+
     return parser
 
 
@@ -92,6 +100,7 @@ def main():
     parser = get_argparser()
     options = parser.parse_args()
     properties = vars(options)
+    parallel = properties.pop('parallel')
     source_dir = properties.pop('source', None)
     mirror_name = properties.pop('mirror_name', None).strip('/')
     symlinks = properties.pop('symlinks', None)
@@ -103,16 +112,21 @@ def main():
         None if options.snapshot_lifetime == 'None' \
         else int(options.snapshot_lifetime)
 
-    failed = list()
-    for server in servers:
-        source_dir = os.path.realpath(source_dir)
-        if not source_dir.endswith('/'):
-            source_dir += '/'
-        remote = TRsync(server, **properties)
-        try:
+    if not properties['timestamp']:
+        properties['timestamp'] = str(utils.TimeStamp())
+    source_dir = os.path.realpath(source_dir)
+    if not source_dir.endswith('/'):
+        source_dir += '/'
+
+    def push(server):
+        with TRsync(server, **properties) as remote:
             remote.push(source_dir, mirror_name, symlinks=symlinks)
-        except Exception as e:
-            print(e.message)
+
+    failed = list()
+    for server, success, result in utils.run_parallel(push, servers,
+                                                      workers=parallel):
+        if not success:
+            print(str(result))
             failed.append(server)
 
     if failed:
@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015-2016, Mirantis, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import copy
+import datetime
+import json
+import os
+import re
+
+
+SNAPSHOT_RE = re.compile(r'^(?P<repo>.+)-'
+                         r'(?P<timestamp>[0-9]{4}-[0-9]{2}-[0-9]{2}-'
+                         r'[0-9]{6})$')
+UPDATED_FORMAT = '%Y-%m-%dT%H:%M:%S'
+# marker file <snapshot>.incomplete next to the snapshot left by failed push
+INCOMPLETE_SUFFIX = '.incomplete'
+
+
+class Catalog(object):
+    '''Snapshots and symlinks of the mirror
+
+    snapshots is dict {snapshot name: info} where info is dict with "repo",
+    "timestamp", "stats" (rsync --stats of the push), "changes" (number of
+    changed paths) and "diff" (diff files). symlinks is dict {symlink path
+    relative the mirror url: snapshot name}. incomplete is set of snapshots
+    left by failed resumable pushes. rebuilt is True if the catalog is
+    evaluated by listings instead of loaded from the file.
+    '''
+    version = 1
+
+    def __init__(self, snapshots=None, symlinks=None, updated=None,
+                 version=None, incomplete=None):
+        self.snapshots = dict(snapshots or {})
+        self.symlinks = dict(symlinks or {})
+        self.incomplete = set(incomplete or [])
+        self.updated = updated
+        if version is None:
+            version = self.__class__.version
+        self.file_version = version
+        self.rebuilt = False
+
+    def copy(self):
+        return copy.deepcopy(self)
+
+    @classmethod
+    def loads(cls, text):
+        '''Returns Catalog parsed from JSON text, None if it is invalid'''
+        try:
+            data = json.loads(text)
+            return cls(snapshots=data['snapshots'],
+                       symlinks=data['symlinks'],
+                       updated=data['updated'],
+                       version=data['version'],
+                       incomplete=data.get('incomplete'))
+        except (ValueError, KeyError, TypeError):
+            return None
+
+    def dumps(self, now=None):
+        '''Returns JSON text of the catalog updated at now (UTC)'''
+        if now is None:
+            now = datetime.datetime.utcnow()
+        self.updated = now.strftime(UPDATED_FORMAT)
+        self.file_version = self.version
+        return json.dumps(self.to_dict(), indent=1, sort_keys=True)
+
+    def to_dict(self):
+        '''Returns catalog as dict, snapshots include their symlinks'''
+        snapshots = dict()
+        linked = self.snapshot_symlinks()
+        for name, info in self.snapshots.items():
+            snapshots[name] = dict(info)
+            snapshots[name]['symlinks'] = sorted(linked.get(name, []))
+        return dict(version=self.file_version,
+                    updated=self.updated,
+                    snapshots=snapshots,
+                    symlinks=dict(self.symlinks),
+                    incomplete=sorted(self.incomplete))
+
+    def is_stale(self, max_age=None, now=None):
+        '''Returns True if the catalog should be rebuilt
+
+        It is so for other format version or if it is updated more than
+        max_age seconds ago.
+        '''
+        if self.file_version != self.version:
+            return True
+        if max_age is None:
+            return False
+        if now is None:
+            now = datetime.datetime.utcnow()
+        try:
+            updated = datetime.datetime.strptime(self.updated,
+                                                 UPDATED_FORMAT)
+        except (TypeError, ValueError):
+            return True
+        return (now - updated) > datetime.timedelta(seconds=max_age)
+
+    def add_snapshot(self, name, stats=None, changes=None, diff=None):
+        match = SNAPSHOT_RE.match(name)
+        self.snapshots[name] = dict(
+            repo=match.group('repo') if match else None,
+            timestamp=match.group('timestamp') if match else None,
+            stats=dict(stats) if stats else None,
+            changes=changes,
+            diff=list(diff or []),
+        )
+        self.incomplete.discard(name)
+
+    def add_incomplete(self, name):
+        '''Adds snapshot left by failed push (unless it is known)'''
+        if name not in self.snapshots:
+            self.add_snapshot(name)
+        self.incomplete.add(name)
+
+    def remove_snapshots(self, names):
+        for name in names:
+            self.snapshots.pop(name, None)
+            self.incomplete.discard(name)
+        for symlink, target in list(self.symlinks.items()):
+            if target in names:
+                del self.symlinks[symlink]
+
+    def snapshot_symlinks(self):
+        '''Returns {snapshot name: [symlinks targeted to it]}'''
+        linked = dict()
+        for symlink, target in self.symlinks.items():
+            linked.setdefault(target, list()).append(symlink)
+        return linked
+
+    def repo_snapshots(self, repo):
+        return sorted([_ for _, info in self.snapshots.items()
+                       if info.get('repo') == repo])
+
+    def listings(self):
+        '''Returns catalog as listings of snapshots dir and symlinks
+
+        The entries are (mode, name, target) like RsyncOps._ls returns,
+        incomplete snapshots are listed with their marker files.
+        '''
+        snapshots = [('d', _, None) for _ in sorted(self.snapshots)]
+        snapshots.extend([('-', _ + INCOMPLETE_SUFFIX, None)
+                          for _ in sorted(self.incomplete)])
+        symlinks = [('l', _, target)
+                    for _, target in sorted(self.symlinks.items())]
+        return [snapshots, symlinks]
+
+    @classmethod
+    def from_listings(cls, snapshots_listing, symlinks_listings,
+                      previous=None):
+        '''Builds catalog by listings of snapshots dir and other dirs
+
+        symlinks_listings is {dir relative mirror url: listing}, only the
+        symlinks targeted to the snapshots are taken into account. Details
+        of snapshots known by previous catalog are kept, as well as its
+        symlinks placed outside the listed dirs.
+        '''
+        catalog = cls()
+        catalog.rebuilt = True
+        markers = set([_[1][:-len(INCOMPLETE_SUFFIX)]
+                       for _ in snapshots_listing
+                       if _[1].endswith(INCOMPLETE_SUFFIX)])
+        for mode, name, target in snapshots_listing:
+            if mode.startswith('d') and SNAPSHOT_RE.match(name):
+                if previous is not None and name in previous.snapshots:
+                    catalog.snapshots[name] = previous.snapshots[name]
+                else:
+                    catalog.add_snapshot(name)
+                if name in markers:
+                    catalog.incomplete.add(name)
+        for dirname, listing in symlinks_listings.items():
+            for mode, name, target in listing:
+                if not mode.startswith('l') or not target:
+                    continue
+                snapshot = os.path.basename(target.rstrip('/'))
+                if snapshot in catalog.snapshots:
+                    path = os.path.join(dirname, name).strip('/')
+                    catalog.symlinks[path] = snapshot
+        if previous is not None:
+            listed = set([_.strip('/') for _ in symlinks_listings])
+            for path, snapshot in previous.symlinks.items():
+                if os.path.dirname(path) not in listed and \
+                        snapshot in catalog.snapshots:
+                    catalog.symlinks[path] = snapshot
+        return catalog
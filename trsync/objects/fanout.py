@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015-2016, Mirantis, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import shlex
+
+from trsync.utils import utils as utils
+
+from trsync.objects.local_ops import ops_for_url
+from trsync.utils.shell import cmd_to_str
+
+
+class SshRelay(object):
+    '''Launches rsync on the host of ssh url over ssh
+
+    ops is RsyncOps of the url, its ssh master connection (if any) and
+    ssh command are used.
+    '''
+
+    def __init__(self, ops):
+        self._ops = ops
+        self.url = ops.url
+
+    def __str__(self):
+        return self.url.url
+
+    def path(self, path):
+        '''Returns directory path (relative the url) on the host'''
+        return self.url.a_dir(self.url.path, path)
+
+    def wrap(self, cmd):
+        '''Returns ssh argument vector running cmd on the host'''
+        if self._ops.ssh_master is not None:
+            ssh = shlex.split(self._ops.ssh_master.rsh())
+        else:
+            ssh = self._ops._ssh_args()
+        return ssh + [self._ops._ssh_destination(), cmd_to_str(cmd)]
+
+
+class Relay(object):
+    '''First tier mirror which snapshots are sources of second tier pushes
+
+    results are {repo_name: PushResult} of the push to rsync_url, the
+    snapshots of result.snapshot are pushed to the second tier mirrors
+    under the same repo names.
+
+    rsync of the second tier push is launched on the host of rsync_url
+    (ssh url) over ssh, the data goes from the first tier mirror to the
+    second tier one directly. The second tier urls should be reachable
+    from that host, ssh_command is used there as well. Snapshots of local
+    mirror are used in place. Other urls can not relay the push.
+
+    kwargs are passed to RsyncOps of rsync_url.
+    '''
+
+    def __init__(self, rsync_url, results, **kwargs):
+        self._log = utils.logger.getChild('Relay.' + rsync_url)
+        self.rsync = ops_for_url(rsync_url, **kwargs)
+        self.url = self.rsync.url
+        self.snapshots = dict([(name, result.snapshot)
+                               for name, result in results.items()])
+        self.ssh = None
+        if self.url.url_type == 'ssh':
+            self.ssh = SshRelay(self.rsync)
+        elif self.url.url_type != 'path':
+            self.rsync.close()
+            raise RuntimeError('Relay requires ssh or local url, got "{}"'
+                               ''.format(rsync_url))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def __str__(self):
+        return self.url.url
+
+    def close(self):
+        '''Stops ssh master connection (if any)'''
+        self.rsync.close()
+
+    def sources(self, sources):
+        '''Returns [(source, repo_name)] of the second tier push
+
+        sources are the ones of the first tier push, only their repo names
+        are used.
+        '''
+        return [(self.source(repo_name), repo_name)
+                for source, repo_name in sources]
+
+    def source(self, repo_name):
+        '''Returns source of the snapshot of repo_name'''
+        snapshot = self.snapshots[repo_name]
+        if self.ssh is not None:
+            return self.ssh.path(snapshot)
+        return self.url.a_dir(self.url.urljoin(snapshot))
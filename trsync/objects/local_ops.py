@@ -0,0 +1,272 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015-2016, Mirantis, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import errno
+import os
+import shutil
+import stat
+
+from trsync.objects.rsync_ops import RsyncOps
+from trsync.objects.rsync_url import RsyncUrl
+
+
+# python 2.7 has neither os.scandir nor os.replace (rename replaces the
+# existing destination on POSIX too) nor stat.filemode
+_replace = getattr(os, 'replace', os.rename)
+
+
+def _filemode(mode):
+    '''Returns "ls -l" like mode string (rsync --list-only prints it)'''
+    if hasattr(stat, 'filemode'):
+        return stat.filemode(mode)
+    kinds = ((stat.S_ISLNK, 'l'), (stat.S_ISDIR, 'd'), (stat.S_ISCHR, 'c'),
+             (stat.S_ISBLK, 'b'), (stat.S_ISFIFO, 'p'), (stat.S_ISSOCK, 's'))
+    result = [next((c for check, c in kinds if check(mode)), '-')]
+    for who, special, char in (('USR', stat.S_ISUID, 's'),
+                               ('GRP', stat.S_ISGID, 's'),
+                               ('OTH', stat.S_ISVTX, 't')):
+        for perm in 'RW':
+            bit = getattr(stat, 'S_I{}{}'.format(perm, who))
+            result.append(perm.lower() if mode & bit else '-')
+        executable = mode & getattr(stat, 'S_IX' + who)
+        if mode & special:
+            result.append(char if executable else char.upper())
+        else:
+            result.append('x' if executable else '-')
+    return ''.join(result)
+
+
+def _scandir(path):
+    '''Yields (name, lstat result) of the directory entries'''
+    if hasattr(os, 'scandir'):
+        for entry in os.scandir(path):
+            yield entry.name, entry.stat(follow_symlinks=False)
+    else:
+        for name in os.listdir(path):
+            yield name, os.lstat(os.path.join(path, name))
+
+
+# rsync params of every call which do not change the results of LocalOps
+LOCAL_NEUTRAL_PARAMS = ('-v', '--no-owner', '--no-group')
+
+
+class LocalOps(RsyncOps):
+    '''RsyncOps for local path urls
+
+    Listings, creating and removing of directories and files and symlinks
+    are made by the filesystem calls instead of rsync, data is still
+    pushed and pulled by rsync. The methods return the same results and
+    support the same transactions as RsyncOps ones (methods returning rsync
+    output return empty string).
+    '''
+
+    def _local(self, path=None):
+        '''Returns filesystem path of path (relative rsync_url)'''
+        return self.url.urljoin(path)
+
+    def _entry(self, full_path, name):
+        '''Returns (mode, name, symlink target) for full_path or None'''
+        try:
+            st = os.lstat(full_path.rstrip('/') or '/')
+        except OSError:
+            return None
+        return self._entry_by_stat(full_path, name, st)
+
+    @staticmethod
+    def _entry_by_stat(full_path, name, st):
+        target = None
+        if stat.S_ISLNK(st.st_mode):
+            target = os.readlink(full_path.rstrip('/'))
+        return _filemode(st.st_mode), name, target
+
+    def _list(self, path=None):
+        '''Lists path like rsync --list-only does
+
+        Content of the directory is listed for the path with trailing
+        slash (symlinks to directories are followed then), the path itself
+        otherwise.
+        '''
+        full_path = self._local(path)
+        if not full_path.endswith('/'):
+            entry = self._entry(full_path, os.path.basename(full_path))
+            return [entry] if entry is not None else []
+        try:
+            entries = [
+                self._entry_by_stat(os.path.join(full_path, name), name, st)
+                for name, st in _scandir(full_path)]
+        except OSError:
+            return []
+        return sorted(entries, key=lambda _: _[1])
+
+    def _ls_paths(self, paths):
+        result, paths = self._ls_paths_cached(paths)
+        for path in paths:
+            entry = self._entry(self._local(path), path)
+            if entry is not None:
+                result[path] = (entry[0], entry[2])
+        return result
+
+    def rm_file(self, filename):
+        '''Removes file on rsync_url.'''
+        self._log.info('Removing file "{}"'.format(filename))
+        self.rm_all([filename])
+        return ''
+
+    def rm_all(self, names=[]):
+        '''Remove all files and dirs (recursively) on list
+
+        See RsyncOps.rm_all.
+        '''
+        paths = self._rm_paths(names)
+        if not paths:
+            return dict()
+        self._log.debug('Removing objects: {}'.format(str(sorted(paths))))
+        errors = dict()
+        for path in sorted(paths):
+            try:
+                self._remove(self._local(path))
+            except OSError as e:
+                errors[path] = str(e)
+        for path in paths:
+            self._ls_cache_invalidate(path)
+        if errors:
+            failed = sorted(errors)
+            msg = 'Removing of {} failed.\n\nERRORS: \n{}'\
+                  ''.format(str(failed),
+                            '\n'.join([errors[_] for _ in failed]))
+            self._log.error(msg)
+            raise RuntimeError(msg)
+        return dict([(name, True) for name in paths.values()])
+
+    @staticmethod
+    def _remove(full_path):
+        '''Removes file, symlink or directory tree, absent path is ok'''
+        full_path = full_path.rstrip('/')
+        if os.path.isdir(full_path) and not os.path.islink(full_path):
+            shutil.rmtree(full_path)
+            return
+        try:
+            os.remove(full_path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+    def clean_dir(self, dirname):
+        '''Removes content of the directory (creates it if absent)'''
+        full_path = self._local(self.url.a_dir(dirname))
+        self._log.info('Cleaning directory "{}"'.format(dirname))
+        self._makedirs(full_path)
+        for name, st in _scandir(full_path):
+            self._remove(os.path.join(full_path, name))
+        self._ls_cache_invalidate(dirname)
+        return ''
+
+    def mk_dir(self, dirname):
+        '''Creates directories (recirsive, like mkdir -p) on rsync_url'''
+        self._log.info('Creating directory "{}"'.format(dirname))
+        self._ls_cache_invalidate(dirname, ancestors=True)
+        self._makedirs(self._local(self.url.a_dir(dirname)))
+        return ''
+
+    @staticmethod
+    def _makedirs(full_path):
+        try:
+            os.makedirs(full_path)
+        except OSError as e:
+            if e.errno != errno.EEXIST or not os.path.isdir(full_path):
+                raise
+
+    def symlinks(self, links, create_target_file=True, store_history=True,
+                 update=True, transaction=None):
+        '''Creates (or updates) all the symlinks targeted to their targets
+
+        See RsyncOps.symlinks. Every symlink and history file is created
+        under temporary name in its directory and renamed over the previous
+        one, so it is replaced atomically.
+        '''
+        links, target_paths = self._symlinks_links(links)
+        if not links:
+            return dict()
+        listing = self._ls_paths([_[1] for _ in links] +
+                                 list(target_paths.values()))
+        previous = self._symlinks_previous(links, target_paths, listing,
+                                           update)
+        infofiles = self._symlinks_infofiles(links, create_target_file)
+
+        if transaction is not None:
+            transaction.append(
+                lambda p=dict(previous): self._restore_symlinks(p))
+        for infofile, target in infofiles.items():
+            self._write_infofile(infofile, target, store_history)
+        for symlink, link_path, target in links:
+            self._replace(link_path, lambda tmp, t=target: os.symlink(t, tmp))
+            self._log.info('Creating symlink "{}" -> "{}"'
+                           ''.format(symlink, target))
+        self._symlinks_done(links, infofiles)
+        return previous
+
+    def _write_infofile(self, infofile, target, store_history):
+        content = target
+        if store_history is True:
+            try:
+                with open(self._local(infofile), 'r') as inf:
+                    content = '{}\n{}'.format(target, inf.read())
+            except IOError:
+                pass
+
+        def write(tmp):
+            with open(tmp, 'w') as outf:
+                outf.write(content)
+
+        self._replace(infofile, write)
+        self._log.debug('Creating informaion file "{}"'.format(infofile))
+
+    def _replace(self, path, create):
+        '''Creates path by create(temporary name) and renames it to path'''
+        full_path = self._local(path)
+        dirname, name = os.path.split(full_path)
+        self._makedirs(dirname)
+        tmp = os.path.join(dirname, '.{}.{}.tmp'.format(name, os.getpid()))
+        self._remove(tmp)
+        create(tmp)
+        try:
+            _replace(tmp, full_path)
+        except OSError:
+            self._remove(tmp)
+            raise
+
+
+def is_local(rsync_url, rsync_extra_params=''):
+    '''Returns True if LocalOps gives the same results as RsyncOps
+
+    LocalOps does not apply rsync_extra_params (like --dry-run), so local
+    urls with extra params besides the default ones are handled by RsyncOps
+    to get the same result.
+    '''
+    extra = [_ for _ in RsyncOps._args(rsync_extra_params)
+             if _ not in LOCAL_NEUTRAL_PARAMS]
+    return RsyncUrl(rsync_url).url_type == 'path' and not extra
+
+
+def ops_for_url(rsync_url, *args, **kwargs):
+    '''Returns LocalOps for local path urls, RsyncOps otherwise
+
+    See is_local().
+    '''
+    params = args[0] if args else kwargs.get('rsync_extra_params')
+    if is_local(rsync_url, params):
+        return LocalOps(rsync_url, *args, **kwargs)
+    return RsyncOps(rsync_url, *args, **kwargs)
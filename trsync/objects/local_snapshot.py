@@ -0,0 +1,394 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015-2016, Mirantis, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import errno
+import os
+import shutil
+import stat
+import time
+
+from multiprocessing.pool import ThreadPool
+
+from trsync.utils import utils as utils
+
+
+# errors of copy_file_range/sendfile meaning "not supported for these files"
+_FALLBACK_ERRNOS = set([errno.EXDEV, errno.ENOSYS, errno.EINVAL,
+                        errno.EOPNOTSUPP, errno.EBADF, errno.ENOTSUP])
+_COPY_CHUNK = 8 * 1024 * 1024
+
+
+def _copy_file_range(infd, outfd, size):
+    copied = 0
+    while copied < size:
+        n = os.copy_file_range(infd, outfd, min(size - copied, _COPY_CHUNK))
+        if n == 0:
+            break
+        copied += n
+
+
+def _sendfile(infd, outfd, size):
+    copied = 0
+    while copied < size:
+        n = os.sendfile(outfd, infd, copied,
+                        min(size - copied, _COPY_CHUNK))
+        if n == 0:
+            break
+        copied += n
+
+
+_KERNEL_COPY = [func for name, func in (('copy_file_range', _copy_file_range),
+                                        ('sendfile', _sendfile))
+                if hasattr(os, name)]
+
+
+def copy_data(src, dst, size):
+    '''Copies content of file src to dst by the kernel if it is possible
+
+    os.copy_file_range (the filesystem may clone or copy on the server
+    side) and os.sendfile are tried, shutil.copyfileobj is the fallback.
+    '''
+    with open(src, 'rb') as infile:
+        with open(dst, 'wb') as outfile:
+            for func in _KERNEL_COPY:
+                try:
+                    func(infile.fileno(), outfile.fileno(), size)
+                    return
+                except OSError as e:
+                    if e.errno not in _FALLBACK_ERRNOS:
+                        raise
+                    infile.seek(0)
+                    outfile.seek(0)
+                    outfile.truncate()
+            shutil.copyfileobj(infile, outfile, _COPY_CHUNK)
+
+
+def _lstat(path):
+    try:
+        return os.lstat(path)
+    except OSError:
+        return None
+
+
+def _scandir(path):
+    '''Returns sorted [(name, lstat result)] of the directory entries'''
+    if hasattr(os, 'scandir'):
+        entries = [(_.name, _.stat(follow_symlinks=False))
+                   for _ in os.scandir(path)]
+    else:
+        entries = [(_, os.lstat(os.path.join(path, _)))
+                   for _ in os.listdir(path)]
+    return sorted(entries)
+
+
+def _mtime(st):
+    return time.strftime('%Y/%m/%d-%H:%M:%S', time.localtime(st.st_mtime))
+
+
+class LocalSnapshot(object):
+    '''Copies local source dir to local dest like rsync --link-dest does
+
+    In-process equivalent of "rsync --archive --delete --link-dest=LINK"
+    for local source and destination (owners and groups are not
+    preserved, like trsync does by default). link_dest is directory or
+    list of them (like several --link-dest, up to 20): regular files
+    equal to the same files in the first of them having such file by
+    size, mtime and permissions are hardlinked to it, other files are
+    copied by copy_data(). Directories are processed by the pool of
+    workers threads level by level.
+
+    run() feeds consumers with lines rsync prints with ITEMIZE_OPTS and
+    STATS_OPTS, so the output is parsed to the same ChangeRecords and
+    stats. Devices and special files are not supported and skipped.
+    '''
+    # rsync accepts at most 20 --link-dest (--copy-dest, --compare-dest)
+    link_dest_limit = 20
+
+    def __init__(self, source, dest, link_dest=None, workers=8,
+                 logger=None):
+        self.source = source.rstrip('/') or '/'
+        self.dest = dest.rstrip('/') or '/'
+        if not isinstance(link_dest, (list, tuple)):
+            link_dest = [link_dest] if link_dest else []
+        self.link_dests = [_.rstrip('/') or '/' for _ in link_dest]
+        self.link_dest = self.link_dests[0] if self.link_dests else None
+        self.workers = max(1, int(workers))
+        if logger is None:
+            logger = utils.logger
+        self._log = logger.getChild('LocalSnapshot')
+
+    def run(self, consumers):
+        '''Makes the snapshot, raises RuntimeError if some paths failed
+
+        Like rsync --ignore-errors, all the paths are processed anyway.
+        '''
+        totals = utils.bunch(reg=0, dir=0, link=0, created=0, deleted=0,
+                             transferred=0, size=0, transferred_size=0)
+        lines, errors, dirs = list(), list(), list()
+        root = self._sync_root(lines, errors, totals)
+        level = [''] if root is not None else []
+        if root is not None:
+            dirs.append(('', root))
+        pool = ThreadPool(self.workers)
+        try:
+            while level:
+                results = pool.map(utils.with_log_context(self._sync_dir),
+                                   level)
+                level = list()
+                for result in results:
+                    lines.extend(result.lines)
+                    errors.extend(result.errors)
+                    dirs.extend(result.dirs)
+                    level.extend([_[0] for _ in result.dirs])
+                    for key, value in result.totals.items():
+                        totals[key] += value
+        finally:
+            pool.close()
+            pool.join()
+        # attributes of directories are set after their content is written
+        for relpath, st in reversed(dirs):
+            self._set_attrs(os.path.join(self.dest, relpath), st, errors)
+
+        try:
+            for line in sorted(lines, key=self._line_key):
+                for consumer in consumers:
+                    consumer.feed(line)
+            for line in self._stats_lines(totals):
+                for consumer in consumers:
+                    consumer.feed(line)
+        finally:
+            for consumer in consumers:
+                consumer.close()
+        if errors:
+            msg = 'Snapshot of "{}" to "{}" failed for {} paths:\n{}'\
+                  ''.format(self.source, self.dest, len(errors),
+                            '\n'.join(errors))
+            self._log.error(msg)
+            raise RuntimeError(msg)
+        return totals
+
+    @staticmethod
+    def _line_key(line):
+        # rsync prints entries of directory after it
+        path = line.rstrip('\n').split('|', 3)[3].split(' -> ')[0]
+        if path == './':
+            return []
+        return path.rstrip('/').split('/')
+
+    def _sync_root(self, lines, errors, totals):
+        try:
+            st = os.stat(self.source)
+        except OSError as e:
+            errors.append('{}: {}'.format(self.source, e))
+            return None
+        if not stat.S_ISDIR(st.st_mode):
+            errors.append('{}: not a directory'.format(self.source))
+            return None
+        try:
+            if not os.path.isdir(self.dest):
+                os.makedirs(self.dest)
+                lines.append(self._line('cd+++++++++', st, './'))
+                totals.created += 1
+        except OSError as e:
+            errors.append('{}: {}'.format(self.dest, e))
+            return None
+        totals.dir += 1
+        return st
+
+    def _sync_dir(self, relpath):
+        result = utils.bunch(lines=[], errors=[], dirs=[],
+                             totals=dict(reg=0, dir=0, link=0, created=0,
+                                         deleted=0, transferred=0, size=0,
+                                         transferred_size=0))
+        source_dir = os.path.join(self.source, relpath)
+        dest_dir = os.path.join(self.dest, relpath)
+        try:
+            entries = _scandir(source_dir)
+            existing = set(os.listdir(dest_dir))
+        except OSError as e:
+            result.errors.append('{}: {}'.format(source_dir, e))
+            return result
+        names = set()
+        for name, st in entries:
+            names.add(name)
+            path = os.path.join(relpath, name)
+            try:
+                self._sync_entry(path, st, name in existing, result)
+            except (OSError, IOError) as e:
+                result.errors.append('{}: {}'.format(path, e))
+        for name in sorted(existing - names):
+            path = os.path.join(relpath, name)
+            try:
+                self._remove(os.path.join(self.dest, path))
+                result.lines.append('*deleting  |0||{}\n'.format(path))
+                result.totals['deleted'] += 1
+            except OSError as e:
+                result.errors.append('{}: {}'.format(path, e))
+        return result
+
+    def _sync_entry(self, path, st, exists, result):
+        dest = os.path.join(self.dest, path)
+        dest_st = _lstat(dest) if exists else None
+        totals = result.totals
+        if stat.S_ISDIR(st.st_mode):
+            totals['dir'] += 1
+            if dest_st is not None and not stat.S_ISDIR(dest_st.st_mode):
+                self._remove(dest)
+                dest_st = None
+            if dest_st is None:
+                os.mkdir(dest)
+                result.lines.append(self._line('cd+++++++++', st, path + '/'))
+                totals['created'] += 1
+            result.dirs.append((path, st))
+            return
+        if dest_st is not None and stat.S_ISDIR(dest_st.st_mode):
+            self._remove(dest)
+            dest_st = None
+        if stat.S_ISREG(st.st_mode):
+            totals['reg'] += 1
+            totals['size'] += st.st_size
+            self._sync_file(path, st, dest_st, result)
+        elif stat.S_ISLNK(st.st_mode):
+            totals['link'] += 1
+            self._sync_symlink(path, st, dest_st, result)
+        else:
+            self._log.warning('Skipping special file "{}"'.format(path))
+
+    def _basis(self, path, test=None):
+        '''Returns (path, lstat) of the first basis passing test or found
+
+        Like rsync, the link dests are checked in order for the match,
+        the first existing basis is returned if none of them matches.
+        '''
+        found = None, None
+        for link_dest in self.link_dests:
+            basis = os.path.join(link_dest, path)
+            basis_st = _lstat(basis)
+            if basis_st is None:
+                continue
+            if test is None or test(basis_st):
+                return basis, basis_st
+            if found[1] is None:
+                found = basis, basis_st
+        return found
+
+    def _sync_file(self, path, st, dest_st, result):
+        dest = os.path.join(self.dest, path)
+        basis, basis_st = self._basis(
+            path, lambda _: stat.S_ISREG(_.st_mode) and self._unchanged(st, _))
+        if basis_st is not None and not stat.S_ISREG(basis_st.st_mode):
+            basis_st = None
+        if basis_st is not None and self._unchanged(st, basis_st):
+            if dest_st is not None:
+                if (dest_st.st_ino, dest_st.st_dev) == \
+                        (basis_st.st_ino, basis_st.st_dev):
+                    return
+                os.remove(dest)
+                dest_st = None
+            try:
+                os.link(basis, dest)
+                return
+            except OSError as e:
+                if e.errno not in (errno.EXDEV, errno.EMLINK, errno.EPERM):
+                    raise
+        if dest_st is not None:
+            if self._unchanged(st, dest_st):
+                return
+            os.remove(dest)
+        copy_data(os.path.join(self.source, path), dest, st.st_size)
+        self._set_attrs(dest, st, result.errors)
+        result.totals['transferred'] += 1
+        result.totals['transferred_size'] += st.st_size
+        previous = basis_st if basis_st is not None else dest_st
+        if previous is None:
+            result.totals['created'] += 1
+            item = '>f+++++++++'
+        else:
+            item = '>f.{}{}{}.....'.format(
+                '.' if previous.st_size == st.st_size else 's',
+                '.' if int(previous.st_mtime) == int(st.st_mtime) else 't',
+                '.' if stat.S_IMODE(previous.st_mode) ==
+                stat.S_IMODE(st.st_mode) else 'p')
+        result.lines.append(self._line(item, st, path))
+
+    @staticmethod
+    def _unchanged(st, other):
+        return st.st_size == other.st_size and \
+            int(st.st_mtime) == int(other.st_mtime) and \
+            stat.S_IMODE(st.st_mode) == stat.S_IMODE(other.st_mode)
+
+    def _sync_symlink(self, path, st, dest_st, result):
+        dest = os.path.join(self.dest, path)
+        target = os.readlink(os.path.join(self.source, path))
+        if dest_st is not None:
+            if stat.S_ISLNK(dest_st.st_mode) and os.readlink(dest) == target:
+                return
+            os.remove(dest)
+        basis, basis_st = self._basis(path)
+        os.symlink(target, dest)
+        self._set_link_mtime(dest, st)
+        if basis_st is not None and stat.S_ISLNK(basis_st.st_mode):
+            if os.readlink(basis) == target:
+                return
+            item = 'cLc.t......'
+        else:
+            result.totals['created'] += 1
+            item = 'cL+++++++++'
+        result.lines.append(self._line(item, st, path, target))
+
+    @staticmethod
+    def _set_link_mtime(dest, st):
+        if os.utime in getattr(os, 'supports_follow_symlinks', ()):
+            os.utime(dest, (st.st_atime, st.st_mtime),
+                     follow_symlinks=False)
+
+    @staticmethod
+    def _set_attrs(dest, st, errors):
+        try:
+            os.chmod(dest, stat.S_IMODE(st.st_mode))
+            os.utime(dest, (st.st_atime, st.st_mtime))
+        except OSError as e:
+            errors.append('{}: {}'.format(dest, e))
+
+    @staticmethod
+    def _remove(path):
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+
+    @staticmethod
+    def _line(item, st, path, target=None):
+        name = path if target is None else '{} -> {}'.format(path, target)
+        return '{}|{}|{}|{}\n'.format(item, st.st_size, _mtime(st), name)
+
+    @staticmethod
+    def _stats_lines(totals):
+        files = totals.reg + totals.dir + totals.link
+        return [
+            '\n',
+            'Number of files: {:,} (reg: {:,}, dir: {:,}, link: {:,})\n'
+            ''.format(files, totals.reg, totals.dir, totals.link),
+            'Number of created files: {:,}\n'.format(totals.created),
+            'Number of deleted files: {:,}\n'.format(totals.deleted),
+            'Number of regular files transferred: {:,}\n'
+            ''.format(totals.transferred),
+            'Total file size: {:,} bytes\n'.format(totals.size),
+            'Total transferred file size: {:,} bytes\n'
+            ''.format(totals.transferred_size),
+            'Literal data: {:,} bytes\n'.format(totals.transferred_size),
+            'Matched data: 0 bytes\n',
+        ]
@@ -0,0 +1,394 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015-2016, Mirantis, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+'''asyncio versions of RsyncOps and TRsync (python >= 3.5)
+
+The classes share command building, parsing and planning with their
+synchronous parents, only the methods which run rsync are coroutines here.
+The transaction, prune and catalog logic of TRsync is shared as the
+generators of I/O steps (see trsync.utils.steps) which AsyncTRsync awaits.
+So many destinations can be handled by a single event loop:
+
+    loop.run_until_complete(asyncio.gather(
+        *[AsyncTRsync(url).push(source, repo) for url in urls]))
+'''
+
+import asyncio
+import logging
+import os
+
+from trsync.utils import utils as utils
+
+from trsync.objects.local_ops import is_local
+from trsync.objects.local_ops import LocalOps
+from trsync.objects.rsync_mirror import TRsync
+from trsync.objects.rsync_ops import RsyncOps
+from trsync.utils.retry import RetryPolicy
+from trsync.utils.retry import RSYNC_UNREACHABLE
+from trsync.utils.shell import DeadlineExceeded
+from trsync.utils.shell_async import AsyncShell
+from trsync.utils.steps import Result
+from trsync.utils.steps_async import run_steps
+from trsync.utils.symlinks import SymlinkResolver
+
+logging.basicConfig()
+log = logging.getLogger(__name__)
+log.setLevel('DEBUG')
+
+
+class AsyncRsyncOps(RsyncOps):
+    def __init__(self, rsync_url, rsync_extra_params='', ls_cache=False,
+                 ls_cache_ttl=None, semaphore=None, **kwargs):
+        '''rsync operations on rsync_url as coroutines
+
+        semaphore (asyncio.Semaphore) limits the number of rsync processes
+        running at the same time, it may be shared between objects.
+        '''
+        super(AsyncRsyncOps, self).__init__(rsync_url,
+                                            rsync_extra_params,
+                                            ls_cache=ls_cache,
+                                            ls_cache_ttl=ls_cache_ttl,
+                                            **kwargs)
+        self._shell = AsyncShell(self._log, semaphore=semaphore,
+                                 retry=self.retry, deadline=self.deadline)
+
+    async def _start_master(self):
+        '''Starts ssh master connection (if any) in the executor
+
+        SshMaster.start() waits for the connection, so it is not called by
+        the loop thread (rsh() of the started master returns at once).
+        '''
+        if self.url.url_type == 'ssh' and self.ssh_master is not None and \
+                not self.ssh_master.started:
+            await asyncio.get_event_loop().run_in_executor(
+                None, self.ssh_master.start)
+
+    async def probe(self):
+        await self._start_master()
+        cmd = self._pull_cmd(opts=['-l'], extra=['--no-v'], no_dry_run=True)
+        try:
+            exitcode, out, err = await self._shell.shell(
+                cmd, raise_error=False, retry=RetryPolicy())
+        except DeadlineExceeded as e:
+            return False, str(e)
+        if exitcode in RSYNC_UNREACHABLE:
+            return False, 'Exit code == {}: {}'.format(exitcode, err.strip())
+        return True, ''
+
+    async def _pull(self, source='', dest='', opts='', extra=None,
+                    no_dry_run=False, raise_error=False, stdin=None,
+                    retry=None):
+        await self._start_master()
+        cmd = self._pull_cmd(source, dest, opts, extra, no_dry_run)
+        return (await self._shell.shell(cmd, raise_error=raise_error,
+                                        stdin=stdin, retry=retry))[1]
+
+    async def push(self, source='', dest='', opts='', extra=None,
+                   consumers=None, stdin=None, retry=None):
+        self._ls_cache_invalidate(dest)
+        return (await self._push(source=source, dest=dest, opts=opts,
+                                 extra=extra, consumers=consumers,
+                                 stdin=stdin, retry=retry))[1]
+
+    async def _push(self, source='', dest='', opts='', extra=None,
+                    stdin=None, raise_error=True, consumers=None,
+                    retry=None, relay=None):
+        await self._start_master()
+        return await self._shell.shell(
+            self._push_cmd(source, dest, opts, extra, relay),
+            raise_error=raise_error, stdin=stdin, consumers=consumers,
+            retry=retry)
+
+    async def tree_digest(self, paths):
+        return self._tree_digest(await self._pull(**self._tree_args(paths)))
+
+    async def _list(self, path=None):
+        try:
+            out = await self._pull(source=path, **self._list_args())
+        except DeadlineExceeded:
+            raise
+        except RuntimeError:
+            out = ''
+        return self._parse_ls(out)
+
+    async def _ls_dir_cached(self, dirname):
+        entries = self._ls_cache_get(dirname)
+        if entries is None:
+            entries = self._ls_cache_put(
+                dirname, await self._list(self.url.a_dir(dirname)))
+        return entries
+
+    async def _ls(self, path=None, pattern=r'.*'):
+        if self._ls_cache is None:
+            return self._ls_filter(await self._list(path), pattern=pattern)
+        dirname, name = self._ls_split(path)
+        return self._ls_filter(await self._ls_dir_cached(dirname), name,
+                               pattern)
+
+    async def ls(self, path=None, pattern=r'.*'):
+        return [_[1] for _ in await self._ls(path, pattern=pattern)]
+
+    async def ls_dirs(self, path=None, pattern=r'.*'):
+        return [_[1] for _ in await self._ls(path, pattern=pattern)
+                if _[0].startswith('d')]
+
+    async def ls_symlinks(self, path=None, pattern=r'.*'):
+        return [[_[1], _[2]] for _ in await self._ls(path, pattern=pattern)
+                if _[0].startswith('l')]
+
+    async def _symlink_abs_target(self, symlink, recursive=True):
+        return (await self.resolve_many([symlink], recursive=recursive,
+                                        absolute=True))[symlink]
+
+    async def symlink_target(self, symlink, recursive=True, absolute=False):
+        return (await self.resolve_many([symlink], recursive=recursive,
+                                        absolute=absolute))[symlink]
+
+    async def resolve_many(self, symlinks, recursive=True, absolute=False):
+        resolver = SymlinkResolver()
+        paths = resolver.pending(symlinks, recursive)
+        while paths:
+            resolver.add_listing(paths, await self._ls_paths(paths))
+            paths = resolver.pending(symlinks, recursive)
+        return self._resolved(resolver, symlinks, recursive, absolute)
+
+    async def rm_file(self, filename):
+        return await self.push(**self._rm_file_args(filename))
+
+    async def rm_all(self, names=[]):
+        paths = self._rm_paths(names)
+        if not paths:
+            return dict()
+        exitcode, out, err = await self._push(raise_error=False,
+                                              **self._rm_args(paths))
+        return self._rm_result(paths, exitcode, out, err)
+
+    async def clean_dir(self, dirname):
+        return await self.push(**self._clean_dir_args(dirname))
+
+    async def rm_dir(self, dirname):
+        self._log.info('Removing directory "{}"'.format(dirname))
+        return await self.rm_all(self.url.a_file(dirname))
+
+    async def mk_dir(self, dirname):
+        temp_dir = self._tmp.get_temp_dir(dirname)
+        try:
+            return (await self._push(**self._mk_dir_args(temp_dir,
+                                                         dirname)))[1]
+        finally:
+            self._tmp.recycle(temp_dir)
+
+    async def _ls_paths(self, paths):
+        result, paths = self._ls_paths_cached(paths)
+        if paths:
+            out = await self._pull(**self._ls_paths_args(paths))
+            result.update(self._parse_ls_paths(out, paths))
+        return result
+
+    async def symlinks(self, links, create_target_file=True,
+                       store_history=True, update=True, transaction=None):
+        '''Same as RsyncOps.symlinks
+
+        The function appended to transaction returns the coroutine.
+        '''
+        links, target_paths = self._symlinks_links(links)
+        if not links:
+            return dict()
+        listing = await self._ls_paths([_[1] for _ in links] +
+                                       list(target_paths.values()))
+        previous = self._symlinks_previous(links, target_paths, listing,
+                                           update)
+
+        temp_dir = self._tmp.get_temp_dir()
+        try:
+            infofiles = self._symlinks_infofiles(links, create_target_file)
+            if infofiles and store_history is True:
+                await self._pull(**self._symlinks_history_args(temp_dir,
+                                                               infofiles))
+            self._symlinks_stage(temp_dir, links, infofiles, store_history)
+
+            if transaction is not None:
+                transaction.append(
+                    lambda p=dict(previous): self._restore_symlinks(p))
+            await self._push(**self._symlinks_push_args(temp_dir))
+        finally:
+            self._tmp.recycle(temp_dir)
+        self._symlinks_done(links, infofiles)
+        return previous
+
+    async def _restore_symlinks(self, previous):
+        existed, absent = self._restore_symlinks_split(previous)
+        if existed:
+            await self.symlinks(existed)
+        if absent:
+            await self.rm_all(absent)
+
+    async def symlink(self, symlink, target,
+                      create_target_file=True, store_history=True,
+                      update=True):
+        return await self.symlinks([(symlink, target)],
+                                   create_target_file=create_target_file,
+                                   store_history=store_history,
+                                   update=update)
+
+
+class AsyncLocalOps(AsyncRsyncOps):
+    def __init__(self, rsync_url, rsync_extra_params='', ls_cache=False,
+                 ls_cache_ttl=None, semaphore=None, **kwargs):
+        '''AsyncRsyncOps for local path urls (see LocalOps)
+
+        Listings, creating and removing of directories and files and
+        symlinks are made by LocalOps sharing the listings cache, the
+        filesystem calls are quick, so they are made in the loop thread.
+        Data is still pushed and pulled by rsync processes.
+        '''
+        super(AsyncLocalOps, self).__init__(rsync_url,
+                                            rsync_extra_params,
+                                            ls_cache=ls_cache,
+                                            ls_cache_ttl=ls_cache_ttl,
+                                            semaphore=semaphore,
+                                            **kwargs)
+        self._local = LocalOps(rsync_url, rsync_extra_params,
+                               ls_cache=ls_cache, ls_cache_ttl=ls_cache_ttl)
+        self._local._ls_cache = self._ls_cache
+
+    def close(self):
+        self._local.close()
+        super(AsyncLocalOps, self).close()
+
+    async def _list(self, path=None):
+        return self._local._list(path)
+
+    async def _ls_paths(self, paths):
+        return self._local._ls_paths(paths)
+
+    async def rm_file(self, filename):
+        return self._local.rm_file(filename)
+
+    async def rm_all(self, names=[]):
+        return self._local.rm_all(names)
+
+    async def clean_dir(self, dirname):
+        return self._local.clean_dir(dirname)
+
+    async def mk_dir(self, dirname):
+        return self._local.mk_dir(dirname)
+
+    async def symlinks(self, links, create_target_file=True,
+                       store_history=True, update=True, transaction=None):
+        '''Same as LocalOps.symlinks
+
+        The function appended to transaction does not return the coroutine.
+        '''
+        return self._local.symlinks(links,
+                                    create_target_file=create_target_file,
+                                    store_history=store_history,
+                                    update=update, transaction=transaction)
+
+
+def async_ops_for_url(rsync_url, *args, **kwargs):
+    '''Returns AsyncLocalOps for local path urls, AsyncRsyncOps otherwise
+
+    See local_ops.is_local().
+    '''
+    params = args[0] if args else kwargs.get('rsync_extra_params')
+    if is_local(rsync_url, params):
+        return AsyncLocalOps(rsync_url, *args, **kwargs)
+    return AsyncRsyncOps(rsync_url, *args, **kwargs)
+
+
+class AsyncTRsync(TRsync):
+    def __init__(self, rsync_url, init_directory_structure=True,
+                 semaphore=None, **kwargs):
+        '''TRsync which methods return coroutines
+
+        Directory structure can not be created in the constructor, so it is
+        created by the first push (or by init_directory_structure()).
+        '''
+        super(AsyncTRsync, self).__init__(rsync_url,
+                                          init_directory_structure=False,
+                                          **kwargs)
+        self._semaphore = semaphore
+        self._init_pending = init_directory_structure is True
+        sync_ops = self.rsync
+        self.rsync = async_ops_for_url(
+            rsync_url,
+            rsync_extra_params=' '.join(['-v --no-owner --no-group',
+                                         self._rsync_extra_params]),
+            ls_cache=True,
+            ls_cache_ttl=sync_ops._ls_cache_ttl,
+            ssh_command=sync_ops._ssh_command,
+            ssh_multiplexing=sync_ops.ssh_master is not None,
+            retry=sync_ops.retry,
+            io_timeout=sync_ops.io_timeout,
+            connect_timeout=sync_ops.connect_timeout,
+            deadline=sync_ops.deadline,
+            semaphore=semaphore,
+        )
+        # the ops of the parent constructor are replaced, so their ssh
+        # master and temporary files are released here
+        sync_ops.close()
+
+    async def init_directory_structure(self):
+        for dir_full_name in (
+                self.url.a_dir(self.url.path),
+                self.url.a_dir(self.url.path, self._snapshots_dir)):
+            if dir_full_name in ['', '/']:
+                continue
+            if self.url.url_type != 'path':
+                rsync_root = AsyncRsyncOps(
+                    self.url.root, self._rsync_extra_params,
+                    ssh_command=self.rsync._ssh_command,
+                    ssh_multiplexing=self.rsync.ssh_master is not None,
+                    ssh_master=self.rsync.ssh_master,
+                    retry=self.rsync.retry,
+                    io_timeout=self.rsync.io_timeout,
+                    connect_timeout=self.rsync.connect_timeout,
+                    deadline=self.rsync.deadline,
+                    semaphore=self._semaphore)
+                await rsync_root.mk_dir(dir_full_name)
+            elif not os.path.isdir(dir_full_name):
+                os.makedirs(dir_full_name)
+        self._init_pending = False
+        return True
+
+    # the steps of TRsync are awaited, so its public methods (push,
+    # push_many, prune_repos, load_catalog, resolve_many and the others)
+    # return coroutines here
+    _run = staticmethod(run_steps)
+
+    def _push_many_steps(self, *args, **kwargs):
+        if self._init_pending:
+            yield self.init_directory_structure
+        results = yield super(AsyncTRsync, self)._push_many_steps(*args,
+                                                                  **kwargs)
+        yield Result(results)
+
+    @staticmethod
+    async def _run_snapshot(snapshot, consumers):
+        # the engine blocks on its worker threads
+        await asyncio.get_event_loop().run_in_executor(
+            None, utils.with_log_context(snapshot.run), consumers)
+
+    async def _rm_batches(self, batches, io_workers):
+        '''Removes batches by concurrent coroutines
+
+        Returns [(batch, success, result)] like utils.run_parallel.
+        '''
+        results = await asyncio.gather(
+            *[self.rsync.rm_all(_) for _ in batches], return_exceptions=True)
+        return [(batch, not isinstance(result, Exception), result)
+                for batch, result in zip(batches, results)]
@@ -14,14 +14,26 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import collections
 import datetime
 import logging
 import os
+import re
 
 from trsync.utils import utils as utils
 
+from trsync.objects.catalog import Catalog
+from trsync.objects.catalog import INCOMPLETE_SUFFIX
+from trsync.objects.catalog import SNAPSHOT_RE
 from trsync.objects.rsync_ops import RsyncOps
 from trsync.objects.rsync_remote import RsyncRemote
+from trsync.utils.changes import ChangesWriter
+from trsync.utils.shell import DeadlineExceeded
+from trsync.utils.shell import FileWriter
+from trsync.utils.shell import LogTail
+from trsync.utils.shell import ProgressLogger
+from trsync.utils.stats import linked_file_size
+from trsync.utils.steps import Result
 from trsync.utils.utils import TimeStamp
 
 logging.basicConfig()
@@ -30,6 +42,15 @@ log.setLevel('DEBUG')
 
 
 class TRsync(RsyncRemote):
+    changes_suffix = '.changes.jsonl.gz'
+    legacy_diff_suffix = '.diff.txt'
+    incomplete_suffix = INCOMPLETE_SUFFIX
+    # partially transferred files of resumable push, relative every dir
+    partial_dir = '.trsync-partial'
+    catalog_name = '.catalog.json'
+    # only the listed files, attributes of snapshots dir are not changed
+    upload_opts = ['--archive', '--files-from=-', '--from0']
+
     # TODO(mrasskazov): possible check that rsync url is exists
     def __init__(self,
                  rsync_url,
@@ -38,6 +59,13 @@ class TRsync(RsyncRemote):
                  snapshot_lifetime=14,
                  init_directory_structure=True,
                  timestamp=None,
+                 legacy_diff=True,
+                 catalog=True,
+                 catalog_max_age=86400,
+                 link_dest_repos=None,
+                 link_dest_depth=4,
+                 resumable=False,
+                 incomplete_max_age=172800,
                  **kwargs
                  ):
         super(TRsync, self).__init__(
@@ -48,6 +76,16 @@ class TRsync(RsyncRemote):
         self._snapshots_dir = self.url.a_dir(snapshots_dir)
         self._latest_successful_postfix = latest_successful_postfix
         self._snapshot_lifetime = snapshot_lifetime
+        self._legacy_diff = legacy_diff
+        self._use_catalog = catalog
+        self._catalog_max_age = catalog_max_age
+        self._catalog = None
+        self._catalog_path = self.url.a_file(self._snapshots_dir,
+                                             self.catalog_name)
+        self._link_dest_repos = list(link_dest_repos or [])
+        self._link_dest_depth = link_dest_depth
+        self._resumable = resumable
+        self._incomplete_max_age = incomplete_max_age
 
         self.timestamp = TimeStamp(timestamp)
         self._log.info('Using timestamp {}'.format(self.timestamp))
@@ -59,32 +97,87 @@ class TRsync(RsyncRemote):
         dir_full_name = self.url.a_dir(self.url.path, self._snapshots_dir)
         if dir_full_name not in ['', '/']:
             if self.url.url_type != 'path':
-                rsync_root = RsyncOps(self.url.root, self._rsync_extra_params)
-                rsync_root.mk_dir(dir_full_name)
+                self._root_ops().mk_dir(dir_full_name)
             else:
                 if not os.path.isdir(dir_full_name):
                     os.makedirs(dir_full_name)
         return True
 
-    def push(self, source, repo_name, symlinks=[], extra=None, save_diff=True):
-        repo_basename = os.path.split(repo_name)[-1]
-        latest_path = self.url.a_file(
-            self._snapshots_dir,
-            '{}-{}'.format(self.url.a_file(repo_basename),
-                           self._latest_successful_postfix)
-        )
+    def push(self, source, repo_name, symlinks=[], extra=None, save_diff=True,
+             keep_changes=True, prune=True):
+        '''Pushes source as new snapshot of repo_name, returns PushResult
 
-        symlinks = list(symlinks)
-        symlinks.insert(0, latest_path)
+        If save_diff is True, changes of the snapshot are stored next to it
+        as compressed JSON lines (<snapshot>.changes.jsonl.gz) and, if
+        legacy_diff is enabled, as rsync -v text (<snapshot>.diff.txt).
+        Durations of the phases are in result.timings: "transfer", "diff",
+        "symlinks", "catalog" and "prune". If prune is False, old snapshots
+        are not removed (see prune_repos). Besides the latest snapshot of
+        repo_name, its newest snapshots and the snapshots of link_dest_repos
+        are used as --link-dest (see _link_dests), data hardlinked to them
+        is result.stats["linked_file_size"].
+        '''
+        return self._run(self._push_repo_steps(
+            source, repo_name, symlinks, extra=extra, save_diff=save_diff,
+            keep_changes=keep_changes, prune=prune))
 
-        snapshot_name = self.url.a_file(
-            '{}-{}'.format(self.url.a_file(repo_basename), self.timestamp)
-        )
-        repo_path = self.url.a_file(self._snapshots_dir, snapshot_name)
+    def _push_repo_steps(self, source, repo_name, symlinks=[], extra=None,
+                         **kwargs):
+        results = yield self._push_many_steps(
+            [(source, repo_name)], {repo_name: symlinks}, extra=extra,
+            **kwargs)
+        yield Result(results[repo_name])
 
-        extra = '--link-dest={}'.format(
-            self.url.path_relative(latest_path, repo_path)
-        )
+    def push_many(self, sources, symlinks=None, extra=None, save_diff=True,
+                  keep_changes=True, prune=True, write_batch=None,
+                  read_batch=None):
+        '''Pushes several repos as one transaction like push does
+
+        sources is list of (source, repo_name), symlinks is {repo_name:
+        additional symlinks}. The catalog and the snapshots dir are read
+        once, the snapshots are transferred one by one, then the symlinks
+        of all the repos are switched by single call and the catalog is
+        written once: all the repos are committed or rolled back together.
+        Old snapshots of the repos are pruned by single prune_repos().
+        Returns {repo_name: PushResult}, the timings of the common phases
+        are the same in all the results.
+
+        If resumable is enabled, the snapshots are marked incomplete while
+        they are pushed and are not removed by rollback. Next push of the
+        repo creates new snapshot with the latest of them as the first
+        --link-dest (see _resume_snapshot), so its files are not
+        transferred again and the snapshot names do not depend on failures
+        of the mirror. The incomplete snapshot is removed after commit.
+
+        The same transfer may be applied to several mirrors holding the
+        same snapshots by rsync batch mode. write_batch is {repo_name:
+        batch file}, the transfer of the repo is recorded to the file
+        (--write-batch) and the state of the mirror it depends on is
+        result.batch_signature. read_batch is {repo_name: (batch file,
+        signature)}, the repo is replayed from the file (--read-batch) if
+        the mirror is in the same state (see _batch_signature), and pushed
+        from its source otherwise. result.batch is "write", "read" or None.
+        '''
+        return self._run(self._push_many_steps(
+            sources, symlinks, extra=extra, save_diff=save_diff,
+            keep_changes=keep_changes, prune=prune, write_batch=write_batch,
+            read_batch=read_batch))
+
+    def _push_many_steps(self, sources, symlinks=None, extra=None,
+                         save_diff=True, keep_changes=True, prune=True,
+                         write_batch=None, read_batch=None):
+        symlinks = symlinks or dict()
+        previous_catalog = None
+        if self._use_catalog:
+            previous_catalog = yield self._load_catalog_steps()
+        listing = yield self._link_dest_listing_steps(previous_catalog)
+        plans = [self._push_plan(repo_name, symlinks.get(repo_name, []),
+                                 extra, listing)
+                 for source, repo_name in sources]
+        for plan in plans:
+            yield self._batch_plan_steps(plan, write_batch, read_batch)
+        results = dict()
+        timings = dict()
 
         # TODO(mrasskazov): split transaction run (push or pull), and
         # commit/rollback functions. transaction must has possibility to
@@ -105,55 +198,765 @@ class TRsync(RsyncRemote):
         transaction = list()
         try:
             # start transaction
-            transaction.append(lambda p=repo_path: self.rsync.rm_all(p))
-            result = super(TRsync, self).push(self.url.a_dir(source),
-                                              repo_path,
-                                              extra)
-            self._log.info('{}'.format(result))
-
-            if save_diff is True:
-                diff_file = self._tmp.get_file(content='{}'.format(result))
-                diff_file_name = '{}.diff.txt'.format(repo_path)
+            for (source, repo_name), plan in zip(sources, plans):
+                results[repo_name] = yield self._push_snapshot_steps(
+                    source, plan, transaction, save_diff, keep_changes)
+
+            with utils.timed(timings, 'symlinks'):
+                previous = yield lambda: self.rsync.symlinks(
+                    sum([_.links for _ in plans], []),
+                    transaction=transaction)
+            self._log_previous(previous)
+            if self._resumable:
+                # snapshots are complete since now
                 transaction.append(
-                    lambda f=diff_file_name: self.rsync.rm_all(f)
-                )
-                super(TRsync, self).push(diff_file, diff_file_name)
-                self._log.debug('Diff file {} created.'
-                                ''.format(diff_file_name))
+                    lambda p=plans: self._write_markers_steps(p))
+                yield lambda: self.rsync.rm_all([_.marker for _ in plans])
 
-            for symlink in symlinks:
-                try:
-                    tgt = self.rsync.symlink_target(symlink, recursive=False)
-                    self._log.info('Previous {} -> {}'.format(symlink, tgt))
-                    undo = lambda l=symlink, t=tgt: self.rsync.symlink(l, t)
-                except Exception:
-                    undo = lambda l=symlink: self.rsync.rm_all(l)
-                transaction.append(undo)
-                self.rsync.symlink(
-                    symlink,
-                    self.url.path_relative(
-                        os.path.join(self._snapshots_dir, snapshot_name),
-                        os.path.split(symlink)[0]
-                    )
-                )
+            if previous_catalog is not None:
+                catalog = previous_catalog
+                for (source, repo_name), plan in zip(sources, plans):
+                    catalog = self._catalog_after_push(
+                        catalog, plan, results[repo_name], save_diff)
+                transaction.append(
+                    lambda c=previous_catalog: self._write_catalog_steps(c))
+                with utils.timed(timings, 'catalog'):
+                    yield self._write_catalog_steps(catalog)
 
-        except RuntimeError:
+        except RuntimeError as e:
             self._log.error("Rollback transaction because some of sync"
                             "operation failed")
-            [func() for func in reversed(transaction)]
-            raise
+            for func in reversed(transaction):
+                yield func
+            if self._resumable:
+                yield self._catalog_incomplete_steps(previous_catalog, plans)
+            # not bare raise: python 2 would raise the last exception
+            # handled by the steps
+            raise e
+        finally:
+            for plan in plans:
+                if 'diff_dir' in plan:
+                    self._tmp.recycle(plan.diff_dir)
 
         try:
             # deleting of old snapshots ignored when assessing the transaction
             # only warning
-            self._remove_old_snapshots(repo_name)
+            if prune:
+                with utils.timed(timings, 'prune'):
+                    yield self._prune_repos_steps(
+                        [repo_name for source, repo_name in sources])
         except RuntimeError:
             self._log.warn("Old snapshots are not deleted. Ignore. "
                            "May be next time.")
 
-        return result
+        try:
+            resumed = self._resumed_paths(plans)
+            if resumed:
+                yield lambda: self.rsync.rm_all(resumed)
+        except RuntimeError:
+            self._log.warn("Resumed incomplete snapshots are not deleted, "
+                           "they will be pruned.")
+
+        for result in results.values():
+            result.timings.update(timings)
+            self._log.info('Timings: {}'.format(result.timings))
+        yield Result(results)
+
+    def _push_snapshot_steps(self, source, plan, transaction, save_diff,
+                             keep_changes):
+        '''Transfers data and diff of single snapshot of push_many'''
+        if not self._resumable:
+            transaction.append(lambda p=plan.repo_path: self.rsync.rm_all(p))
+        else:
+            yield self._write_markers_steps([plan])
+        plan.started = True
+        consumers, record_consumers = self._push_consumers(plan, save_diff)
+        result = yield self._push_steps(
+            self._push_source(source, plan),
+            plan.repo_path,
+            plan.extra,
+            consumers=consumers,
+            record_consumers=record_consumers,
+            keep_changes=keep_changes)
+        result.batch = plan.batch
+        result.batch_signature = plan.batch_signature
+        result.snapshot = plan.repo_path
+        self._log_result(plan, result)
+
+        if save_diff is True:
+            transaction.append(
+                lambda f=plan.diff_files: self.rsync.rm_all(f)
+            )
+            with utils.timed(result.timings, 'diff'):
+                yield lambda: self.rsync.push(**self._diff_push_args(plan))
+            self._log.debug('Diff files {} created.'
+                            ''.format(plan.diff_files))
+        yield Result(result)
+
+    def _write_markers_steps(self, plans):
+        '''Uploads incomplete markers of the snapshots by single push'''
+        if not plans:
+            return
+        # the steps may be run by coroutines, so the directory is recycled
+        # explicitly instead of TempFiles.operation()
+        temp_dir = self._tmp.get_temp_dir()
+        try:
+            names = self._stage_markers(temp_dir, plans)
+            yield lambda: self.rsync.push(**self._upload_args(temp_dir,
+                                                              names))
+        finally:
+            self._tmp.recycle(temp_dir)
+
+    @staticmethod
+    def _stage_markers(temp_dir, plans):
+        names = list()
+        for plan in plans:
+            names.append(os.path.basename(plan.marker))
+            with open(os.path.join(temp_dir, names[-1]), 'w') as outfile:
+                outfile.write('{}\n'.format(plan.snapshot_name))
+        return names
+
+    def _catalog_incomplete_steps(self, previous, plans):
+        '''Adds snapshots of failed push to the catalog, errors ignored'''
+        if previous is None:
+            return
+        try:
+            yield self._write_catalog_steps(
+                self._catalog_with_incomplete(previous, plans))
+        except RuntimeError:
+            self._log.warn('Incomplete snapshots are not added to catalog')
+
+    @staticmethod
+    def _catalog_with_incomplete(previous, plans):
+        catalog = previous.copy()
+        for plan in plans:
+            if plan.get('started'):
+                catalog.add_incomplete(plan.snapshot_name)
+        return catalog
+
+    def _resumed_paths(self, plans):
+        '''Returns paths of incomplete snapshots resumed by the plans'''
+        paths = list()
+        for plan in plans:
+            if plan.resumed:
+                path = self.url.a_file(self._snapshots_dir, plan.resumed_from)
+                paths.extend([path, path + self.incomplete_suffix])
+        return paths
+
+    def _resume_snapshot(self, repo_basename, snapshots_listing):
+        '''Returns the latest incomplete snapshot of the repo or None
+
+        Snapshots older than incomplete_max_age seconds are abandoned
+        (they are removed by pruning).
+        '''
+        if not self._resumable:
+            return None
+        pattern = re.compile(self._snapshots_pattern(re.escape(repo_basename)))
+        for name in sorted(self._incomplete(snapshots_listing), reverse=True):
+            if pattern.match(name) and \
+                    not self._abandoned(repo_basename, name):
+                return name
+        return None
+
+    @staticmethod
+    def _incomplete(snapshots_listing):
+        '''Returns set of snapshots marked incomplete in the listing'''
+        names = set([_[1] for _ in snapshots_listing if _[0].startswith('d')])
+        return set([_[1][:-len(INCOMPLETE_SUFFIX)] for _ in snapshots_listing
+                    if _[1].endswith(INCOMPLETE_SUFFIX)]) & names
+
+    def _abandoned(self, repo_name, name):
+        '''Returns True if incomplete snapshot is too old to resume'''
+        started = datetime.datetime.strptime(
+            name, '{}-{}'.format(repo_name,
+                                 self.timestamp.snapshot_stamp_format))
+        return self.timestamp.now - started > \
+            datetime.timedelta(seconds=self._incomplete_max_age)
+
+    def _push_plan(self, repo_name, symlinks=[], extra=None,
+                   snapshots_listing=None):
+        '''Evaluates names and paths used by push
+
+        snapshots_listing of snapshots dir is used to choose --link-dest
+        candidates (only the latest snapshot is used without it) and the
+        incomplete snapshot to resume ("resumed_from"). The snapshot is
+        always named by the timestamp, the resumed one is the first
+        --link-dest.
+        '''
+        plan = utils.bunch(repo_name=repo_name)
+        repo_basename = os.path.split(repo_name)[-1]
+        latest_path = self.url.a_file(
+            self._snapshots_dir,
+            '{}-{}'.format(self.url.a_file(repo_basename),
+                           self._latest_successful_postfix)
+        )
+
+        symlinks = list(symlinks)
+        symlinks.insert(0, latest_path)
+
+        plan.snapshot_name = self.url.a_file(
+            '{}-{}'.format(self.url.a_file(repo_basename), self.timestamp))
+        plan.resumed_from = self._resume_snapshot(
+            self.url.a_file(repo_basename), snapshots_listing or [])
+        plan.resumed = plan.resumed_from is not None
+        if plan.resumed:
+            self._log.info('Resuming incomplete snapshot {} into {}'
+                           ''.format(plan.resumed_from, plan.snapshot_name))
+        plan.repo_path = self.url.a_file(self._snapshots_dir,
+                                         plan.snapshot_name)
+        plan.marker = plan.repo_path + self.incomplete_suffix
+        plan.diff_files = [plan.repo_path + self.changes_suffix]
+        if self._legacy_diff:
+            plan.diff_files.append(plan.repo_path + self.legacy_diff_suffix)
+
+        extra = RsyncOps._args(extra)
+        if self._resumable:
+            extra.append('--partial-dir={}'.format(self.partial_dir))
+        limit = self.link_dest_limit - \
+            len([_ for _ in extra if _.startswith('--link-dest')])
+        plan.link_dests = self._link_dests(
+            repo_basename, latest_path, snapshots_listing or [], limit,
+            exclude=[plan.snapshot_name, plan.resumed_from])
+        if plan.resumed:
+            # files transferred by the failed push are linked, not copied
+            plan.link_dests.insert(0, self.url.a_file(self._snapshots_dir,
+                                                      plan.resumed_from))
+            plan.link_dests = plan.link_dests[:max(0, limit)]
+        plan.extra = ['--link-dest={}'.format(
+            self.url.path_relative(_, plan.repo_path)
+        ) for _ in plan.link_dests] + extra
+
+        plan.links = [(symlink,
+                       self.url.path_relative(
+                           os.path.join(self._snapshots_dir,
+                                        plan.snapshot_name),
+                           os.path.split(symlink)[0]))
+                      for symlink in symlinks]
+        return plan
+
+    def _batch_signature_steps(self, plan):
+        '''Returns state of the mirror which the transfer of plan depends on
+
+        It is the snapshot name, the --link-dest candidates (including the
+        resumed incomplete snapshot) with their targets and the digest of
+        the trees of the targets and of the snapshot. The batch of the transfer
+        written on one mirror may be read on another one only if their
+        signatures are equal.
+        '''
+        targets = yield lambda: self.rsync.resolve_many(plan.link_dests,
+                                                        absolute=True)
+        digest = yield lambda: self.rsync.tree_digest(
+            [targets[_] for _ in plan.link_dests] + [plan.repo_path])
+        yield Result(self._signature(plan, targets, digest))
+
+    def _signature(self, plan, targets, digest):
+        return dict(snapshot=plan.snapshot_name,
+                    resumed=plan.resumed,
+                    link_dests=[[self.url.path_relative(_, plan.repo_path),
+                                 targets[_]] for _ in plan.link_dests],
+                    digest=digest)
+
+    def _batch_plan_steps(self, plan, write_batch=None, read_batch=None):
+        '''Sets plan.batch, adds the batch file option to plan.extra'''
+        plan.batch = None
+        plan.batch_signature = None
+        if not self._batch_wanted(plan, write_batch, read_batch):
+            return
+        try:
+            signature = yield self._batch_signature_steps(plan)
+        except DeadlineExceeded:
+            raise
+        except RuntimeError as e:
+            self._log.warn('Batch mode is not used for {}: {}'
+                           ''.format(plan.repo_name, e))
+            return
+        self._batch_apply(plan, write_batch, read_batch, signature)
+
+    @staticmethod
+    def _batch_wanted(plan, write_batch, read_batch):
+        return plan.repo_name in (write_batch or dict()) or \
+            plan.repo_name in (read_batch or dict())
+
+    def _batch_apply(self, plan, write_batch, read_batch, signature):
+        plan.batch_signature = signature
+        if plan.repo_name in (write_batch or dict()):
+            plan.batch = 'write'
+            plan.extra.append('--write-batch={}'
+                              ''.format(write_batch[plan.repo_name]))
+            return
+        batch_file, expected = read_batch[plan.repo_name]
+        if signature != expected:
+            self._log.warn('Snapshots of {} differ from the ones the batch '
+                           'is written against, pushing from the source'
+                           ''.format(plan.repo_name))
+            return
+        plan.batch = 'read'
+        plan.extra.append('--read-batch={}'.format(batch_file))
+
+    def _push_source(self, source, plan):
+        '''Returns source url of the push, None if it is read from batch'''
+        if plan.batch == 'read':
+            return None
+        return self.url.a_dir(source)
+
+    def _push_listed(self):
+        '''Returns True if _push_plan needs listing of snapshots dir'''
+        return bool(self._link_dest_depth or self._link_dest_repos or
+                    self._resumable)
+
+    def _link_dest_listing_steps(self, catalog=None):
+        '''Returns listing of snapshots dir for _push_plan or None'''
+        if not self._push_listed():
+            yield Result(None)
+        if catalog is not None:
+            yield Result(catalog.listings()[0])
+        listing = yield lambda: self.rsync._ls(self._snapshots_dir)
+        yield Result(listing)
+
+    def _link_dests(self, repo_basename, latest_path, snapshots_listing,
+                    limit=None, exclude=()):
+        '''Returns paths of --link-dest candidates, the best first
+
+        The latest snapshot of the repo goes first, then link_dest_depth
+        newest snapshots of the repo (they may be not promoted to latest
+        yet), then the latest and newest snapshots of every repo of
+        link_dest_repos found in the listing. Up to limit paths, exclude
+        snapshots are skipped.
+        '''
+        if limit is None:
+            limit = self.link_dest_limit
+        snapshots = sorted([_[1] for _ in snapshots_listing
+                            if _[0].startswith('d') and _[1] not in exclude],
+                           reverse=True)
+        link_dests = [latest_path]
+        for repo in [repo_basename] + self._link_dest_repos:
+            pattern = re.compile(self._snapshots_pattern(re.escape(repo)))
+            newest = [_ for _ in snapshots if pattern.match(_)]
+            if not newest:
+                continue
+            if repo != repo_basename:
+                link_dests.append(self.url.a_file(
+                    self._snapshots_dir,
+                    '{}-{}'.format(repo, self._latest_successful_postfix)))
+            link_dests.extend([self.url.a_file(self._snapshots_dir, _)
+                               for _ in newest[:self._link_dest_depth]])
+        unique = list()
+        for path in link_dests:
+            if path not in unique:
+                unique.append(path)
+        return unique[:max(0, limit)]
+
+    def _push_consumers(self, plan, save_diff):
+        '''Returns (consumers, record_consumers) for data push
+
+        Changes and rsync output are streamed to the diff files staged in
+        plan.diff_dir, only the tail of the output is kept in memory.
+        '''
+        plan.tail = LogTail()
+        consumers = [plan.tail, ProgressLogger(self._log)]
+        record_consumers = list()
+        if save_diff is True:
+            plan.diff_dir = self._tmp.get_temp_dir()
+            for diff_file in plan.diff_files:
+                staged = os.path.join(plan.diff_dir,
+                                      os.path.basename(diff_file))
+                if diff_file.endswith(self.changes_suffix):
+                    record_consumers.append(ChangesWriter(staged))
+                else:
+                    consumers.append(FileWriter(staged))
+        return consumers, record_consumers
+
+    def _diff_push_args(self, plan):
+        return self._upload_args(plan.diff_dir,
+                                 [os.path.basename(_)
+                                  for _ in plan.diff_files])
+
+    def _upload_args(self, local_dir, names):
+        '''Returns push args for uploading of files to snapshots dir'''
+        return dict(source=self.url.a_dir(local_dir),
+                    dest=self.url.a_dir(self._snapshots_dir),
+                    opts=self.upload_opts,
+                    stdin='\0'.join(names))
+
+    def load_catalog(self, reload=False):
+        '''Returns Catalog of the mirror
+
+        The catalog file is read by one small transfer and kept in memory
+        (until reload). If the file is missing, invalid or older than
+        catalog_max_age seconds, the catalog is rebuilt by the listings of
+        the snapshots dir and the root.
+        '''
+        return self._run(self._load_catalog_steps(reload))
+
+    def _load_catalog_steps(self, reload=False):
+        if self._catalog is not None and not reload:
+            yield Result(self._catalog)
+        temp_dir = self._tmp.get_temp_dir()
+        try:
+            yield lambda: self.rsync._pull(
+                **self._catalog_pull_args(temp_dir))
+            catalog = self._catalog_read(temp_dir)
+        finally:
+            self._tmp.recycle(temp_dir)
+        if catalog is None or catalog.is_stale(self._catalog_max_age):
+            listings = yield self._listings_steps(self._prune_dirs())
+            catalog = self._catalog_rebuild(catalog, listings)
+        self._catalog = catalog
+        yield Result(catalog)
+
+    def _listings_steps(self, dirs):
+        '''Returns listings of dirs'''
+        listings = list()
+        for path in dirs:
+            listing = yield lambda p=path: self.rsync._ls(p)
+            listings.append(listing)
+        yield Result(listings)
+
+    def _catalog_pull_args(self, temp_dir):
+        return dict(source=self._catalog_path, dest=self.url.a_dir(temp_dir),
+                    no_dry_run=True, retry=self.rsync._lookup_retry())
+
+    def _catalog_read(self, temp_dir):
+        '''Returns Catalog pulled to temp_dir or None'''
+        filename = os.path.join(temp_dir, self.catalog_name)
+        if not os.path.isfile(filename):
+            self._log.info('Catalog {} not found'.format(self._catalog_path))
+            return None
+        with open(filename) as infile:
+            catalog = Catalog.loads(infile.read())
+        if catalog is None:
+            self._log.warn('Catalog {} is invalid'.format(self._catalog_path))
+        return catalog
+
+    def _catalog_rebuild(self, previous, listings):
+        self._log.info('Rebuilding catalog {}'.format(self._catalog_path))
+        dirs = [_.strip('/') for _ in self._prune_dirs()]
+        return Catalog.from_listings(listings[0], dict(zip(dirs, listings)),
+                                     previous)
+
+    def _catalog_after_push(self, previous, plan, result, save_diff):
+        '''Returns copy of previous catalog with the pushed snapshot'''
+        catalog = previous.copy()
+        diff = list()
+        if save_diff is True:
+            diff = [os.path.basename(_) for _ in plan.diff_files]
+        if plan.resumed:
+            catalog.remove_snapshots([plan.resumed_from])
+        catalog.add_snapshot(
+            plan.snapshot_name, stats=result.stats, diff=diff,
+            changes=None if result.changes is None else len(result.changes))
+        for symlink, target in plan.links:
+            catalog.symlinks[self.url.a_file(symlink).strip('/')] = \
+                plan.snapshot_name
+        return catalog
+
+    def _write_catalog_steps(self, catalog):
+        '''Uploads the catalog atomically (rsync renames temporary file)'''
+        temp_dir = self._tmp.get_temp_dir()
+        try:
+            yield lambda: self.rsync.push(
+                **self._catalog_upload_args(temp_dir, catalog))
+        finally:
+            self._tmp.recycle(temp_dir)
+        self._catalog = catalog
+
+    def _catalog_upload_args(self, temp_dir, catalog):
+        with open(os.path.join(temp_dir, self.catalog_name), 'w') as outfile:
+            outfile.write(catalog.dumps())
+        return self._upload_args(temp_dir, [self.catalog_name])
+
+    def symlink_target(self, symlink, recursive=True, absolute=False):
+        '''Returns target of symlink (relative url)
+
+        Symlinks are always resolved by RsyncOps, the catalog is not used
+        since symlinks may be changed without it (trsync symlink, by hand
+        or by push with --no-catalog).
+        '''
+        return self._run(self._symlink_target_steps(symlink, recursive,
+                                                    absolute))
+
+    def _symlink_target_steps(self, symlink, recursive=True, absolute=False):
+        targets = yield self._resolve_many_steps([symlink], recursive,
+                                                 absolute)
+        yield Result(targets[symlink])
+
+    def resolve_many(self, symlinks, recursive=True, absolute=False):
+        '''Returns {symlink: target} resolved by RsyncOps at once'''
+        return self._run(self._resolve_many_steps(symlinks, recursive,
+                                                  absolute))
+
+    def _resolve_many_steps(self, symlinks, recursive=True, absolute=False):
+        result = yield lambda: self.rsync.resolve_many(
+            symlinks, recursive=recursive, absolute=absolute)
+        yield Result(result)
+
+    def _log_result(self, plan, result):
+        if plan.tail.truncated:
+            self._log.info('Last {} of {} lines of output:'
+                           ''.format(plan.tail.maxlen,
+                                     plan.tail.lines_number))
+        self._log.info('{}'.format(result))
+        if result.changes is not None:
+            self._log.info('{} paths changed'.format(len(result.changes)))
+        linked = linked_file_size(result.stats)
+        if linked is not None:
+            result.stats['linked_file_size'] = linked
+            self._log.info('Hardlinked {} bytes to {} --link-dest, '
+                           'transferred {} bytes'
+                           ''.format(linked, len(plan.link_dests),
+                                     result.stats.transferred_file_size))
+        if result.stats:
+            self._log.info('Transfer stats: {}'.format(dict(result.stats)))
+        if len(result.attempts) > 1:
+            self._log.info('Transferred in {} attempts, exit codes: {}'
+                           ''.format(len(result.attempts),
+                                     [_.exitcode for _ in result.attempts]))
+
+    def _log_previous(self, previous):
+        for symlink, tgt in previous.items():
+            self._log.info('Previous {} -> {}'.format(symlink, tgt))
 
     def _remove_old_snapshots(self, repo_name, snapshot_lifetime=None):
+        return self._run(self._remove_old_snapshots_steps(repo_name,
+                                                          snapshot_lifetime))
+
+    def _remove_old_snapshots_steps(self, repo_name, snapshot_lifetime=None):
+        plan = yield self._prune_plan_steps(repo_name, snapshot_lifetime)
+        if plan is not None:
+            yield self._prune_steps(plan)
+
+    def prune_plan(self, repo_name, snapshot_lifetime=None):
+        '''Returns plan of removing old snapshots of repo_name or None
+
+        The plan is evaluated by one listing of the root and one of the
+        snapshots dir (plus symlinks known by the catalog outside of them,
+        see _prune_listings_steps and _prune_plan), nothing is removed
+        until it is passed to prune().
+        '''
+        return self._run(self._prune_plan_steps(repo_name, snapshot_lifetime))
+
+    def _prune_plan_steps(self, repo_name, snapshot_lifetime=None):
+        snapshot_lifetime = self._prune_lifetime(snapshot_lifetime)
+        if snapshot_lifetime is None:
+            yield Result(None)
+        listings = yield self._prune_listings_steps()
+        yield Result(self._prune_plan(repo_name, snapshot_lifetime,
+                                      listings))
+
+    def _prune_listings_steps(self):
+        '''Returns listings of _prune_dirs() and of symlinks of the catalog
+
+        Symlinks may be changed without the catalog (trsync symlink, by
+        hand or by push with --no-catalog), so _prune_dirs() are always
+        listed by rsync. The catalog only adds its symlinks placed outside
+        of them, their current targets are listed by single call.
+        '''
+        dirs = self._prune_dirs()
+        listings = yield self._listings_steps(dirs)
+        if self._use_catalog:
+            catalog = yield self._load_catalog_steps()
+            listed = set([_.strip('/') for _ in dirs])
+            others = sorted([_ for _ in catalog.symlinks
+                             if os.path.dirname(_) not in listed])
+            if others:
+                current = yield lambda: self.rsync._ls_paths(others)
+                listings.append([
+                    (mode, path, target)
+                    for path, (mode, target) in sorted(current.items())
+                    if mode.startswith('l') and target])
+        yield Result(listings)
+
+    def prune(self, plan):
+        '''Removes snapshots (and their diffs) planned by prune_plan()'''
+        return self._run(self._prune_steps(plan))
+
+    def _prune_steps(self, plan):
+        if plan.paths:
+            yield lambda: self.rsync.rm_all(plan.paths)
+            if self._use_catalog:
+                catalog = yield self._load_catalog_steps()
+                yield self._write_catalog_steps(
+                    self._catalog_after_prune(catalog, plan))
+
+    def prune_repos(self, repos=None, snapshot_lifetime=None,
+                    io_workers=4, dry_run=False):
+        '''Removes old snapshots of several repos in one pass
+
+        The snapshots dir and the root are listed once for all the repos,
+        all the repos found in the snapshots dir are pruned if repos is
+        None. Snapshots (with their diffs) are removed by up to io_workers
+        concurrent rm_all, the catalog is written once. Returns report
+        bunch: "plans" {repo: plan of prune_plan()}, planned "snapshots",
+        "removed" and "failed" ones, "reclaimed" bytes (None if unknown)
+        and "exact" (False if reclaimed is estimated). Nothing is removed
+        if dry_run is True.
+        '''
+        return self._run(self._prune_repos_steps(repos, snapshot_lifetime,
+                                                 io_workers, dry_run))
+
+    def _prune_repos_steps(self, repos=None, snapshot_lifetime=None,
+                           io_workers=4, dry_run=False):
+        snapshot_lifetime = self._prune_lifetime(snapshot_lifetime)
+        if snapshot_lifetime is None:
+            yield Result(self._prune_report())
+        listings = yield self._prune_listings_steps()
+        report = self._prune_report(repos, snapshot_lifetime, listings)
+        catalog = None
+        if self._use_catalog:
+            catalog = yield self._load_catalog_steps()
+        report.reclaimed, report.exact = self._reclaimed_space(
+            report.snapshots, catalog)
+        if dry_run or not report.snapshots:
+            yield Result(report)
+
+        batches = self._prune_batches(report.plans, io_workers)
+        results = yield lambda: self._rm_batches(batches, io_workers)
+        self._prune_done(report, results)
+        if catalog is not None and report.removed:
+            yield self._write_catalog_steps(self._catalog_after_prune(
+                catalog, utils.bunch(remove=report.removed)))
+        yield Result(report)
+
+    def _rm_batches(self, batches, io_workers):
+        '''Removes batches by concurrent rm_all
+
+        Returns [(batch, success, result)] like utils.run_parallel.
+        '''
+        return utils.run_parallel(self.rsync.rm_all, batches,
+                                  workers=io_workers)
+
+    def _prune_report(self, repos=None, snapshot_lifetime=None,
+                      listings=None):
+        '''Returns report of prune_repos with the plans of repos'''
+        report = utils.bunch(plans=dict(), snapshots=list(), removed=list(),
+                             failed=list(), reclaimed=None, exact=False)
+        if listings is None:
+            return report
+        if repos is None:
+            repos = self._listing_repos(listings[0])
+        for repo in repos:
+            report.plans[repo] = self._prune_plan(repo, snapshot_lifetime,
+                                                  listings)
+            report.snapshots.extend(report.plans[repo].remove)
+        report.snapshots.sort()
+        return report
+
+    def _prune_done(self, report, results):
+        '''Updates report by [(batch, success, result)] of rm_all'''
+        for batch, success, result in results:
+            names = [os.path.basename(_) for _ in batch
+                     if os.path.basename(_) in report.snapshots]
+            if success:
+                report.removed.extend(names)
+            else:
+                self._log.error('Removing of {} failed: {}'
+                                ''.format(names, result))
+                report.failed.extend(names)
+        report.removed.sort()
+        report.failed.sort()
+        self._log.info('Removed {} snapshots, reclaimed {} {} bytes'
+                       ''.format(len(report.removed),
+                                 'exactly' if report.exact else 'about',
+                                 report.reclaimed))
+
+    @staticmethod
+    def _listing_repos(snapshots_listing):
+        '''Returns names of repos having snapshots in the listing'''
+        repos = set()
+        for mode, name, target in snapshots_listing:
+            match = SNAPSHOT_RE.match(name)
+            if mode.startswith('d') and match:
+                repos.add(match.group('repo'))
+        return sorted(repos)
+
+    @classmethod
+    def _prune_batches(cls, plans, io_workers):
+        '''Returns up to io_workers lists of paths for concurrent rm_all
+
+        Paths of every snapshot (the dir and its diffs) are kept together,
+        snapshots are dealt to the batches round robin.
+        '''
+        groups = collections.OrderedDict()
+        for repo in sorted(plans):
+            for path in plans[repo].paths:
+                snapshot = path
+                for suffix in (cls.changes_suffix, cls.legacy_diff_suffix,
+                               cls.incomplete_suffix):
+                    if snapshot.endswith(suffix):
+                        snapshot = snapshot[:-len(suffix)]
+                groups.setdefault(snapshot, list()).append(path)
+        groups = list(groups.values())
+        batches = [list() for _ in range(max(1, min(io_workers,
+                                                    len(groups))))]
+        for i, group in enumerate(groups):
+            batches[i % len(batches)].extend(group)
+        return [_ for _ in batches if _]
+
+    def _reclaimed_space(self, snapshots, catalog=None):
+        '''Returns (bytes freed by removing of snapshots, exact)
+
+        For local mirror the inodes of the snapshots are counted, only
+        the ones which all links are inside the removed snapshots are
+        freed. Otherwise it is estimated by the catalog: data of removed
+        snapshot replaced in the next snapshot of its repo is the data
+        transferred by the push of the next one (None without catalog).
+        '''
+        if not snapshots:
+            return 0, True
+        if self.url.url_type == 'path':
+            return self._local_reclaimed_space(snapshots), True
+        if catalog is None:
+            return None, False
+        reclaimed = 0
+        for name in snapshots:
+            info = catalog.snapshots.get(name) or dict()
+            later = [_ for _ in catalog.repo_snapshots(info.get('repo'))
+                     if _ > name]
+            stats = catalog.snapshots[later[0]].get('stats') if later \
+                else info.get('stats')
+            reclaimed += (stats or {}).get('transferred_file_size', 0)
+        return reclaimed, False
+
+    def _local_reclaimed_space(self, snapshots):
+        snapshots_dir = os.path.join(self.url.path, self._snapshots_dir)
+        inodes = dict()
+        reclaimed = 0
+        for name in snapshots:
+            path = os.path.join(snapshots_dir, name)
+            paths = [path + self.changes_suffix,
+                     path + self.legacy_diff_suffix]
+            for dirpath, dirnames, filenames in os.walk(path):
+                paths.extend([os.path.join(dirpath, _) for _ in filenames])
+            for path in paths:
+                try:
+                    st = os.lstat(path)
+                except OSError:
+                    continue
+                if st.st_nlink == 1:
+                    reclaimed += st.st_size
+                    continue
+                key = (st.st_dev, st.st_ino)
+                size, nlink, seen = inodes.get(key, (st.st_size,
+                                                     st.st_nlink, 0))
+                inodes[key] = (size, nlink, seen + 1)
+        return reclaimed + sum([size for size, nlink, seen
+                                in inodes.values() if seen >= nlink])
+
+    @staticmethod
+    def _catalog_after_prune(previous, plan):
+        catalog = previous.copy()
+        catalog.remove_snapshots(plan.remove)
+        return catalog
+
+    def _prune_dirs(self):
+        '''Returns directories which listings are used by _prune_plan'''
+        dirs = [self.url.a_dir(self._snapshots_dir)]
+        if self.url.a_dir() not in dirs:
+            dirs.append(self.url.a_dir())
+        return dirs
+
+    def _prune_lifetime(self, snapshot_lifetime=None):
+        '''Returns lifetime in days (-1 for all) or None to skip pruning'''
         if snapshot_lifetime is None:
             snapshot_lifetime = self._snapshot_lifetime
         if snapshot_lifetime is None or snapshot_lifetime is False:
@@ -167,55 +970,80 @@ class TRsync(RsyncRemote):
             self._log.info('Skip deletion of old snapshots '
                            '(snapshot_lifetime == {})'
                            ''.format(snapshot_lifetime))
-            return
+            return None
         else:
             # delete snapshots older than
             self._log.info('Deletion all of the unlinked snapshots older '
                            'than {0} days (snapshot_lifetime == {0})'
                            ''.format(snapshot_lifetime))
+        return snapshot_lifetime
+
+    def _snapshots_pattern(self, repo_name):
+        return r'^{}-{}$'.format(repo_name,
+                                 self.timestamp.snapshot_stamp_pattern)
+
+    def _prune_plan(self, repo_name, snapshot_lifetime, listings):
+        '''Returns plan of pruning evaluated by listings of _prune_dirs()
+
+        Plan is bunch: snapshots to remove ("remove"), snapshots kept by
+        symlinks ({snapshot: symlinks} "linked"), kept as new ("new") or
+        as incomplete ones which may be resumed ("incomplete"), and "paths"
+        to remove (snapshots with their diffs). Incomplete snapshots are
+        removed only if they are older than incomplete_max_age seconds.
+        '''
+        plan = utils.bunch(repo_name=repo_name, lifetime=snapshot_lifetime,
+                           remove=list(), linked=dict(), new=list(),
+                           incomplete=list(), paths=list())
+        snapshots_listing = listings[0]
+        pattern = re.compile(self._snapshots_pattern(repo_name))
+        snapshots = [_[1] for _ in snapshots_listing
+                     if _[0].startswith('d') and pattern.match(_[1])]
+        incomplete = self._incomplete(snapshots_listing)
+
+        # symlinks are indexed by the names of their targets
+        links = collections.defaultdict(list)
+        for listing in listings:
+            for mode, name, target in listing:
+                if mode.startswith('l') and target:
+                    links[os.path.basename(target.rstrip('/'))].append(name)
+
         warn_date = \
             self.timestamp.now - datetime.timedelta(days=snapshot_lifetime)
         warn_date = datetime.datetime.combine(warn_date, datetime.time(0))
-        snapshots = self.rsync.ls_dirs(
-            self.url.a_dir(self._snapshots_dir),
-            pattern=r'^{}-{}$'.format(
-                repo_name,
-                self.timestamp.snapshot_stamp_pattern
-            )
-        )
-        links = self.rsync.ls_symlinks(self.url.a_dir())
-        links += self.rsync.ls_symlinks(self.url.a_dir(self._snapshots_dir))
-        snapshots_to_remove = list()
-        new_snapshots = list()
+        stamp_format = '{}-{}'.format(repo_name,
+                                      self.timestamp.snapshot_stamp_format)
         for s in snapshots:
-            s_date = datetime.datetime.strptime(
-                s,
-                '{}-{}'.format(repo_name,
-                               self.timestamp.snapshot_stamp_format)
-            )
+            s_date = datetime.datetime.strptime(s, stamp_format)
             s_date = datetime.datetime.combine(s_date, datetime.time(0))
-            s_path = self.url.a_file(self._snapshots_dir, s)
-            if s_date < warn_date:
-                s_links = [_[0] for _ in links
-                           if _[1] == s
-                           or _[1].endswith('/{}'.format(s))
-                           ]
-                if not s_links:
-                    snapshots_to_remove.append(s_path)
-                    snapshots_to_remove.append(s_path + '.diff.txt')
+            if s in incomplete and s not in links:
+                if self._abandoned(repo_name, s):
+                    s_path = self.url.a_file(self._snapshots_dir, s)
+                    plan.remove.append(s)
+                    plan.paths.extend([s_path,
+                                       s_path + self.changes_suffix,
+                                       s_path + self.legacy_diff_suffix,
+                                       s_path + self.incomplete_suffix])
                 else:
-                    self._log.info('Skip deletion of "{}" because there are '
-                                   'symlinks found: {}'.format(s, s_links))
+                    plan.incomplete.append(s)
+            elif s_date >= warn_date:
+                plan.new.append(s)
+            elif s in links:
+                plan.linked[s] = links[s]
+                self._log.info('Skip deletion of "{}" because there are '
+                               'symlinks found: {}'.format(s, links[s]))
             else:
-                new_snapshots.append(s)
+                s_path = self.url.a_file(self._snapshots_dir, s)
+                plan.remove.append(s)
+                plan.paths.extend([s_path,
+                                   s_path + self.changes_suffix,
+                                   s_path + self.legacy_diff_suffix])
 
-        if new_snapshots:
+        if plan.new:
             self._log.info('Skip deletion of snapshots newer than '
                            '{} days: {}'.format(snapshot_lifetime,
-                                                str(new_snapshots)))
+                                                str(plan.new)))
 
-        if snapshots_to_remove:
+        if plan.paths:
             self._log.info('Removing old snapshots (older then {} days): {}'
-                           ''.format(snapshot_lifetime,
-                                     str(snapshots_to_remove)))
-            self.rsync.rm_all(snapshots_to_remove)
+                           ''.format(snapshot_lifetime, str(plan.paths)))
+        return plan
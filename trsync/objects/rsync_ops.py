@@ -14,14 +14,25 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import hashlib
 import logging
 import os
 import re
+import shlex
+import time
 
 from trsync.utils import utils as utils
 
 from trsync.objects.rsync_url import RsyncUrl as RsyncUrl
+from trsync.utils.retry import PARTIAL_TRANSFER
+from trsync.utils.retry import RetryPolicy
+from trsync.utils.retry import RSYNC_UNREACHABLE
+from trsync.utils.shell import cmd_to_str
+from trsync.utils.shell import Deadline
+from trsync.utils.shell import DeadlineExceeded
 from trsync.utils.shell import Shell
+from trsync.utils.ssh import SshMaster
+from trsync.utils.symlinks import SymlinkResolver
 from trsync.utils.tempfiles import TempFiles
 
 
@@ -31,33 +42,175 @@ log.setLevel('DEBUG')
 
 
 class RsyncOps(object):
-    def __init__(self, rsync_url, rsync_extra_params=''):
-        # TODO(mrasskazov): retry parameters for rsync
+    def __init__(self, rsync_url, rsync_extra_params='', ls_cache=False,
+                 ls_cache_ttl=None, ssh_command=None, ssh_multiplexing=True,
+                 ssh_master=None, retry=None, io_timeout=None,
+                 connect_timeout=None, deadline=None):
+        '''rsync operations on rsync_url
+
+        If ls_cache is True, listings of remote directories are cached and
+        ls-family methods are answered from the cache. The cache is updated
+        by writes of this object only, so it should be enabled when nobody
+        else changes the remote during the object lifetime, or with
+        ls_cache_ttl (seconds) for long-running processes.
+
+        For ssh urls all rsync calls are multiplexed over persistent ssh
+        master connection (see SshMaster) which is stopped by close().
+        ssh_command (remote shell for rsync -e, "ssh" by default) is used
+        for it. Master connection of other object may be shared by
+        ssh_master, it is not stopped by close() of this object then.
+
+        rsync calls failed with transient exit codes are retried according
+        to retry (RetryPolicy, single attempt by default). Listings and
+        lookups do not retry partial transfer codes, they are returned for
+        missing paths.
+
+        io_timeout is rsync --timeout, connect_timeout is rsync --contimeout
+        for daemon urls and ssh ConnectTimeout for ssh urls (seconds, none
+        by default). deadline (seconds or Deadline shared with other
+        objects) limits the duration of all the rsync calls of the object,
+        the running call is killed when it expires (see Shell).
+        '''
         self._log = utils.logger.getChild('RsyncOps.' + rsync_url)
         self._tmp = TempFiles()
-        self._shell = Shell(self._log)
-        self._rsync_extra_params = ' '.join(['-v --no-owner --no-group',
-                                            rsync_extra_params])
+        self.retry = retry if retry is not None else RetryPolicy()
+        if deadline is not None and not isinstance(deadline, Deadline):
+            deadline = Deadline(deadline)
+        self.deadline = deadline
+        self.io_timeout = io_timeout
+        self.connect_timeout = connect_timeout
+        self._shell = Shell(self._log, retry=self.retry,
+                            deadline=self.deadline)
+        self._rsync_extra_params = ['-v', '--no-owner', '--no-group'] + \
+            self._args(rsync_extra_params)
         self.url = RsyncUrl(rsync_url)
+        self._ls_cache = dict() if ls_cache else None
+        self._ls_cache_ttl = ls_cache_ttl
+        self._ssh_command = ssh_command
+        self._own_ssh_master = False
+        if ssh_master is None and ssh_multiplexing and \
+                self.url.url_type == 'ssh':
+            ssh_master = SshMaster(self._ssh_destination(),
+                                   self._ssh_args(), logger=self._log)
+            self._own_ssh_master = True
+        self.ssh_master = ssh_master
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def close(self):
+        '''Stops owned ssh master connection, removes temporary files'''
+        if self._own_ssh_master:
+            self.ssh_master.close()
+        self._tmp.close()
+
+    def _ssh_destination(self):
+        if self.url.user:
+            return '{}@{}'.format(self.url.user, self.url.host)
+        return self.url.host
+
+    @staticmethod
+    def _args(params):
+        '''Returns list of arguments for params
+
+        params may be list of arguments or string, string is parsed by shlex
+        (it is used for free-form parameters like rsync_extra_params).
+        '''
+        if not params:
+            return list()
+        if isinstance(params, (list, tuple)):
+            return list(params)
+        return shlex.split(params)
+
+    def _cmd(self, opts, extra, *urls):
+        '''Returns rsync argument vector'''
+        return self._rsync_cmd(self._rsh_args(), opts, extra, urls)
+
+    def _rsync_cmd(self, rsh_args, opts, extra, urls):
+        cmd = ['rsync'] + self._args(opts) + rsh_args + \
+            self._timeout_args() + self._rsync_extra_params + \
+            self._args(extra)
+        if self.url.url_type == 'ssh':
+            # remote shell should not split paths with spaces
+            cmd.append('--protect-args')
+        return cmd + [_.url for _ in urls]
+
+    def _rsh_args(self):
+        '''Returns rsync -e option for ssh urls
+
+        It is placed before extra params, so -e specified by user wins.
+        '''
+        if self.url.url_type != 'ssh':
+            return list()
+        if self.ssh_master is not None:
+            return ['-e', self.ssh_master.rsh()]
+        return self._plain_rsh_args()
+
+    def _plain_rsh_args(self):
+        '''Returns rsync -e option without ssh master connection'''
+        if self.url.url_type == 'ssh' and \
+                (self._ssh_command or self.connect_timeout):
+            return ['-e', cmd_to_str(self._ssh_args())]
+        return list()
+
+    def _ssh_args(self):
+        '''Returns ssh argument vector with the connect timeout'''
+        args = self._args(self._ssh_command or 'ssh')
+        if self.connect_timeout:
+            args += ['-o', 'ConnectTimeout={}'.format(self.connect_timeout)]
+        return args
+
+    def _timeout_args(self):
+        '''Returns rsync timeout options
+
+        They are placed before extra params, so the options specified by
+        user win.
+        '''
+        args = list()
+        if self.io_timeout:
+            args.append('--timeout={}'.format(self.io_timeout))
+        if self.connect_timeout and self.url.url_type.startswith('rsync'):
+            args.append('--contimeout={}'.format(self.connect_timeout))
+        return args
+
+    def probe(self):
+        '''Checks that rsync_url is reachable by single listing
+
+        Returns (reachable, message). The url is reachable even if it does
+        not exist yet, it is not reachable if the connection fails or the
+        deadline expires.
+        '''
+        cmd = self._pull_cmd(opts=['-l'], extra=['--no-v'], no_dry_run=True)
+        try:
+            exitcode, out, err = self._shell.shell(
+                cmd, raise_error=False, retry=RetryPolicy())
+        except DeadlineExceeded as e:
+            return False, str(e)
+        if exitcode in RSYNC_UNREACHABLE:
+            return False, 'Exit code == {}: {}'.format(exitcode, err.strip())
+        return True, ''
 
     def _pull(self, source='', dest='', opts='', extra=None,
-              no_dry_run=False, raise_error=False):
-        cmd = 'rsync {opts} {allextra} {source.url}'
-        source = RsyncUrl(self.url.urljoin(source))
+              no_dry_run=False, raise_error=False, stdin=None, retry=None):
+        cmd = self._pull_cmd(source, dest, opts, extra, no_dry_run)
+        return self._shell.shell(cmd, raise_error=raise_error,
+                                 stdin=stdin, retry=retry)[1]
+
+    def _pull_cmd(self, source='', dest='', opts='', extra=None,
+                  no_dry_run=False):
+        urls = [RsyncUrl(self.url.urljoin(source))]
         if dest:
-            dest = RsyncUrl(dest)
-            cmd += ' {dest.url}'
-        allextra = self._rsync_extra_params
-        if extra is not None:
-            allextra = ' '.join((allextra, extra))
-        cmd = cmd.format(**(locals()))
+            urls.append(RsyncUrl(dest))
+        cmd = self._cmd(opts, extra, *urls)
         if no_dry_run:
-            cmd.replace('--dry-run', '')
-        self._log.debug(cmd)
-        return self._shell.shell(cmd, raise_error=raise_error)[1]
+            cmd = [_ for _ in cmd if _ != '--dry-run']
+        return cmd
 
-    def push(self, source='', dest='', opts='', extra=None):
-        # TODO(mrasskazov): retry for rsync
+    def push(self, source='', dest='', opts='', extra=None, consumers=None,
+             stdin=None, retry=None):
         # TODO(mrasskazov): locking:
         # https://review.openstack.org/#/c/147120/4/utils/simple_http_daemon.py
         # create lock-files on remotes during operations
@@ -70,82 +223,216 @@ class RsyncOps(object):
         # unlocked
         # TODO(mrasskazov): check for url compatibility
         # (local->remote, remote->local, local->local)
-        cmd = 'rsync {opts} {allextra} {source.url} {dest.url}'
-        source = RsyncUrl(source)
-        dest = RsyncUrl(self.url.urljoin(dest))
-        allextra = self._rsync_extra_params
-        if extra is not None:
-            allextra = ' '.join((allextra, extra))
-        cmd = cmd.format(**(locals()))
-        self._log.debug(cmd)
-        return self._shell.shell(cmd)[1]
-
-    def _ls(self, path=None, pattern=r'.*', opts=''):
-        extra = '--no-v'
+        self._ls_cache_invalidate(dest)
+        return self._push(source=source, dest=dest, opts=opts, extra=extra,
+                          consumers=consumers, stdin=stdin, retry=retry)[1]
+
+    def _push(self, source='', dest='', opts='', extra=None, stdin=None,
+              raise_error=True, consumers=None, retry=None, relay=None):
+        '''Runs rsync push, returns ShellResult with the attempts'''
+        return self._shell.shell(
+            self._push_cmd(source, dest, opts, extra, relay),
+            raise_error=raise_error, stdin=stdin, consumers=consumers,
+            retry=retry)
+
+    def _push_cmd(self, source='', dest='', opts='', extra=None,
+                  relay=None):
+        '''Returns push argument vector, source is None for --read-batch
+
+        If relay (see fanout.SshRelay) is specified, rsync is launched on
+        its host over ssh and source is a path there. The local ssh master
+        connection is not used by that rsync then.
+        '''
+        urls = [RsyncUrl(self.url.urljoin(dest))]
+        if source is not None:
+            urls.insert(0, RsyncUrl(source))
+        if relay is None:
+            return self._cmd(opts, extra, *urls)
+        if self.url.url_type == 'path':
+            raise RuntimeError('Local destination "{}" can not be pushed by '
+                               'relay {}'.format(self.url.url, relay))
+        return relay.wrap(self._rsync_cmd(self._plain_rsh_args(), opts,
+                                          extra, urls))
+
+    def _list(self, path=None):
+        '''Lists path on remote, returns [(mode, name, symlink target)]'''
         try:
-            out = self._pull(source=path, opts=opts, extra=extra,
-                             no_dry_run=True, raise_error=False)
+            out = self._pull(source=path, **self._list_args())
+        except DeadlineExceeded:
+            raise
         except RuntimeError:
             out = ''
+        return self._parse_ls(out)
+
+    def _list_args(self):
+        return dict(opts=['-l'], extra=['--no-v'], no_dry_run=True,
+                    raise_error=False, retry=self._lookup_retry())
+
+    def _lookup_retry(self):
+        '''Returns RetryPolicy for calls which may address missing paths'''
+        return self.retry.excluding(*PARTIAL_TRANSFER)
+
+    @classmethod
+    def _parse_ls(cls, out):
+        entries = [cls._parse_ls_line(_) for _ in out.splitlines()]
+        return [_ for _ in entries if _ is not None and _[1] != '.']
+
+    def _ls_cache_get(self, dirname):
+        '''Returns cached listing of dirname or None'''
+        if self._ls_cache is None or dirname not in self._ls_cache:
+            return None
+        timestamp, entries = self._ls_cache[dirname]
+        if self._ls_cache_ttl is not None and \
+                time.time() - timestamp > self._ls_cache_ttl:
+            del self._ls_cache[dirname]
+            return None
+        return entries
+
+    def _ls_dir_cached(self, dirname):
+        '''Returns listing of dirname (relative rsync_url) from the cache'''
+        entries = self._ls_cache_get(dirname)
+        if entries is None:
+            entries = self._ls_cache_put(dirname,
+                                         self._list(self.url.a_dir(dirname)))
+        return entries
+
+    def _ls_cache_put(self, dirname, entries):
+        self._ls_cache[dirname] = (time.time(), entries)
+        return entries
+
+    def _ls_cache_invalidate(self, path='', ancestors=False):
+        '''Drops cached listings which could be changed by writing to path
+
+        If ancestors is True, listings of all the directories above path
+        are dropped too (mk_dir may create them).
+        '''
+        if not self._ls_cache:
+            return
+        path = self.url.a_file(path or '').strip('/')
+        parents = set([os.path.dirname(path)])
+        if ancestors:
+            parent = path
+            while parent:
+                parent = os.path.dirname(parent)
+                parents.add(parent)
+        for key in list(self._ls_cache.keys()):
+            if not path or key == path or key in parents or \
+                    key.startswith(path + '/'):
+                del self._ls_cache[key]
+
+    def _ls_cache_update(self, path, mode, target=None):
+        '''Puts entry written by this object to the cached listing'''
+        if not self._ls_cache:
+            return
+        path = path.strip('/')
+        for key in list(self._ls_cache.keys()):
+            if key == path or key.startswith(path + '/'):
+                del self._ls_cache[key]
+        dirname, name = os.path.split(path)
+        if dirname in self._ls_cache:
+            timestamp, entries = self._ls_cache[dirname]
+            entries = [_ for _ in entries if _[1] != name]
+            entries.append((mode, name, target))
+            self._ls_cache[dirname] = (timestamp, entries)
+
+    @staticmethod
+    def _ls_split(path):
+        '''Returns (directory, name) to look up path in cached listings
+
+        name is None if the content of directory is requested.
+        '''
+        path = path or ''
+        if not path or path.endswith('/'):
+            return path.strip('/'), None
+        return os.path.split(path.strip('/'))
+
+    @staticmethod
+    def _ls_filter(entries, name=None, pattern=r'.*'):
+        if name is not None:
+            entries = [_ for _ in entries if _[1] == name]
         pattern = re.compile(pattern)
-        out = [_ for _ in out.splitlines()
-               if (_.split()[-1] != '.') and
-               (pattern.match(_.split()[-1]) is not None)]
-        return out
+        return [_ for _ in entries if pattern.match(_[1]) is not None]
+
+    def _ls(self, path=None, pattern=r'.*'):
+        if self._ls_cache is None:
+            return self._ls_filter(self._list(path), pattern=pattern)
+        dirname, name = self._ls_split(path)
+        return self._ls_filter(self._ls_dir_cached(dirname), name, pattern)
 
     def ls(self, path=None, pattern=r'.*'):
-        out = self._ls(path, pattern=pattern)
-        out = [_.split()[-1] for _ in out]
-        return out
+        return [_[1] for _ in self._ls(path, pattern=pattern)]
 
     def ls_dirs(self, path=None, pattern=r'.*'):
-        out = self._ls(path, pattern=pattern)
-        out = [_.split()[-1] for _ in out if _.startswith('d')]
-        return out
+        return [_[1] for _ in self._ls(path, pattern=pattern)
+                if _[0].startswith('d')]
 
     def ls_symlinks(self, path=None, pattern=r'.*'):
-        out = self._ls(path, pattern=pattern, opts='-l')
-        out = [_.split()[-3:] for _ in out if _.startswith('l')]
-        out = [[_[0], _[-1]] for _ in out]
-        return out
+        return [[_[1], _[2]] for _ in self._ls(path, pattern=pattern)
+                if _[0].startswith('l')]
 
     def _symlink_abs_target(self, symlink, recursive=True):
-        target = symlink
-        try:
-            path, name = os.path.split(target)
-            target = self.ls_symlinks(symlink)[-1][-1]
-            abs_target = os.path.normpath(os.path.join(path, target))
-            if not recursive:
-                return abs_target
-            return self._symlink_abs_target(abs_target)
-        except Exception:
-            return target
+        return self.resolve_many([symlink], recursive=recursive,
+                                 absolute=True)[symlink]
 
     def symlink_target(self, symlink, recursive=True, absolute=False):
-        if absolute:
-            return self._symlink_abs_target(symlink, recursive=recursive)
-        else:
-            return os.path.relpath(
-                self._symlink_abs_target(symlink, recursive=recursive),
-                os.path.dirname(symlink)
-            )
+        return self.resolve_many([symlink], recursive=recursive,
+                                 absolute=absolute)[symlink]
+
+    def resolve_many(self, symlinks, recursive=True, absolute=False):
+        '''Returns {symlink: target} for symlinks (relative rsync_url)
+
+        Next hops of all the chains are listed by single rsync call, hops
+        are listed once per call. Raises RuntimeError on symlinks loop.
+        '''
+        resolver = SymlinkResolver()
+        paths = resolver.pending(symlinks, recursive)
+        while paths:
+            resolver.add_listing(paths, self._ls_paths(paths))
+            paths = resolver.pending(symlinks, recursive)
+        return self._resolved(resolver, symlinks, recursive, absolute)
+
+    @staticmethod
+    def _resolved(resolver, symlinks, recursive, absolute):
+        result = dict()
+        for symlink in symlinks:
+            target = resolver.target(symlink, recursive=recursive)
+            if not absolute:
+                target = os.path.relpath(target, os.path.dirname(symlink))
+            result[symlink] = target
+        return result
 
     def rm_file(self, filename):
         '''Removes file on rsync_url.'''
+        return self.push(**self._rm_file_args(filename))
+
+    def _rm_file_args(self, filename):
         report_name = filename
         dirname, filename = os.path.split(filename)
         dirname = self.url.a_dir(dirname)
         source = self.url.a_dir(self._tmp.empty_dir)
-        opts = "-r --delete --include={} '--exclude=*'".format(filename)
+        opts = ['-r', '--delete', '--include={}'.format(filename),
+                '--exclude=*']
         self._log.info('Removing file "{}"'.format(report_name))
-        return self.push(source=source, dest=dirname, opts=opts)
+        return dict(source=source, dest=dirname, opts=opts)
 
     def rm_all(self, names=[]):
         '''Remove all files and dirs (recursively)
 
-        on list as single rsync operation
+        on list as single rsync operation. Names are relative rsync_url and
+        streamed to rsync on stdin, so any number of names is removed in one
+        session. Returns dict {name: True} if all the names were removed (or
+        were absent), raises RuntimeError with the list of failed names
+        otherwise.
         '''
+        paths = self._rm_paths(names)
+        if not paths:
+            return dict()
+        exitcode, out, err = self._push(raise_error=False,
+                                        **self._rm_args(paths))
+        return self._rm_result(paths, exitcode, out, err)
 
+    def _rm_paths(self, names):
+        '''Returns {path: name} for rm_all'''
         if type(names) not in (list, tuple):
             if type(names) is str:
                 names = [names]
@@ -153,37 +440,71 @@ class RsyncOps(object):
                 raise RuntimeError('rsync_remote.rm_all has wrong parameter '
                                    '"names" == "{}"'.format(names))
 
-        source = self.url.a_dir(self._tmp.empty_dir)
-
-        # group files by directories
-        dest_dirs = dict()
+        paths = dict()
         for name in names:
-            dirname, filename = os.path.split(name)
-            if dirname not in dest_dirs.keys():
-                dest_dirs[dirname] = list()
-            dest_dirs[dirname].append(filename)
-
-        for dest_dir, filenames in dest_dirs.items():
-            # prepare filter file for every dest_dir
-            content = ''
-            for filename in filenames:
-                content += '+ {}\n'.format(filename)
-            content += '- *'
-            filter_file = self._tmp.get_file(content=content)
-            # removing specified files on dest_dir
-            self._log.debug('Removing objects on "{}" directory: {}'
-                            ''.format(dest_dir, str(filenames)))
-            opts = "--recursive --delete --filter='merge,p {}'"\
-                   "".format(filter_file)
-            self.push(source=source, dest=dest_dir, opts=opts)
+            path = self.url.a_file(name).strip('/')
+            if not path:
+                raise RuntimeError('rsync_remote.rm_all can not remove the '
+                                   'root of "{}"'.format(self.url.url))
+            paths[path] = name
+        return paths
+
+    def _rm_args(self, paths):
+        self._log.debug('Removing objects: {}'.format(str(sorted(paths))))
+        return dict(source=self.url.a_dir(self._tmp.empty_dir),
+                    opts=['--files-from=-', '--from0',
+                          '--delete-missing-args', '--force',
+                          '--itemize-changes'],
+                    stdin='\0'.join(paths))
+
+    def _rm_result(self, paths, exitcode, out, err):
+        for path in paths:
+            self._ls_cache_invalidate(path)
+        report = self._rm_report(paths, exitcode, out, err)
+        failed = sorted([_ for _, removed in report.items() if not removed])
+        if failed:
+            msg = 'Removing of {} failed. Exit code == {}\n\nSTDERR: \n{}'\
+                  ''.format(str(failed), exitcode, err)
+            self._log.error(msg)
+            raise RuntimeError(msg)
+        return report
+
+    @staticmethod
+    def _rm_report(paths, exitcode, out, err):
+        '''Evaluates {name: removed} for rm_all by rsync output'''
+        if exitcode == 0:
+            return dict([(name, True) for name in paths.values()])
+
+        deleted = set()
+        for line in out.splitlines():
+            match = re.match(r'^\*deleting\s+(.*)$', line)
+            if match is not None:
+                deleted.add(match.group(1).rstrip('/'))
+
+        def mentioned(path):
+            # rsync reports failed object or something inside it
+            return re.search(r'[\s(\"]{}(/|[\s)\"]|$)'
+                             ''.format(re.escape(path)), err) is not None
+
+        blamed = [_ for _ in paths if mentioned(_)]
+        report = dict()
+        for path, name in paths.items():
+            if blamed:
+                report[name] = path not in blamed
+            else:
+                # nothing to blame in stderr (connection error, etc.)
+                report[name] = path in deleted
+        return report
 
     def clean_dir(self, dirname):
         '''Removes directories (recursive) on rsync_url'''
+        return self.push(**self._clean_dir_args(dirname))
+
+    def _clean_dir_args(self, dirname):
         dirname = self.url.a_dir(dirname)
         source = self.url.a_dir(self._tmp.empty_dir)
-        opts = "-a --delete"
         self._log.info('Cleaning directory "{}"'.format(dirname))
-        return self.push(source=source, dest=dirname, opts=opts)
+        return dict(source=source, dest=dirname, opts=['-a', '--delete'])
 
     def rm_dir(self, dirname):
         '''Removes directories (recursive) on rsync_url'''
@@ -192,46 +513,233 @@ class RsyncOps(object):
 
     def mk_dir(self, dirname):
         '''Creates directories (recirsive, like mkdir -p) on rsync_url'''
-        source = self.url.a_dir(self._tmp.get_temp_dir(dirname))
-        opts = "-r"
+        with self._tmp.operation():
+            temp_dir = self._tmp.get_temp_dir(dirname)
+            return self._push(**self._mk_dir_args(temp_dir, dirname))[1]
+
+    def _mk_dir_args(self, temp_dir, dirname):
+        source = self.url.a_dir(temp_dir)
         self._log.info('Creating directory "{}"'.format(dirname))
-        return self.push(source=source, opts=opts)
+        self._ls_cache_invalidate(dirname, ancestors=True)
+        return dict(source=source, opts=['-r'])
 
-    def symlink(self, symlink, target,
-                create_target_file=True, store_history=True, update=True):
-        '''Creates symlink targeted to target'''
+    @staticmethod
+    def _parse_ls_line(line):
+        '''Returns (mode, name, symlink target) for rsync --list-only line'''
+        parts = line.split(None, 4)
+        if len(parts) < 5 or \
+                re.match(r'^[-bcdlps][-rwxsStT]{9}$', parts[0]) is None or \
+                re.match(r'^\d{4}/\d{2}/\d{2}$', parts[2]) is None:
+            return None
+        mode, name, target = parts[0], parts[4], None
+        if mode.startswith('l') and ' -> ' in name:
+            name, target = name.split(' -> ', 1)
+        return mode, name, target
+
+    def _ls_paths(self, paths):
+        '''Lists specified paths (relative rsync_url) by single rsync call
+
+        Returns dict {path: (mode, symlink target)} for existent paths only.
+        '''
+        result, paths = self._ls_paths_cached(paths)
+        if paths:
+            out = self._pull(**self._ls_paths_args(paths))
+            result.update(self._parse_ls_paths(out, paths))
+        return result
+
+    def _ls_paths_cached(self, paths):
+        '''Returns ({path: (mode, target)}, paths which are not cached)'''
+        paths = set([_.strip('/') for _ in paths if _.strip('/')])
+        result = dict()
+        # paths in the cached directories are not listed again
+        for path in list(paths):
+            dirname, name = os.path.split(path)
+            entries = self._ls_cache_get(dirname)
+            if entries is not None:
+                paths.discard(path)
+                for mode, entry, target in entries:
+                    if entry == name:
+                        result[path] = (mode, target)
+        return result, paths
+
+    @staticmethod
+    def _ls_paths_args(paths):
+        return dict(source='/',
+                    opts=['-l', '--files-from=-', '--from0',
+                          '--ignore-missing-args'],
+                    extra=['--no-v'], no_dry_run=True, raise_error=False,
+                    stdin='\0'.join(paths))
 
-        # check that symlink already exists on remote
-        if not update:
-            if self.ls_symlinks(symlink):
+    def tree_digest(self, paths):
+        '''Returns digest of recursive listing of paths (relative rsync_url)
+
+        Paths are listed by single rsync call, missing paths are skipped.
+        Equal digests mean the same names, types, sizes, mtimes and symlink
+        targets in the trees.
+        '''
+        return self._tree_digest(self._pull(**self._tree_args(paths)))
+
+    def _tree_args(self, paths):
+        return dict(source='/',
+                    opts=['-rl', '--files-from=-', '--from0',
+                          '--ignore-missing-args'],
+                    extra=['--no-v'], no_dry_run=True, raise_error=True,
+                    stdin='\0'.join(sorted(set(paths))))
+
+    @classmethod
+    def _tree_digest(cls, out):
+        entries = sorted([line.split(None, 4) for line in out.splitlines()
+                          if cls._parse_ls_line(line) is not None])
+        digest = hashlib.sha1()
+        for entry in entries:
+            digest.update(('\0'.join(entry) + '\n').encode('utf-8'))
+        return digest.hexdigest()
+
+    @classmethod
+    def _parse_ls_paths(cls, out, paths):
+        result = dict()
+        for line in out.splitlines():
+            parsed = cls._parse_ls_line(line)
+            if parsed is not None and parsed[1].rstrip('/') in paths:
+                mode, name, target = parsed
+                result[name.rstrip('/')] = (mode, target)
+        return result
+
+    def symlinks(self, links, create_target_file=True, store_history=True,
+                 update=True, transaction=None):
+        '''Creates (or updates) all the symlinks targeted to their targets
+
+        links is list of (symlink, target) pairs or dict {symlink: target}.
+        Current state of the symlinks and targets is evaluated by single
+        listing, history files are pulled by single rsync call, and new
+        symlinks with history files are pushed together. So the number of
+        rsync calls does not depend on the number of symlinks.
+
+        If transaction list is specified, the function which restores
+        previous state of the symlinks is appended to it before pushing.
+        Returns dict {symlink: previous target or None}.
+        '''
+        links, target_paths = self._symlinks_links(links)
+        if not links:
+            return dict()
+        listing = self._ls_paths([_[1] for _ in links] +
+                                 list(target_paths.values()))
+        previous = self._symlinks_previous(links, target_paths, listing,
+                                           update)
+
+        with self._tmp.operation():
+            temp_dir = self._tmp.get_temp_dir()
+            infofiles = self._symlinks_infofiles(links, create_target_file)
+            if infofiles and store_history is True:
+                self._pull(**self._symlinks_history_args(temp_dir,
+                                                         infofiles))
+            self._symlinks_stage(temp_dir, links, infofiles, store_history)
+
+            if transaction is not None:
+                transaction.append(
+                    lambda p=dict(previous): self._restore_symlinks(p))
+            self._push(**self._symlinks_push_args(temp_dir))
+        self._symlinks_done(links, infofiles)
+        return previous
+
+    def _symlinks_links(self, links):
+        '''Returns [(symlink, path, target)] and {path: target path}'''
+        if isinstance(links, dict):
+            links = list(links.items())
+        links = [(symlink, self.url.a_file(symlink).strip('/'), target)
+                 for symlink, target in links]
+        target_paths = dict()
+        for symlink, link_path, target in links:
+            target_paths[link_path] = os.path.normpath(
+                os.path.join(os.path.dirname(link_path), target))
+        return links, target_paths
+
+    @staticmethod
+    def _symlinks_previous(links, target_paths, listing, update):
+        '''Checks the links against listing, returns previous targets'''
+        previous = dict()
+        for symlink, link_path, target in links:
+            mode, current = listing.get(link_path, ('', None))
+            is_symlink = mode.startswith('l')
+            # check that symlink already exists on remote
+            if not update and is_symlink:
                 raise RuntimeError('Symlink {} already exists'.format(symlink))
-        temp_dir = self._tmp.get_temp_dir()
-        remote_path, symlink = os.path.split(self.url.a_file(symlink))
-        # check that target is exists on remote
-        if not self.ls(os.path.join(remote_path, target)):
-            raise RuntimeError('Target {} does not exists'.format(target))
-        path = os.path.join(temp_dir, remote_path)
-        if not os.path.isdir(path):
-            os.makedirs(path)
-        os.symlink(target, os.path.join(path, symlink))
+            # check that target is exists on remote
+            if target_paths[link_path] not in listing:
+                raise RuntimeError('Target {} does not exists'.format(target))
+            previous[symlink] = current if is_symlink else None
+        return previous
 
+    @staticmethod
+    def _symlinks_infofiles(links, create_target_file):
+        infofiles = dict()
         if create_target_file is True:
-            infofile = '{}.target.txt'\
-                ''.format(os.path.join(remote_path, symlink))
+            for symlink, link_path, target in links:
+                infofiles['{}.target.txt'.format(link_path)] = target
+        return infofiles
+
+    def _symlinks_history_args(self, temp_dir, infofiles):
+        return dict(source='/', dest=self.url.a_dir(temp_dir),
+                    opts=['--files-from=-', '--from0',
+                          '--ignore-missing-args'],
+                    no_dry_run=True, raise_error=False,
+                    stdin='\0'.join(infofiles))
+
+    def _symlinks_stage(self, temp_dir, links, infofiles, store_history):
+        '''Creates symlinks and history files in the staging tree'''
+        for infofile, target in infofiles.items():
+            content = target
             if store_history is True:
                 try:
-                    self._pull(source=infofile, dest=self.url.a_dir(path),
-                               no_dry_run=True, raise_error=False)
                     with open(os.path.join(temp_dir, infofile), 'r') as inf:
                         content = '{}\n{}'.format(target, inf.read())
                 except IOError:
-                    content = target
-                with open(os.path.join(temp_dir, infofile), 'w') as outf:
-                    outf.write(content)
+                    pass
+            path = os.path.dirname(os.path.join(temp_dir, infofile))
+            if not os.path.isdir(path):
+                os.makedirs(path)
+            with open(os.path.join(temp_dir, infofile), 'w') as outf:
+                outf.write(content)
             self._log.debug('Creating informaion file "{}"'.format(infofile))
 
-        opts = "-rl"
-        self._log.info('Creating symlink "{}" -> "{}"'.format(symlink, target))
-        return self.push(source=self.url.a_dir(path),
-                         dest=self.url.a_dir(remote_path),
-                         opts=opts)
+        for symlink, link_path, target in links:
+            path = os.path.dirname(os.path.join(temp_dir, link_path))
+            if not os.path.isdir(path):
+                os.makedirs(path)
+            os.symlink(target, os.path.join(temp_dir, link_path))
+            self._log.info('Creating symlink "{}" -> "{}"'
+                           ''.format(symlink, target))
+
+    def _symlinks_push_args(self, temp_dir):
+        # --keep-dirlinks prevents replacing of symlinked directories on
+        # remote by the directories from staging tree
+        return dict(source=self.url.a_dir(temp_dir), opts=['-rlK'])
+
+    def _symlinks_done(self, links, infofiles):
+        for symlink, link_path, target in links:
+            self._ls_cache_update(link_path, 'lrwxrwxrwx', target)
+        for infofile in infofiles:
+            self._ls_cache_update(infofile, '-rw-r--r--')
+
+    def _restore_symlinks(self, previous):
+        '''Restores symlinks state returned by symlinks()'''
+        existed, absent = self._restore_symlinks_split(previous)
+        if existed:
+            self.symlinks(existed)
+        if absent:
+            self.rm_all(absent)
+
+    @staticmethod
+    def _restore_symlinks_split(previous):
+        existed = [(_, target) for _, target in previous.items()
+                   if target is not None]
+        absent = [_ for _, target in previous.items() if target is None]
+        return existed, absent
+
+    def symlink(self, symlink, target,
+                create_target_file=True, store_history=True, update=True):
+        '''Creates symlink targeted to target'''
+        return self.symlinks([(symlink, target)],
+                             create_target_file=create_target_file,
+                             store_history=store_history,
+                             update=update)
@@ -19,7 +19,19 @@ import os
 
 from trsync.utils import utils as utils
 
+from trsync.objects.local_ops import ops_for_url
+from trsync.objects.local_snapshot import LocalSnapshot
 from trsync.objects.rsync_ops import RsyncOps
+from trsync.objects.rsync_url import RsyncUrl
+from trsync.utils.changes import ChangeRecords
+from trsync.utils.changes import ITEMIZE_OPTS
+from trsync.utils.changes import ItemizeParser
+from trsync.utils.shell import LogTail
+from trsync.utils.shell import Shell
+from trsync.utils.stats import STATS_OPTS
+from trsync.utils.stats import StatsParser
+from trsync.utils.steps import Result
+from trsync.utils.steps import run_steps
 from trsync.utils.tempfiles import TempFiles
 
 logging.basicConfig()
@@ -27,40 +39,226 @@ log = logging.getLogger(__name__)
 log.setLevel('DEBUG')
 
 
+class PushResult(str):
+    '''Output of push with its structured details
+
+    It is the output text (itemized lines rendered as rsync -v prints
+    them), so it may be used as before. changes is the list of
+    ChangeRecords (None if they are not kept), stats is bunch of rsync
+    --stats values (see StatsParser), timings is dict {phase: seconds},
+    attempts is the list of retry.Attempt of the transfer (empty for the
+    hardlink engine). batch is "write" or "read" if the transfer is
+    written to or read from rsync batch file (see TRsync.push_many).
+    snapshot is the path of the pushed snapshot relative the mirror url
+    (TRsync), relay is the url of the first tier mirror the snapshot is
+    pushed from (see fanout.Relay).
+    '''
+
+    def __new__(cls, output, changes=None, stats=None, timings=None,
+                attempts=None):
+        result = super(PushResult, cls).__new__(cls, output)
+        result.changes = changes
+        result.stats = utils.bunch() if stats is None else stats
+        result.timings = dict() if timings is None else timings
+        result.attempts = list(attempts or [])
+        result.batch = None
+        result.batch_signature = None
+        result.snapshot = None
+        result.relay = None
+        return result
+
+    @property
+    def output(self):
+        return str(self)
+
+    def metrics(self):
+        '''Returns JSON-serializable dict of stats, timings and attempts'''
+        metrics = dict(stats=dict(self.stats), timings=dict(self.timings))
+        if self.changes is not None:
+            metrics['changes'] = len(self.changes)
+        if self.attempts:
+            metrics['attempts'] = [_.to_dict() for _ in self.attempts]
+        if self.batch is not None:
+            metrics['batch'] = self.batch
+        if self.relay is not None:
+            metrics['relay'] = self.relay
+        return metrics
+
+
 class RsyncRemote(object):
+    push_opts = ['--archive', '--force', '--ignore-errors', '--delete'] + \
+        ITEMIZE_OPTS + STATS_OPTS
+    engines = ('rsync', 'hardlink')
+    link_dest_limit = LocalSnapshot.link_dest_limit
+
     def __init__(self,
                  rsync_url,
                  rsync_extra_params='',
                  init_directory_structure=True,
+                 ls_cache_ttl=None,
+                 ssh_command=None,
+                 ssh_multiplexing=True,
+                 engine='rsync',
+                 engine_workers=8,
+                 retry=None,
+                 io_timeout=None,
+                 connect_timeout=None,
+                 deadline=None,
+                 relay=None,
                  ):
+        '''Pushes to rsync_url
+
+        engine "hardlink" makes local to local pushes by LocalSnapshot
+        (engine_workers threads) instead of rsync. Pushes with other urls
+        or with rsync options except --link-dest (and --partial-dir) are
+        made by rsync anyway.
+
+        retry is RetryPolicy of rsync calls, io_timeout, connect_timeout
+        and deadline limit their durations (see RsyncOps).
+
+        If relay (fanout.SshRelay) is specified, the data is transferred by
+        rsync launched on its host over ssh, the sources are paths there.
+        Other rsync calls (diffs, symlinks, catalog) are made locally.
+        '''
         self._log = utils.logger.getChild('RsyncRemote.' + rsync_url)
+        if engine not in self.engines:
+            raise RuntimeError('Unknown push engine "{}", should be one of {}'
+                               ''.format(engine, self.engines))
+        self._engine = engine
+        self._engine_workers = engine_workers
+        self._relay = relay
         self._tmp = TempFiles()
         self._rsync_extra_params = rsync_extra_params
-        self.rsync = RsyncOps(
+        self.rsync = ops_for_url(
             rsync_url,
             rsync_extra_params=' '.join(['-v --no-owner --no-group',
-                                         rsync_extra_params])
+                                         rsync_extra_params]),
+            ls_cache=True,
+            ls_cache_ttl=ls_cache_ttl,
+            ssh_command=ssh_command,
+            ssh_multiplexing=ssh_multiplexing,
+            retry=retry,
+            io_timeout=io_timeout,
+            connect_timeout=connect_timeout,
+            deadline=deadline,
         )
         self.url = self.rsync.url
         if init_directory_structure is True:
             self._init_directory_structure()
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def close(self):
+        '''Stops ssh master connection (if any), removes temporary files'''
+        self.rsync.close()
+        self._tmp.close()
+
+    def _root_ops(self):
+        '''Returns RsyncOps for the root of url sharing ssh connection'''
+        return ops_for_url(self.url.root, self._rsync_extra_params,
+                           ssh_command=self.rsync._ssh_command,
+                           ssh_multiplexing=self.rsync.ssh_master is not None,
+                           ssh_master=self.rsync.ssh_master,
+                           retry=self.rsync.retry,
+                           io_timeout=self.rsync.io_timeout,
+                           connect_timeout=self.rsync.connect_timeout,
+                           deadline=self.rsync.deadline)
+
     def _init_directory_structure(self):
         dir_full_name = self.url.a_dir(self.url.path)
         if dir_full_name not in ['', '/']:
             if self.url.url_type != 'path':
-                rsync_root = RsyncOps(self.url.root, self._rsync_extra_params)
-                rsync_root.mk_dir(dir_full_name)
+                self._root_ops().mk_dir(dir_full_name)
             else:
                 if not os.path.isdir(dir_full_name):
                     os.makedirs(dir_full_name)
         return True
 
-    def push(self, source, repo_name='', extra=None):
-        '''Push source to destination'''
-        opts = '--archive --force --ignore-errors --delete'
+    def push(self, source, repo_name='', extra=None, consumers=None,
+             record_consumers=None, keep_changes=True):
+        '''Push source to destination, returns PushResult
+
+        Changes reported by rsync are parsed to ChangeRecords which are
+        passed to record_consumers and kept in the result if keep_changes
+        is True. If consumers are specified, rsync output is streamed to
+        them and only the tail of the output is returned (see Shell.shell).
+        rsync runs are recorded in result.attempts.
+        '''
+        return self._run(self._push_steps(source, repo_name, extra,
+                                          consumers, record_consumers,
+                                          keep_changes))
+
+    # runs generator of I/O steps (see trsync.utils.steps)
+    _run = staticmethod(run_steps)
+
+    def _push_steps(self, source, repo_name='', extra=None, consumers=None,
+                    record_consumers=None, keep_changes=True):
         self._log.info('Push "{}" to "{}"'.format(source, repo_name))
-        return self.rsync.push(source=source,
-                               dest=repo_name,
-                               opts=opts,
-                               extra=extra)
+        parts, consumers = self._result_consumers(
+            consumers, record_consumers, keep_changes)
+        snapshot = self._local_snapshot(source, repo_name, extra)
+        with utils.timed(parts.timings, 'transfer'):
+            self.rsync._ls_cache_invalidate(repo_name)
+            if snapshot is not None:
+                yield lambda: self._run_snapshot(snapshot, consumers)
+            else:
+                pushed = yield lambda: self.rsync._push(source=source,
+                                                        dest=repo_name,
+                                                        opts=self.push_opts,
+                                                        extra=extra,
+                                                        consumers=consumers,
+                                                        relay=self._relay)
+                parts.attempts = pushed.attempts
+        yield Result(self._push_result(parts))
+
+    @staticmethod
+    def _run_snapshot(snapshot, consumers):
+        snapshot.run(consumers)
+
+    def _local_snapshot(self, source, repo_name, extra):
+        '''Returns LocalSnapshot for the push or None if rsync is used'''
+        if self._engine != 'hardlink' or self._relay is not None:
+            return None
+        # partial files are not left by the engine, --partial-dir is noop
+        args = [_ for _ in RsyncOps._args(extra)
+                if not _.startswith('--partial-dir=')]
+        link_dests = [_.split('=', 1)[1] for _ in args
+                      if _.startswith('--link-dest=')]
+        if self.url.url_type != 'path' or \
+                len(link_dests) != len(args) or \
+                RsyncUrl(source).url_type != 'path' or \
+                len(link_dests) > self.link_dest_limit or \
+                self._rsync_extra_params.strip():
+            self._log.debug('Push "{}" by rsync: hardlink engine supports '
+                            'only local urls and --link-dest'.format(source))
+            return None
+        dest = self.url.urljoin(repo_name)
+        # relative --link-dest is relative the destination directory
+        link_dests = [os.path.normpath(os.path.join(dest, _))
+                      for _ in link_dests]
+        return LocalSnapshot(source, dest, link_dests,
+                             workers=self._engine_workers, logger=self._log)
+
+    @staticmethod
+    def _result_consumers(consumers, record_consumers, keep_changes):
+        '''Returns (parts of PushResult, consumers for rsync)'''
+        if consumers is None:
+            consumers = [LogTail(maxlen=None)]
+        parts = utils.bunch(stats=StatsParser(), changes=None,
+                            timings=dict(), attempts=list())
+        parts.tail, consumers = Shell._tail(consumers)
+        consumers.append(parts.stats)
+        record_consumers = list(record_consumers or [])
+        if keep_changes:
+            parts.changes = ChangeRecords()
+            record_consumers.append(parts.changes)
+        return parts, [ItemizeParser(consumers, record_consumers)]
+
+    @staticmethod
+    def _push_result(parts):
+        return PushResult(parts.tail.text, parts.changes, parts.stats.stats,
+                          parts.timings, parts.attempts)
@@ -14,8 +14,10 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import collections
 import os
 import re
+import threading
 
 from trsync.utils import utils as utils
 
@@ -23,7 +25,109 @@ from trsync.utils import utils as utils
 logger = utils.logger.getChild('RsyncUrl')
 
 
+def _squash_slashes(path):
+    '''Replaces "//" by "/" (but not in "://")
+
+    It is re.sub(r'([^:])//', r'\1/', re.sub(r'^//', r'/', path)) without
+    regular expressions.
+    '''
+    if path.startswith('//'):
+        path = path[1:]
+    result, start = list(), 0
+    index = path.find('//', 1)
+    while index != -1:
+        if path[index - 1] != ':':
+            result.append(path[start:index])
+            start = index + 1
+            index = path.find('//', start + 2)
+        else:
+            index = path.find('//', index + 1)
+    result.append(path[start:])
+    return ''.join(result)
+
+
 class RsyncUrl(object):
+    '''Parsed rsync url
+
+    RsyncUrl is immutable value: urls are equal and have the same hash if
+    their strings are equal. The patterns are compiled once, results of
+    parsing are kept in LRU cache of cache_size urls, so constructing of
+    RsyncUrl for the same strings again is cheap.
+    '''
+    __slots__ = ('_url', '_url_type', '_sep', '_match', '_parsed_url',
+                 '_rendered')
+
+    pattern_tpls = {
+        'protocol': r'((?P<protocol>^[^/:]+)://)',
+        'user': r'((?P<user>[^@/:]+)@)',
+        'host': r'(?P<host>[^@:/]+)',
+        'port': r'(:(?P<port>[^@:/]+))',
+        'module': r'((?P<module>[^@:/]+)/?)',
+        'path': r'(?P<path>[^@:]*$)',
+    }
+
+    patterns = {
+        # ssh: [USER@]HOST:SRC
+        'ssh': re.compile(
+            '^{user}?{host}:(?!//){path}?$'
+            ''.format(**pattern_tpls)
+        ),
+        # rsync: [USER@]HOST::SRC
+        'rsync1': re.compile(
+            '^{user}?{host}(::(?!/){module}?){path}?$'
+            ''.format(**pattern_tpls)
+        ),
+        # rsync://[USER@]HOST[:PORT]/SRC
+        'rsync2': re.compile(
+            '^{protocol}{user}?{host}{port}?(/{module})?{path}?$'
+            ''.format(**pattern_tpls)
+        ),
+        # local/path/to/directory
+        'path': re.compile(
+            '^{path}$'
+            ''.format(**pattern_tpls)
+        ),
+    }
+
+    templates = {
+        # ssh: [USER@]HOST:SRC
+        'ssh': ('{user}@', '{host}:', '{path}'),
+        # rsync: [USER@]HOST::SRC
+        'rsync1': ('{user}@', '{host}::', '{module}', '/{path}'),
+        # rsync://[USER@]HOST[:PORT]/SRC
+        'rsync2': ('{protocol}://', '{user}@', '{host}', ':{port}',
+                   '/{module}', '/{path}'),
+        # local/path/to/directory
+        'path': ('{path}/', ),
+    }
+
+    root_templates = {
+        # ssh: [USER@]HOST:SRC
+        'ssh': ('{user}@', '{host}:', '{rootpath}'),
+        # rsync: [USER@]HOST::SRC
+        'rsync1': ('{user}@', '{host}::', '{module}'),
+        # rsync://[USER@]HOST[:PORT]/SRC
+        'rsync2': ('{protocol}://', '{user}@', '{host}', ':{port}',
+                   '/{module}'),
+        # local/path/to/directory
+        'path': ('{rootpath}', ),
+    }
+
+    netloc_templates = {
+        # ssh: [USER@]HOST:SRC
+        'ssh': ('{user}@', '{host}:'),
+        # rsync: [USER@]HOST::SRC
+        'rsync1': ('{user}@', '{host}::', '{module}'),
+        # rsync://[USER@]HOST[:PORT]/SRC
+        'rsync2': ('{protocol}://', '{user}@', '{host}', ':{port}',
+                   '/{module}'),
+        # local/path/to/directory
+        'path': ('', ),
+    }
+
+    cache_size = 4096
+    _cache = collections.OrderedDict()
+    _cache_lock = threading.Lock()
 
     def __init__(self, remote_url):
 
@@ -32,124 +136,117 @@ class RsyncUrl(object):
             logger.error(msg)
             raise Exception(msg)
 
-        self._url = remote_url
-        self._url_type = False
-        self._sep = '/'
-
-        self.pattern_tpls = {
-            'protocol': r'((?P<protocol>^[^/:]+)://)',
-            'user': r'((?P<user>[^@/:]+)@)',
-            'host': r'(?P<host>[^@:/]+)',
-            'port': r'(:(?P<port>[^@:/]+))',
-            'module': r'((?P<module>[^@:/]+)/?)',
-            'path': r'(?P<path>[^@:]*$)',
-        }
-
-        self.patterns = {
-            # ssh: [USER@]HOST:SRC
-            'ssh': re.compile(
-                '^{user}?{host}:(?!//){path}?$'
-                ''.format(**self.pattern_tpls)
-            ),
-            # rsync: [USER@]HOST::SRC
-            'rsync1': re.compile(
-                '^{user}?{host}(::(?!/){module}?){path}?$'
-                ''.format(**self.pattern_tpls)
-            ),
-            # rsync://[USER@]HOST[:PORT]/SRC
-            'rsync2': re.compile(
-                '^{protocol}{user}?{host}{port}?(/{module})?{path}?$'
-                ''.format(**self.pattern_tpls)
-            ),
-            # local/path/to/directory
-            'path': re.compile(
-                '^{path}$'
-                ''.format(**self.pattern_tpls)
-            ),
-        }
-
-        self.templates = {
-            # ssh: [USER@]HOST:SRC
-            'ssh': ('{user}@', '{host}:', '{path}'),
-            # rsync: [USER@]HOST::SRC
-            'rsync1': ('{user}@', '{host}::', '{module}', '/{path}'),
-            # rsync://[USER@]HOST[:PORT]/SRC
-            'rsync2': ('{protocol}://', '{user}@', '{host}', ':{port}',
-                       '/{module}', '/{path}'),
-            # local/path/to/directory
-            'path': ('{path}/', ),
-        }
-
-        self._match = self._get_matching_pattern()
-        if self.match is None:
-            self._parsed_url = utils.bunch()
-            self._parsed_url.protocol = None,
-            self._parsed_url.user = None,
-            self._parsed_url.host = None,
-            self._parsed_url.port = None,
-            self._parsed_url.module = None,
-            self._parsed_url.path = None,
-        else:
-            self._parse_rsync_url(self.match)
+        url_type, sep, match, parsed_url, rendered = \
+            self._parse(remote_url)
+        set_attr = super(RsyncUrl, self).__setattr__
+        set_attr('_url', remote_url)
+        set_attr('_url_type', url_type)
+        set_attr('_sep', sep)
+        set_attr('_match', match)
+        set_attr('_parsed_url', parsed_url)
+        # {template: rendered string}, shared by RsyncUrls of the same url
+        set_attr('_rendered', rendered)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('RsyncUrl is immutable')
+
+    def __eq__(self, other):
+        return isinstance(other, RsyncUrl) and self._url == other._url
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self._url)
 
-    def _get_matching_pattern(self):
-        patterns = self._get_all_matching_patterns()
-        patterns_len = len(patterns)
-        if patterns_len != 1:
+    def __repr__(self):
+        return 'RsyncUrl({!r})'.format(self._url)
+
+    def __getstate__(self):
+        return self._url
+
+    def __setstate__(self, state):
+        self.__init__(state)
+
+    @classmethod
+    def _parse(cls, remote_url):
+        '''Returns (url_type, sep, match, parsed url, {}) using the cache'''
+        with cls._cache_lock:
+            parsed = cls._cache.pop(remote_url, None)
+            if parsed is not None:
+                cls._cache[remote_url] = parsed
+                return parsed
+        parsed = cls._parse_rsync_url(remote_url)
+        with cls._cache_lock:
+            cls._cache[remote_url] = parsed
+            while len(cls._cache) > cls.cache_size:
+                cls._cache.popitem(last=False)
+        return parsed
+
+    @classmethod
+    def _matching_patterns(cls, remote_url):
+        '''Returns [(url_type, pattern)] matching with remote_url'''
+        return [(url_type, pattern)
+                for url_type, pattern in cls.patterns.items()
+                if pattern.match(remote_url) is not None]
+
+    def _get_all_matching_patterns(self):
+        return [_[1] for _ in self._matching_patterns(self.url)]
+
+    @classmethod
+    def _parse_rsync_url(cls, remote_url):
+        patterns = cls._matching_patterns(remote_url)
+        if len(patterns) != 1:
             logger.warn('Rsync location "{}" matches with {} patterns: {}.'
                         'Please file a bug on {} if it is wrong.'
-                        ''.format(self.url,
+                        ''.format(remote_url,
                                   len(patterns),
-                                  [str(_.pattern) for _ in patterns],
+                                  [str(_[1].pattern) for _ in patterns],
                                   '...'))
-        if patterns_len == 0:
-            self._url_type = None
-            return None
-        else:
-            return patterns[0]
+        sep = '/'
+        if not patterns:
+            parsed_url = utils.bunch()
+            parsed_url.protocol = None,
+            parsed_url.user = None,
+            parsed_url.host = None,
+            parsed_url.port = None,
+            parsed_url.module = None,
+            parsed_url.path = None,
+            return None, sep, None, parsed_url, dict()
 
-    def _get_all_matching_patterns(self):
-        patterns = list()
-        for url_type, pattern in self.patterns.items():
-            match = pattern.match(self.url)
-            if match is not None:
-                if self.url_type is False:
-                    self._url_type = url_type
-                patterns.append(pattern)
-        return patterns
-
-    def _parse_rsync_url(self, pattern):
         # parse remote url
+        url_type, pattern = patterns[0]
+        parsed_url = utils.bunch(pattern.match(remote_url).groupdict())
 
-        match = pattern.match(self._url)
-        self._parsed_url = utils.bunch(match.groupdict())
+        if url_type == 'ssh':
+            if parsed_url.path == '':
+                parsed_url.path = '~'
 
-        if self.url_type == 'ssh':
-            if self._parsed_url.path == '':
-                self._parsed_url.path = '~'
-
-            if self.path.startswith('/'):
-                self._parsed_url.rootpath = '/'
+            if parsed_url.path.startswith('/'):
+                parsed_url.rootpath = '/'
             else:
-                self._parsed_url.rootpath = '~/'
+                parsed_url.rootpath = '~/'
 
-        elif self.url_type.startswith('rsync'):
-            if self._parsed_url.module:
-                if self._parsed_url.path == '':
-                    self._parsed_url.path = '/'
-                self._parsed_url.rootpath = '/'
+        elif url_type.startswith('rsync'):
+            if parsed_url.module:
+                if parsed_url.path == '':
+                    parsed_url.path = '/'
+                parsed_url.rootpath = '/'
             else:
-                self._parsed_url.path = None
+                parsed_url.path = None
 
-            if self.url_type == 'rsync2':
-                if self.protocol != 'rsync':
-                    msg = 'Wrong URL protocol == "{}"'.format(self.protocol)
+            if url_type == 'rsync2':
+                if parsed_url.protocol != 'rsync':
+                    msg = 'Wrong URL protocol == "{}"'\
+                          ''.format(parsed_url.protocol)
                     logger.error(msg)
                     raise Exception(msg)
 
-        elif self.url_type == 'path':
-            self._sep = os.path.sep
-            self._parsed_url.rootpath = self.a_dir(self.path)
+        elif url_type == 'path':
+            sep = os.path.sep
+            parsed_url.rootpath = cls._a_dir(sep, parsed_url.path)
+
+        return url_type, sep, pattern, parsed_url, dict()
 
     @property
     def match(self):
@@ -193,35 +290,11 @@ class RsyncUrl(object):
 
     @property
     def root(self):
-
-        templates = {
-            # ssh: [USER@]HOST:SRC
-            'ssh': ('{user}@', '{host}:', '{rootpath}'),
-            # rsync: [USER@]HOST::SRC
-            'rsync1': ('{user}@', '{host}::', '{module}'),
-            # rsync://[USER@]HOST[:PORT]/SRC
-            'rsync2': ('{protocol}://', '{user}@', '{host}', ':{port}',
-                       '/{module}'),
-            # local/path/to/directory
-            'path': ('{rootpath}', ),
-        }
-        return self._by_template(templates[self.url_type])
+        return self._by_template(self.root_templates[self.url_type])
 
     @property
     def netloc(self):
-
-        templates = {
-            # ssh: [USER@]HOST:SRC
-            'ssh': ('{user}@', '{host}:'),
-            # rsync: [USER@]HOST::SRC
-            'rsync1': ('{user}@', '{host}::', '{module}'),
-            # rsync://[USER@]HOST[:PORT]/SRC
-            'rsync2': ('{protocol}://', '{user}@', '{host}', ':{port}',
-                       '/{module}'),
-            # local/path/to/directory
-            'path': ('', ),
-        }
-        return self._by_template(templates[self.url_type])
+        return self._by_template(self.netloc_templates[self.url_type])
 
     @property
     def parsed_url(self):
@@ -238,6 +311,13 @@ class RsyncUrl(object):
         return parsed_dict
 
     def _by_template(self, template_list):
+        result = self._rendered.get(template_list)
+        if result is None:
+            result = self._rendered[template_list] = \
+                self._render(template_list)
+        return result
+
+    def _render(self, template_list):
         template = ''
         for part in ('protocol', 'user', 'host', 'port', 'module', 'path',
                      'rootpath'):
@@ -261,35 +341,31 @@ class RsyncUrl(object):
                 return False
         return True
 
-    def _fn_join(self, *parts):
+    @staticmethod
+    def _join(sep, *parts):
         '''Joins filenames with ignoring empty parts (None, '', etc)'''
 
         parts = [_ for _ in parts if _]
-
-        if len(parts) > 0:
-            if parts[-1].endswith(self.sep):
-                isdir = True
-            else:
-                isdir = False
-            first, parts = parts[0], parts[1:]
-        else:
+        if not parts:
             return ''
+        isdir = parts[-1].endswith(sep)
 
-        if first is None:
-            first = ''
+        first = parts[0]
         if len(first) > 1:
-            while first.endswith(self.sep):
-                first = first[:-1]
+            first = first.rstrip(sep)
 
-        subs = self.sep.join([_ for _ in parts if _]).split(self.sep)
-        subs = [_ for _ in subs if _]
+        subs = [_ for _ in sep.join(parts[1:]).split(sep) if _]
 
-        result = re.sub(r'^//', r'/', self.sep.join([first, ] + subs))
-        result = re.sub(r'([^:])//', r'\1/', result)
-        if not result.endswith(self.sep) and isdir:
-            result += self.sep
+        result = sep.join([first, ] + subs)
+        if '//' in result:
+            result = _squash_slashes(result)
+        if not result.endswith(sep) and isdir:
+            result += sep
         return result
 
+    def _fn_join(self, *parts):
+        return self._join(self.sep, *parts)
+
     def join(self, *parts):
         return self._fn_join(*parts)
 
@@ -297,12 +373,16 @@ class RsyncUrl(object):
         return self.join(self._by_template(self.templates[self.url_type]),
                          *parts)
 
-    def a_dir(self, *path):
-        result = self._fn_join(*path)
+    @classmethod
+    def _a_dir(cls, sep, *path):
+        result = cls._join(sep, *path)
         if not result.endswith('/'):
             result += '/'
         return result
 
+    def a_dir(self, *path):
+        return self._a_dir(self.sep, *path)
+
     def url_dir(self, *path):
         return self.a_dir(self._by_template(self.templates[self.url_type]),
                           *path)
@@ -310,28 +390,23 @@ class RsyncUrl(object):
     def a_file(self, *path):
         result = self._fn_join(*path)
         if len(result) > 1:
-            while result.endswith(self.sep):
-                result = result[:-1]
+            result = result.rstrip(self.sep)
         return result
 
     def url_file(self, *path):
         return self.a_file(self._by_template(self.templates[self.url_type]),
                            *path)
 
-    def _split_path(self, path):
+    @staticmethod
+    def _split_path(path):
         '''Returns list of path's parts, starting from '/' for absolute path'''
-        result = list()
         if path != '/':
-            while path.endswith('/'):
-                path = path[:-1]
-        while True:
-            path, second = os.path.split(path)
-            if second:
-                result.insert(0, second)
-            else:
-                if path:
-                    result.insert(0, path)
-                break
+            path = path.rstrip('/')
+        if not path:
+            return list()
+        result = [_ for _ in path.split('/') if _]
+        if path.startswith('/'):
+            result.insert(0, path[:len(path) - len(path.lstrip('/'))])
         return result
 
     def path_relative(self, path, relative=None):
@@ -352,11 +427,11 @@ class RsyncUrl(object):
         else:
             # path relative
             common_index = 0
-            for i in xrange(min(len(path_dir), len(relative_dir))):
+            for i in range(min(len(path_dir), len(relative_dir))):
                 if path_dir[i] == relative_dir[i]:
                     common_index += 1
                 else:
                     break
             updir_number = len(relative_dir[common_index:][:])
-            return '/'.join(['..' for _ in xrange(updir_number)] +
+            return '/'.join(['..' for _ in range(updir_number)] +
                             path_dir[common_index:])
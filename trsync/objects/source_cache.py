@@ -0,0 +1,267 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015-2016, Mirantis, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import fcntl
+import hashlib
+import os
+import re
+import shutil
+import stat
+import tempfile
+import time
+
+from trsync.utils import utils as utils
+
+from trsync.objects.local_ops import ops_for_url
+from trsync.objects.rsync_url import RsyncUrl
+
+
+GENERATION_FORMAT = '%Y-%m-%d-%H%M%S'
+
+
+class SourceCache(object):
+    '''Persistent local copies of remote push sources
+
+    Every remote source is pulled to its own directory under cache_dir
+    as a new generation (directory named by UTC time of the pull). The
+    pull is made with --link-dest to the previous generation, so only the
+    changes are transferred and unchanged files are hardlinked between the
+    generations. "latest" symlink of the source directory points to the
+    newest complete generation, keep newest generations of every source
+    are kept. Local sources are used in place.
+
+    If max_size (bytes) is specified, evict() removes the oldest
+    generations until the cache fits it: previous generations of all the
+    sources first, then whole sources not staged by this object, the least
+    recently pulled first. The generations staged by this object are never
+    evicted. The cache is locked from the first stage() until close(), so
+    concurrent processes sharing cache_dir wait for each other.
+
+    kwargs are passed to RsyncOps of the sources.
+    '''
+    latest_name = 'latest'
+    incoming_prefix = '.incoming-'
+    lock_name = '.lock'
+    stage_opts = ['--archive', '--delete']
+
+    def __init__(self, cache_dir, max_size=None, keep=2, **kwargs):
+        if keep < 1:
+            raise ValueError('At least one generation should be kept, got {}'
+                             ''.format(keep))
+        self._log = utils.logger.getChild('SourceCache.' + cache_dir)
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.max_size = max_size
+        self.keep = keep
+        self._ops_kwargs = kwargs
+        self._staged = dict()
+        self._lock_file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def close(self):
+        '''Releases the lock of the cache'''
+        if self._lock_file is not None:
+            self._lock_file.close()
+            self._lock_file = None
+
+    def _lock(self):
+        if self._lock_file is not None:
+            return
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        self._lock_file = open(os.path.join(self.cache_dir, self.lock_name),
+                               'a')
+        try:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            self._log.info('Waiting for the lock of the cache')
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+
+    def sources(self, sources):
+        '''Returns [(source, repo_name)] with staged sources, evicts once'''
+        sources = [(self.stage(source), repo_name)
+                   for source, repo_name in sources]
+        self.evict()
+        return sources
+
+    def stage(self, source):
+        '''Returns local directory with the copy of source
+
+        Remote source is pulled to new generation once per object, local
+        source is returned as is.
+        '''
+        if RsyncUrl(source).url_type == 'path':
+            return source
+        if source not in self._staged:
+            self._lock()
+            self._staged[source] = self._pull(source)
+        return self._staged[source]
+
+    def source_dir(self, source):
+        '''Returns directory of generations of source'''
+        name = re.sub(r'[^\w.-]+', '_', source).strip('_.')[:64]
+        digest = hashlib.sha1(source.encode('utf-8')).hexdigest()[:8]
+        return os.path.join(self.cache_dir, '{}-{}'.format(name, digest))
+
+    def generations(self, source_dir):
+        '''Returns complete generations of source_dir, the oldest first'''
+        if not os.path.isdir(source_dir):
+            return list()
+        return sorted([
+            _ for _ in os.listdir(source_dir)
+            if not _.startswith('.') and _ != self.latest_name and
+            os.path.isdir(os.path.join(source_dir, _))])
+
+    def _pull(self, source):
+        source_dir = self.source_dir(source)
+        if not os.path.isdir(source_dir):
+            os.makedirs(source_dir)
+        self._remove_incoming(source_dir)
+        previous = self.generations(source_dir)
+        incoming = tempfile.mkdtemp(prefix=self.incoming_prefix,
+                                    dir=source_dir)
+        opts = list(self.stage_opts)
+        if previous:
+            opts.append('--link-dest={}'.format(
+                os.path.join(source_dir, previous[-1])))
+        self._log.info('Pull "{}" to "{}"'.format(source, incoming))
+        try:
+            with ops_for_url(source, **self._ops_kwargs) as ops:
+                ops._pull(source='/', dest=incoming + '/', opts=opts,
+                          no_dry_run=True, raise_error=True)
+            generation = self._new_generation(source_dir)
+            os.rename(incoming, os.path.join(source_dir, generation))
+        except Exception:
+            shutil.rmtree(incoming, ignore_errors=True)
+            raise
+        self._switch_latest(source_dir, generation)
+        for name in self.generations(source_dir)[:-self.keep]:
+            self._log.info('Remove old generation "{}" of "{}"'
+                           ''.format(name, source))
+            shutil.rmtree(os.path.join(source_dir, name))
+        return os.path.join(source_dir, generation)
+
+    def _remove_incoming(self, source_dir):
+        '''Removes generations left by failed pulls'''
+        for name in os.listdir(source_dir):
+            if name.startswith(self.incoming_prefix):
+                shutil.rmtree(os.path.join(source_dir, name),
+                              ignore_errors=True)
+
+    @staticmethod
+    def _new_generation(source_dir):
+        name = time.strftime(GENERATION_FORMAT, time.gmtime())
+        generation, index = name, 0
+        while os.path.lexists(os.path.join(source_dir, generation)):
+            index += 1
+            generation = '{}.{}'.format(name, index)
+        return generation
+
+    def _switch_latest(self, source_dir, generation):
+        latest = os.path.join(source_dir, self.latest_name)
+        temp = os.path.join(source_dir, '.{}.new'.format(self.latest_name))
+        if os.path.lexists(temp):
+            os.remove(temp)
+        os.symlink(generation, temp)
+        os.rename(temp, latest)
+
+    def _source_generations(self):
+        '''Returns [(source dir, paths of its generations)]'''
+        if not os.path.isdir(self.cache_dir):
+            return list()
+        result = list()
+        for name in sorted(os.listdir(self.cache_dir)):
+            source_dir = os.path.join(self.cache_dir, name)
+            if name.startswith('.') or not os.path.isdir(source_dir):
+                continue
+            generations = [os.path.join(source_dir, _)
+                           for _ in self.generations(source_dir)]
+            if generations:
+                result.append((source_dir, generations))
+        return result
+
+    def _candidates(self, source_generations):
+        '''Returns [(path to remove, its generations)] in eviction order'''
+        staged = set(self._staged.values())
+        older, sources = list(), list()
+        for source_dir, generations in source_generations:
+            older.extend([(os.path.basename(_), _, [_])
+                          for _ in generations[:-1] if _ not in staged])
+            if not staged.intersection(generations):
+                sources.append((os.path.basename(generations[-1]),
+                                source_dir, generations))
+        return [_[1:] for _ in sorted(older)] + \
+            [_[1:] for _ in sorted(sources)]
+
+    @staticmethod
+    def _usage(generations):
+        '''Returns ({inode: [size, generations linking it]}, total size)'''
+        usage = dict()
+        for generation in generations:
+            for dirpath, dirnames, filenames in os.walk(generation):
+                for name in filenames:
+                    try:
+                        st = os.lstat(os.path.join(dirpath, name))
+                    except OSError:
+                        continue
+                    if not stat.S_ISREG(st.st_mode):
+                        continue
+                    entry = usage.setdefault((st.st_dev, st.st_ino),
+                                             [st.st_size, set()])
+                    entry[1].add(generation)
+        return usage, sum([_[0] for _ in usage.values()])
+
+    def size(self):
+        '''Returns size (bytes) of the files of the cache'''
+        return self._usage(sum([_[1] for _ in self._source_generations()],
+                               []))[1]
+
+    def evict(self):
+        '''Removes the oldest generations until the cache fits max_size
+
+        Returns the list of removed paths.
+        '''
+        if self.max_size is None:
+            return list()
+        source_generations = self._source_generations()
+        candidates = self._candidates(source_generations)
+        usage, total = self._usage(sum([_[1] for _ in source_generations],
+                                       []))
+        linked = dict()
+        for key, (size, generations) in usage.items():
+            for generation in generations:
+                linked.setdefault(generation, list()).append(key)
+        removed = list()
+        for path, generations in candidates:
+            if total <= self.max_size:
+                break
+            self._log.info('Evict "{}" from the cache'.format(path))
+            shutil.rmtree(path, ignore_errors=True)
+            removed.append(path)
+            for generation in generations:
+                for key in linked.get(generation, []):
+                    usage[key][1].discard(generation)
+                    if not usage[key][1]:
+                        total -= usage[key][0]
+        if total > self.max_size:
+            self._log.warn('Cache size {} bytes exceeds the limit {} bytes '
+                           'by the sources in use'.format(total,
+                                                          self.max_size))
+        return removed
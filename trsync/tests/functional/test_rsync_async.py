@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015-2016, Mirantis, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import logging
+import os
+import sys
+import unittest
+
+from trsync.tests.functional import rsync_base
+from trsync.utils.tempfiles import TempFiles
+
+
+logging.basicConfig()
+log = logging.getLogger(__name__)
+log.setLevel(logging.INFO)
+
+
+@unittest.skipIf(sys.version_info < (3, 5), 'asyncio is required')
+class TestRsyncAsync(rsync_base.TestRsyncBase):
+
+    """Test case class for rsync_async module"""
+
+    def run_async(self, coroutine):
+        import asyncio
+        return asyncio.get_event_loop().run_until_complete(coroutine)
+
+    def test_shell_stream(self):
+        from trsync.utils.shell import LogTail
+        from trsync.utils.shell_async import AsyncShell
+        tail = LogTail(maxlen=2)
+        exitcode, out, err = self.run_async(AsyncShell().shell(
+            'seq 1 5000; echo error >&2', consumers=[tail]))
+        self.assertEqual((exitcode, out, err), (0, '4999\n5000\n', 'error\n'))
+        self.assertEqual(tail.lines_number, 5000)
+        exitcode, out, err = self.run_async(AsyncShell().shell(
+            ['cat'], stdin='input', raise_error=False))
+        self.assertEqual((exitcode, out), (0, 'input'))
+
+    def test_ls_symlinks(self):
+        from trsync.objects.rsync_async import AsyncRsyncOps
+        for remote in self.rsyncd[self.testname]:
+            os.makedirs(os.path.join(remote.path, 'dir1'))
+            os.symlink('dir1', os.path.join(remote.path, 'link1'))
+            ops = AsyncRsyncOps(remote.url, ls_cache=True)
+            self.assertEqual(self.run_async(ops.ls_dirs()), ['dir1'])
+            self.assertEqual(self.run_async(ops.ls_symlinks()),
+                             [['link1', 'dir1']])
+            self.assertEqual(self.run_async(ops.symlink_target('link1')),
+                             'dir1')
+
+    def test_push(self):
+        import asyncio
+        from trsync.objects.rsync_async import AsyncTRsync
+        temp_dir = TempFiles()
+        src_dir = temp_dir.last_temp_dir
+        self.getDataFile(os.path.join(src_dir, 'dir1/dir2/test_data.txt'))
+        remotes = self.rsyncd[self.testname]
+        mirrors = [AsyncTRsync(_.url) for _ in remotes]
+        outs = self.run_async(asyncio.gather(
+            *[_.push(os.path.join(src_dir, 'dir1'), 'dir1') for _ in mirrors]
+        ))
+        for remote, mirror, out in zip(remotes, mirrors, outs):
+            snapshot_path = remote.path + '/snapshots/dir1-{}'\
+                ''.format(mirror.timestamp.snapshot_stamp)
+            latest_path = remote.path + '/snapshots/dir1-latest'
+            self.assertDirsEqual(snapshot_path, src_dir + '/dir1')
+            self.assertEqual(snapshot_path, os.path.realpath(latest_path))
+            with open(snapshot_path + '.diff.txt') as diff_file:
+                self.assertEqual(out, diff_file.read())
@@ -19,8 +19,11 @@ import os
 
 from time import sleep
 
+from trsync.objects.fanout import Relay
 from trsync.objects.rsync_mirror import TRsync
+from trsync.objects.source_cache import SourceCache
 from trsync.tests.functional import rsync_base
+from trsync.utils.changes import read_changes
 from trsync.utils.tempfiles import TempFiles
 
 
@@ -62,6 +65,15 @@ class TestRsyncMirror(rsync_base.TestRsyncBase):
             self.assertEqual(snapshot1_path, os.path.realpath(latest_path))
             with open(snapshot1_path + '.diff.txt') as diff_file:
                 self.assertEqual(out, diff_file.read())
+            self.assertIn(('dir2/dir3/test_data.txt', 'created', 'file'),
+                          [(_.path, _.change, _.kind) for _ in out.changes])
+            self.assertEqual(
+                out.changes,
+                list(read_changes(snapshot1_path + '.changes.jsonl.gz')))
+            self.assertEqual(out.stats.files_transferred, 1)
+            self.assertSetEqual(set(out.timings),
+                                set(['transfer', 'diff', 'symlinks', 'catalog',
+                                     'prune']))
             with open(latest_path + '.target.txt') as target_file:
                 self.assertEqual(
                     ['dir1-' + timestamp1],
@@ -123,3 +135,96 @@ class TestRsyncMirror(rsync_base.TestRsyncBase):
             # previous operation or fail (optional)
             # CLI parameters: --raise-if-locked, --wait-if-locked,
             # --ignore-locking
+
+    def test_push_hardlink_engine(self):
+        for remote in self.rsyncd[self.testname]:
+            if remote.url != remote.path:
+                # the engine is used for local destinations only
+                continue
+            temp_dir = TempFiles()
+            src_dir = temp_dir.last_temp_dir
+            self.getDataFile(os.path.join(src_dir, 'dir1/dir2/same.txt'))
+            self.getDataFile(os.path.join(src_dir, 'dir1/changed.txt'))
+
+            rsync = TRsync(remote.url, engine='hardlink')
+            out = rsync.push(os.path.join(src_dir, 'dir1'), 'dir1')
+            snapshot1_path = remote.path + '/snapshots/dir1-{}'\
+                ''.format(rsync.timestamp.snapshot_stamp)
+            self.assertDirsEqual(snapshot1_path, src_dir + '/dir1')
+            self.assertIn(('dir2/same.txt', 'created', 'file'),
+                          [(_.path, _.change, _.kind) for _ in out.changes])
+            self.assertEqual(out.stats.files_transferred, 2)
+
+            sleep(1)
+            self.getDataFile(os.path.join(src_dir, 'dir1/changed.txt'))
+            rsync = TRsync(remote.url, engine='hardlink')
+            out = rsync.push(os.path.join(src_dir, 'dir1'), 'dir1')
+            snapshot2_path = remote.path + '/snapshots/dir1-{}'\
+                ''.format(rsync.timestamp.snapshot_stamp)
+            self.assertDirsEqual(snapshot2_path, src_dir + '/dir1')
+            self.assertEqual(
+                os.stat(os.path.join(snapshot1_path, 'dir2/same.txt')).st_ino,
+                os.stat(os.path.join(snapshot2_path, 'dir2/same.txt')).st_ino)
+            self.assertEqual(
+                [(_.path, _.change) for _ in out.changes
+                 if _.kind == 'file'],
+                [('changed.txt', 'updated')])
+            with open(snapshot2_path + '.diff.txt') as diff_file:
+                self.assertEqual(out, diff_file.read())
+
+    def test_push_relay(self):
+        for remote in self.rsyncd[self.testname]:
+            # second tier is another daemon of the same kind
+            tier2 = type(remote)(self.testname + '-tier2')
+            self.addCleanup(tier2.stop)
+            temp_dir = TempFiles()
+            src_dir = temp_dir.last_temp_dir
+            self.getDataFile(os.path.join(src_dir, 'dir1/dir2/test_data.txt'))
+
+            rsync = TRsync(remote.url)
+            results = rsync.push_many([(os.path.join(src_dir, 'dir1'),
+                                        'dir1')])
+            snapshot = results['dir1'].snapshot
+            with Relay(remote.url, results) as relay:
+                sources = relay.sources([(None, 'dir1')])
+                out = TRsync(tier2.url, timestamp=str(rsync.timestamp)
+                             ).push(sources[0][0], 'dir1')
+            self.assertEqual(out.stats.files_transferred, 1)
+            self.assertDirsEqual(os.path.join(tier2.path, snapshot),
+                                 src_dir + '/dir1')
+            self.assertEqual(
+                os.path.realpath(tier2.path + '/snapshots/dir1-latest'),
+                os.path.join(tier2.path, snapshot))
+
+    def test_source_cache(self):
+        for remote in self.rsyncd[self.testname]:
+            temp_dir = TempFiles()
+            cache_dir = os.path.join(temp_dir.last_temp_dir, 'cache')
+            self.getDataFile(os.path.join(remote.path, 'src/same.txt'))
+            self.getDataFile(os.path.join(remote.path, 'src/changed.txt'))
+            source = remote.url + '/src'
+
+            with SourceCache(cache_dir) as cache:
+                first = cache.stage(source)
+            self.assertDirsEqual(first, remote.path + '/src')
+            sleep(1)
+            with open(os.path.join(remote.path, 'src/changed.txt'),
+                      'w') as outfile:
+                outfile.write('CHANGED')
+            with SourceCache(cache_dir, keep=2) as cache:
+                sources = cache.sources([(source, 'src')])
+            second = sources[0][0]
+            self.assertNotEqual(first, second)
+            self.assertDirsEqual(second, remote.path + '/src')
+            # unchanged files are hardlinked between the generations
+            self.assertEqual(
+                os.stat(os.path.join(first, 'same.txt')).st_ino,
+                os.stat(os.path.join(second, 'same.txt')).st_ino)
+            self.assertEqual(
+                os.path.realpath(os.path.join(os.path.dirname(second),
+                                              'latest')),
+                second)
+
+            out = TRsync(remote.url).push(second, 'dir1')
+            self.assertEqual(out.stats.files_transferred, 2)
+            temp_dir.close()
@@ -17,6 +17,8 @@
 import logging
 import os
 
+from time import sleep
+
 from trsync.objects.rsync_ops import RsyncOps
 from trsync.tests.functional import rsync_base
 from trsync.utils.tempfiles import TempFiles
@@ -79,6 +81,23 @@ class TestRsyncOps(rsync_base.TestRsyncBase):
             # compare the directories
             self.assertDirsEqual(remote.path, temp_dir.last_temp_dir)
 
+    def test_push_names_with_spaces(self):
+        for remote in self.rsyncd[self.testname]:
+            # create some data on temp dir
+            temp_dir = TempFiles()
+            self.getDataFile(os.path.join(temp_dir.last_temp_dir,
+                             "dir 1/it's file.txt"))
+            # push it to the rsync remote
+            ops = RsyncOps(remote.url)
+            ops.push(os.path.join(temp_dir.last_temp_dir, 'dir 1'),
+                     opts=['-r'])
+            self.assertDirsEqual(remote.path, temp_dir.last_temp_dir)
+            self.assertListEqual(ops.ls('dir 1/'), ["it's file.txt"])
+            ops.symlink('link 1', 'dir 1')
+            self.assertEqual(ops.symlink_target('link 1'), 'dir 1')
+            ops.rm_all(['dir 1', 'link 1', 'link 1.target.txt'])
+            self.assertListEqual(ops.ls(), [])
+
     def test_ls(self):
         for remote in self.rsyncd[self.testname]:
             ops = RsyncOps(remote.url)
@@ -200,6 +219,25 @@ class TestRsyncOps(rsync_base.TestRsyncBase):
             self.assertEqual(ops.symlink_target('snapshots/symlink5'),
                              '../snapshots2/dir3')
 
+    def test_resolve_many(self):
+        for remote in self.rsyncd[self.testname]:
+            ops = RsyncOps(remote.url)
+            os.makedirs(os.path.join(remote.path, 'snapshots/dir1'))
+            os.symlink('dir1', os.path.join(remote.path, 'snapshots/latest'))
+            os.symlink('snapshots/latest', os.path.join(remote.path, 'rel'))
+            os.symlink('rel', os.path.join(remote.path, 'stable'))
+            os.symlink('loop2', os.path.join(remote.path, 'loop1'))
+            os.symlink('loop1', os.path.join(remote.path, 'loop2'))
+            self.assertDictEqual(
+                ops.resolve_many(['stable', 'rel', 'snapshots/latest']),
+                {'stable': 'snapshots/dir1',
+                 'rel': 'snapshots/dir1',
+                 'snapshots/latest': 'dir1'})
+            self.assertDictEqual(
+                ops.resolve_many(['stable'], recursive=False),
+                {'stable': 'rel'})
+            self.assertRaises(RuntimeError, ops.symlink_target, 'loop1')
+
     def test_rm_file(self):
         for remote in self.rsyncd[self.testname]:
             ops = RsyncOps(remote.url)
@@ -234,6 +272,21 @@ class TestRsyncOps(rsync_base.TestRsyncBase):
             ops.rm_all(['file1.txt', 'dir1', 'symlink1'])
             self.assertSetEqual(set(ops.ls()), set(['dir2']))
 
+    def test_rm_all_many_dirs(self):
+        for remote in self.rsyncd[self.testname]:
+            ops = RsyncOps(remote.url)
+            # create some data on rsync remote
+            self.getDataFile(os.path.join(remote.path, 'dir1/file1.txt'))
+            self.getDataFile(os.path.join(remote.path, 'dir1/file2.txt'))
+            self.getDataFile(os.path.join(remote.path, 'dir2/dir3/file1.txt'))
+            self.getDataFile(os.path.join(remote.path, 'dir4/file1.txt'))
+            names = ['dir1/file1.txt', 'dir2/dir3', 'dir4', 'absent.txt']
+            report = ops.rm_all(names)
+            self.assertDictEqual(report, dict([(_, True) for _ in names]))
+            self.assertSetEqual(set(ops.ls()), set(['dir1', 'dir2']))
+            self.assertSetEqual(set(ops.ls('dir1/')), set(['file2.txt']))
+            self.assertSetEqual(set(ops.ls('dir2/')), set([]))
+
     def test_clean_dir(self):
         for remote in self.rsyncd[self.testname]:
             ops = RsyncOps(remote.url)
@@ -319,3 +372,102 @@ class TestRsyncOps(rsync_base.TestRsyncBase):
             # update symlink with absent target
             self.assertRaises(RuntimeError,
                               ops.symlink, 'snapshots/symlink1', 'dir3')
+
+    def test_symlinks(self):
+        for remote in self.rsyncd[self.testname]:
+            ops = RsyncOps(remote.url)
+            os.makedirs(os.path.join(remote.path, 'snapshots/dir1'))
+            os.makedirs(os.path.join(remote.path, 'snapshots/dir2'))
+            os.symlink('dir1', os.path.join(remote.path, 'snapshots/link1'))
+            previous = ops.symlinks([('snapshots/link1', 'dir2'),
+                                     ('snapshots/link2', 'dir2'),
+                                     ('link3', 'snapshots/dir1')])
+            self.assertDictEqual(previous, {'snapshots/link1': 'dir1',
+                                            'snapshots/link2': None,
+                                            'link3': None})
+            self.assertEqual(ops.symlink_target('snapshots/link1'), 'dir2')
+            self.assertEqual(ops.symlink_target('snapshots/link2'), 'dir2')
+            self.assertEqual(ops.symlink_target('link3'), 'snapshots/dir1')
+            self.assertSetEqual(
+                set(ops.ls('snapshots/')),
+                set(['dir1', 'dir2', 'link1', 'link1.target.txt',
+                     'link2', 'link2.target.txt']))
+
+            # nothing is changed if some target is absent
+            self.assertRaises(RuntimeError, ops.symlinks,
+                              [('snapshots/link1', 'dir1'),
+                               ('snapshots/link2', 'dir3')])
+            self.assertEqual(ops.symlink_target('snapshots/link1'), 'dir2')
+
+            # restore previous state
+            transaction = list()
+            ops.symlinks({'snapshots/link1': 'dir1'}, transaction=transaction)
+            self.assertEqual(ops.symlink_target('snapshots/link1'), 'dir1')
+            [func() for func in reversed(transaction)]
+            self.assertEqual(ops.symlink_target('snapshots/link1'), 'dir2')
+
+    def test_ls_cache(self):
+        for remote in self.rsyncd[self.testname]:
+            ops = RsyncOps(remote.url, ls_cache=True)
+            os.makedirs(os.path.join(remote.path, 'dir1'))
+            self.assertSetEqual(set(ops.ls()), set(['dir1']))
+            # changes made by somebody else are not visible
+            self.getDataFile(os.path.join(remote.path, 'file1.txt'))
+            self.assertSetEqual(set(ops.ls()), set(['dir1']))
+            # own writes are visible
+            ops.mk_dir('dir2')
+            ops.symlink('symlink1', 'dir1')
+            self.assertSetEqual(set(ops.ls_dirs()), set(['dir1', 'dir2']))
+            self.assertListEqual(ops.ls_symlinks('symlink1'),
+                                 [['symlink1', 'dir1']])
+            ops.rm_all(['dir2', 'symlink1', 'symlink1.target.txt'])
+            self.assertSetEqual(set(ops.ls()), set(['dir1', 'file1.txt']))
+
+    def test_ls_cache_ttl(self):
+        for remote in self.rsyncd[self.testname]:
+            ops = RsyncOps(remote.url, ls_cache=True, ls_cache_ttl=1)
+            self.assertListEqual(ops.ls(), [])
+            self.getDataFile(os.path.join(remote.path, 'file1.txt'))
+            self.assertListEqual(ops.ls(), [])
+            sleep(1.5)
+            self.assertListEqual(ops.ls(), ['file1.txt'])
+
+    def test_ssh_multiplexing(self):
+        # stand-in remote shell: logs its arguments, emulates master
+        # control commands and runs remote command locally
+        temp_dir = TempFiles()
+        ssh = os.path.join(temp_dir.last_temp_dir, 'ssh')
+        with open(ssh, 'w') as outf:
+            outf.write('#!/bin/sh\n'
+                       'echo "$@" >> "$0.log"\n'
+                       'while [ $# -gt 0 ]; do\n'
+                       '    case "$1" in\n'
+                       '        -o|-l|-p|-O) shift 2;;\n'
+                       '        -*) shift;;\n'
+                       '        *) break;;\n'
+                       '    esac\n'
+                       'done\n'
+                       'shift\n'
+                       '[ $# -gt 0 ] && exec sh -c "$*"\n'
+                       'exit 0\n')
+        os.chmod(ssh, 0o755)
+        for remote in self.rsyncd[self.testname]:
+            if not remote.url.startswith('/'):
+                continue
+            with RsyncOps('localhost:' + remote.path,
+                          ssh_command=ssh) as ops:
+                ops.mk_dir('dir1/dir2')
+                ops.symlink('symlink1', 'dir1')
+                self.assertListEqual(ops.ls_dirs(), ['dir1'])
+                control_path = ops.ssh_master.control_path
+            with open(ssh + '.log') as log_file:
+                calls = log_file.read().splitlines()
+            self.assertIn('ControlMaster=yes', calls[0])
+            self.assertTrue(calls[-1].endswith('-O exit localhost'))
+            # master is started once, all the sessions share it
+            self.assertEqual(
+                len([_ for _ in calls if 'ControlMaster=yes' in _]), 1)
+            self.assertTrue(all(['ControlPath={}'.format(control_path) in _
+                                 for _ in calls]))
+            self.assertTrue(os.path.isdir(os.path.join(remote.path,
+                                                       'dir1/dir2')))
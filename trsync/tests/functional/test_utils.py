@@ -14,8 +14,12 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import os
+import time
 import unittest
 
+from trsync.utils import shell as shell
+from trsync.utils.tempfiles import TempFiles
 from trsync.utils import utils as utils
 
 
@@ -41,5 +45,54 @@ class TestUtils(unittest.TestCase):
         self.assertRaises(utils.ResultNotProduced,
                           retryer.wait_result, self.gen10.next, 5)
 
+    def test_run_parallel(self):
+        def square(item):
+            time.sleep(0.2)
+            if item == 3:
+                raise RuntimeError('failed on 3')
+            return item * item
+
+        started = time.time()
+        res = utils.run_parallel(square, range(5), workers=5)
+        self.assertLess(time.time() - started, 0.6)
+        self.assertEqual([_[0] for _ in res], [0, 1, 2, 3, 4])
+        self.assertEqual([_[1] for _ in res], [True, True, True, False, True])
+        self.assertEqual(res[4][2], 16)
+        self.assertIsInstance(res[3][2], RuntimeError)
+
+    def test_run_parallel_sequential(self):
+        res = utils.run_parallel(lambda x: x + 1, [1, 2], workers=1)
+        self.assertEqual(res, [(1, True, 2), (2, True, 3)])
+
+    def test_run_parallel_log_context(self):
+        with utils.logging_context('server1'):
+            res = utils.run_parallel(lambda x: utils.log_context(), [1, 2],
+                                     workers=2)
+        self.assertEqual([_[2] for _ in res], ['server1', 'server1'])
+        self.assertIsNone(utils.log_context())
+
+    def test_shell_stream(self):
+        temp_dir = TempFiles()
+        out_file = os.path.join(temp_dir.last_temp_dir, 'out.txt')
+        tail = shell.LogTail(maxlen=2)
+        exitcode, out, err = shell.Shell().shell(
+            'seq 1 5000; echo error >&2',
+            consumers=[tail, shell.FileWriter(out_file)])
+        self.assertEqual(exitcode, 0)
+        self.assertEqual(out, '4999\n5000\n')
+        self.assertEqual(err, 'error\n')
+        self.assertTrue(tail.truncated)
+        self.assertEqual(tail.lines_number, 5000)
+        with open(out_file) as outf:
+            self.assertEqual(len(outf.read().splitlines()), 5000)
+
+    def test_shell_stream_failed(self):
+        self.assertRaises(RuntimeError, shell.Shell().shell,
+                          'cat; exit 3', stdin='input', consumers=[])
+        exitcode, out, err = shell.Shell().shell(
+            'cat; exit 3', stdin='input', consumers=[], raise_error=False)
+        self.assertEqual((exitcode, out), (3, 'input'))
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015-2016, Mirantis, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import unittest
+
+from trsync.objects.rsync_mirror import TRsync
+from trsync.utils.tempfiles import TempFiles
+
+
+class TestBatchPlan(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = TempFiles()
+        self.rsync = TRsync(self.temp_dir.last_temp_dir,
+                            init_directory_structure=False,
+                            timestamp='2016-01-20-000000')
+        self.plan = self.rsync._push_plan('repo')
+        self.signature = self.rsync._signature(
+            self.plan, {'snapshots/repo-latest': 'repo-2016-01-19-000000'},
+            'digest')
+
+    def test_signature(self):
+        self.assertEqual(self.signature['snapshot'],
+                         'repo-2016-01-20-000000')
+        self.assertEqual(self.signature['link_dests'],
+                         [['../repo-latest', 'repo-2016-01-19-000000']])
+
+    def test_write(self):
+        self.rsync._batch_apply(self.plan, {'repo': '/tmp/repo.batch'},
+                                None, self.signature)
+        self.assertEqual(self.plan.batch, 'write')
+        self.assertEqual(self.plan.extra[-1],
+                         '--write-batch=/tmp/repo.batch')
+        self.assertEqual(self.rsync._push_source('/src', self.plan), '/src/')
+
+    def test_read(self):
+        self.rsync._batch_apply(
+            self.plan, None, {'repo': ('/tmp/repo.batch', self.signature)},
+            dict(self.signature))
+        self.assertEqual(self.plan.batch, 'read')
+        self.assertEqual(self.plan.extra[-1], '--read-batch=/tmp/repo.batch')
+        self.assertIsNone(self.rsync._push_source('/src', self.plan))
+        cmd = self.rsync.rsync._push_cmd(None, 'snapshots/x', [],
+                                         self.plan.extra)
+        self.assertEqual(cmd[-1],
+                         '{}/snapshots/x'.format(self.temp_dir.last_temp_dir))
+        self.assertNotIn('/src/', cmd)
+
+    def test_diverged(self):
+        changed = dict(self.signature, digest='other')
+        self.plan.batch = None
+        self.rsync._batch_apply(
+            self.plan, None, {'repo': ('/tmp/repo.batch', self.signature)},
+            changed)
+        self.assertIsNone(self.plan.batch)
+        self.assertEqual(self.plan.extra, ['--link-dest=../repo-latest'])
+        self.assertEqual(self.rsync._push_source('/src', self.plan), '/src/')
+
+    def test_not_wanted(self):
+        self.rsync._run(self.rsync._batch_plan_steps(
+            self.plan, {'other': '/tmp/other.batch'}))
+        self.assertIsNone(self.plan.batch)
+        self.assertEqual(self.plan.extra, ['--link-dest=../repo-latest'])
+
+    def test_tree_digest(self):
+        listing = ('drwxr-xr-x          4,096 2016/01/19 00:00:00 repo\n'
+                   '-rw-r--r--              5 2016/01/19 00:00:00 repo/f\n')
+        digest = self.rsync.rsync._tree_digest(listing)
+        reordered = '\n'.join(reversed(listing.splitlines()))
+        self.assertEqual(self.rsync.rsync._tree_digest(reordered), digest)
+        self.assertNotEqual(self.rsync.rsync._tree_digest(
+            listing.replace(' 5 ', ' 6 ')), digest)
+        # messages of rsync are ignored
+        self.assertEqual(self.rsync.rsync._tree_digest(
+            'receiving file list ... done\n' + listing), digest)
+
+
+if __name__ == '__main__':
+    unittest.main()
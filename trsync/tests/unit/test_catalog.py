@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015-2016, Mirantis, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import datetime
+import unittest
+
+from trsync.objects.catalog import Catalog
+
+
+class TestCatalog(unittest.TestCase):
+
+    snapshot1 = 'repo-2016-01-02-030405'
+    snapshot2 = 'repo-2016-01-03-030405'
+
+    def catalog(self):
+        catalog = Catalog()
+        catalog.add_snapshot(self.snapshot1, stats={'files': 2}, changes=1,
+                             diff=['diff.txt'])
+        catalog.add_snapshot(self.snapshot2)
+        catalog.symlinks['snapshots/repo-latest'] = self.snapshot2
+        catalog.symlinks['repo'] = self.snapshot2
+        catalog.symlinks['snapshots/repo-2016-01-02'] = self.snapshot1
+        return catalog
+
+    def test_dumps_loads(self):
+        catalog = self.catalog()
+        now = datetime.datetime(2016, 1, 3, 4, 5, 6)
+        loaded = Catalog.loads(catalog.dumps(now))
+        self.assertEqual(loaded.snapshots[self.snapshot1],
+                         dict(repo='repo', timestamp='2016-01-02-030405',
+                              stats={'files': 2}, changes=1,
+                              diff=['diff.txt'],
+                              symlinks=['snapshots/repo-2016-01-02']))
+        self.assertEqual(loaded.symlinks, catalog.symlinks)
+        self.assertEqual(loaded.updated, '2016-01-03T04:05:06')
+        self.assertFalse(loaded.rebuilt)
+        self.assertIsNone(Catalog.loads('not json'))
+        self.assertIsNone(Catalog.loads('{"snapshots": {}}'))
+
+    def test_is_stale(self):
+        catalog = self.catalog()
+        now = datetime.datetime(2016, 1, 3, 4, 5, 6)
+        catalog.dumps(now)
+        self.assertFalse(catalog.is_stale(60, now))
+        self.assertFalse(catalog.is_stale(None, now))
+        self.assertTrue(catalog.is_stale(
+            60, now + datetime.timedelta(seconds=61)))
+        catalog.file_version = 0
+        self.assertTrue(catalog.is_stale(None, now))
+
+    def test_remove_snapshots(self):
+        catalog = self.catalog()
+        catalog.remove_snapshots([self.snapshot2])
+        self.assertEqual(list(catalog.snapshots), [self.snapshot1])
+        self.assertEqual(catalog.symlinks,
+                         {'snapshots/repo-2016-01-02': self.snapshot1})
+
+    def test_from_listings(self):
+        previous = self.catalog()
+        previous.symlinks['other/repo'] = self.snapshot1
+        catalog = Catalog.from_listings(
+            [('d', self.snapshot1, None),
+             ('d', self.snapshot2, None),
+             ('d', 'unknown', None),
+             ('l', 'repo-latest', self.snapshot2)],
+            {'snapshots/': [('l', 'repo-latest', self.snapshot2),
+                            ('-', 'file', None)],
+             '/': [('l', 'repo', 'snapshots/' + self.snapshot1),
+                   ('l', 'external', '/srv/repo')]},
+            previous=previous)
+        self.assertTrue(catalog.rebuilt)
+        self.assertEqual(sorted(catalog.snapshots),
+                         [self.snapshot1, self.snapshot2])
+        self.assertEqual(catalog.snapshots[self.snapshot1]['changes'], 1)
+        self.assertEqual(catalog.symlinks,
+                         {'snapshots/repo-latest': self.snapshot2,
+                          'repo': self.snapshot1,
+                          'other/repo': self.snapshot1})
+        snapshots, symlinks = catalog.listings()
+        self.assertEqual(snapshots, [('d', self.snapshot1, None),
+                                     ('d', self.snapshot2, None)])
+        self.assertIn(('l', 'repo', self.snapshot1), symlinks)
+
+    def test_incomplete(self):
+        catalog = self.catalog()
+        catalog.add_incomplete('repo-2016-01-04-030405')
+        loaded = Catalog.loads(catalog.dumps())
+        self.assertEqual(loaded.incomplete, set(['repo-2016-01-04-030405']))
+        self.assertIn(('-', 'repo-2016-01-04-030405.incomplete', None),
+                      loaded.listings()[0])
+        loaded.add_snapshot('repo-2016-01-04-030405', stats={'files': 1})
+        self.assertEqual(loaded.incomplete, set())
+        rebuilt = Catalog.from_listings(
+            [('d', self.snapshot1, None),
+             ('d', self.snapshot2, None),
+             ('-', self.snapshot2 + '.incomplete', None),
+             ('-', 'repo-2016-01-05-030405.incomplete', None)], {})
+        self.assertEqual(rebuilt.incomplete, set([self.snapshot2]))
+        rebuilt.remove_snapshots([self.snapshot2])
+        self.assertEqual(rebuilt.incomplete, set())
+
+
+if __name__ == '__main__':
+    unittest.main()
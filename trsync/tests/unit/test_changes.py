@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015-2016, Mirantis, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import os
+import unittest
+
+from trsync.utils import changes as changes
+from trsync.utils.shell import LogTail
+from trsync.utils.tempfiles import TempFiles
+
+
+class TestChanges(unittest.TestCase):
+
+    output = [
+        'sending incremental file list\n',
+        'cd+++++++++|4096|2016/01/02-03:04:05|dir1/\n',
+        '>f+++++++++|9|2016/01/02-03:04:05|dir1/file|with|bars.txt\n',
+        '>f.st......|10|2016/01/03-03:04:05|file2.txt\n',
+        '.d..t......|4096|2016/01/03-03:04:05|./\n',
+        'cL+++++++++|4|2016/01/02-03:04:05|link1 -> dir1\n',
+        '*deleting  |0|1970/01/01-00:00:00|old/\n',
+        '\n',
+        'sent 100 bytes  received 20 bytes  240.00 bytes/sec\n',
+    ]
+
+    def test_parse_line(self):
+        record, legacy = changes.parse_line(self.output[2])
+        self.assertEqual(record, changes.ChangeRecord(
+            path='dir1/file|with|bars.txt', change='created', kind='file',
+            size=9, mtime='2016-01-02T03:04:05', item='>f+++++++++'))
+        self.assertEqual(legacy, 'dir1/file|with|bars.txt\n')
+        self.assertIsNone(changes.parse_line(self.output[0]))
+        self.assertIsNone(changes.parse_line(self.output[-1]))
+
+    def test_change_types(self):
+        records = [changes.parse_line(_)[0] for _ in self.output[1:7]]
+        self.assertEqual(
+            [(_.path, _.change, _.kind) for _ in records],
+            [('dir1', 'created', 'dir'),
+             ('dir1/file|with|bars.txt', 'created', 'file'),
+             ('file2.txt', 'updated', 'file'),
+             ('.', 'attributes', 'dir'),
+             ('link1', 'created', 'symlink'),
+             ('old', 'deleted', 'dir')])
+        self.assertEqual((records[-1].size, records[-1].mtime), (None, None))
+
+    def test_itemize_parser(self):
+        tail = LogTail()
+        records = changes.ChangeRecords()
+        parser = changes.ItemizeParser([tail], [records])
+        for line in self.output:
+            parser.feed(line)
+        parser.close()
+        self.assertEqual(len(records), 6)
+        self.assertEqual(tail.text.splitlines()[5:7],
+                         ['link1 -> dir1', 'deleting old/'])
+        self.assertEqual(tail.lines_number, len(self.output))
+
+    def test_changes_file(self):
+        temp_dir = TempFiles()
+        filename = os.path.join(temp_dir.last_temp_dir, 'c.jsonl.gz')
+        records = [changes.parse_line(_)[0] for _ in self.output[1:7]]
+        writer = changes.ChangesWriter(filename)
+        for record in records:
+            writer.feed(record)
+        writer.close()
+        self.assertEqual(writer.records_number, 6)
+        self.assertEqual(list(changes.read_changes(filename)), records)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015-2016, Mirantis, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import os
+import time
+import unittest
+
+from trsync.objects.rsync_ops import RsyncOps
+from trsync.utils.retry import RetryPolicy
+from trsync.utils.shell import Deadline
+from trsync.utils.shell import DeadlineExceeded
+from trsync.utils.shell import LogTail
+from trsync.utils.shell import Shell
+from trsync.utils.tempfiles import TempFiles
+
+
+class TestDeadline(unittest.TestCase):
+
+    def test_remaining(self):
+        deadline = Deadline(10, grace=5)
+        self.assertTrue(9 < deadline.remaining() <= 10)
+        deadline.expire()
+        self.assertTrue(deadline.expired)
+        self.assertTrue(4 < deadline.remaining() <= 5)
+
+    def test_kill(self):
+        shell = Shell(deadline=Deadline(0.5, grace=0))
+        started = time.time()
+        self.assertRaises(DeadlineExceeded, shell.shell, 'sleep 10',
+                          raise_error=False)
+        self.assertLess(time.time() - started, 5)
+        self.assertTrue(shell.deadline.expired)
+        # the next commands are not started
+        self.assertRaises(DeadlineExceeded, shell.shell, 'true')
+
+    def test_kill_process_group(self):
+        temp_dir = TempFiles()
+        flag = os.path.join(temp_dir.last_temp_dir, 'flag')
+        shell = Shell(deadline=Deadline(0.5))
+        tail = LogTail()
+        # the child of the shell does not outlive it
+        self.assertRaises(DeadlineExceeded, shell.shell,
+                          'echo started; (sleep 2; touch {}) & wait'
+                          ''.format(flag), consumers=[tail])
+        self.assertEqual(tail.text, 'started\n')
+        time.sleep(2.5)
+        self.assertFalse(os.path.exists(flag))
+        temp_dir.close()
+
+    def test_grace(self):
+        shell = Shell(deadline=Deadline(0.5, grace=10))
+        self.assertRaises(DeadlineExceeded, shell.shell, 'sleep 10')
+        # rollback is given the grace period
+        self.assertEqual(shell.shell('echo undo')[1], 'undo\n')
+
+    def test_no_retry_after_deadline(self):
+        shell = Shell(retry=RetryPolicy(attempts=3, backoff=30, jitter=0),
+                      deadline=Deadline(10))
+        result = shell.shell('exit 10', raise_error=False)
+        self.assertEqual(len(result.attempts), 1)
+
+
+class TestTimeoutArgs(unittest.TestCase):
+
+    def ops(self, url, **kwargs):
+        return RsyncOps(url, ssh_multiplexing=False, **kwargs)
+
+    def test_ssh(self):
+        ops = self.ops('user@host:/mirror/', io_timeout=600,
+                       connect_timeout=60, ssh_command='ssh -i key')
+        cmd = ops._cmd(['-l'], ['--timeout=5'])
+        self.assertEqual(cmd[:8], ['rsync', '-l', '-e',
+                                   'ssh -i key -o ConnectTimeout=60',
+                                   '--timeout=600', '-v', '--no-owner',
+                                   '--no-group'])
+        # options specified by user win
+        self.assertEqual(cmd[-2], '--timeout=5')
+        self.assertNotIn('--contimeout=60', cmd)
+
+    def test_daemon(self):
+        ops = self.ops('rsync://host/module/', io_timeout=600,
+                       connect_timeout=60)
+        cmd = ops._cmd([], [])
+        self.assertIn('--contimeout=60', cmd)
+        self.assertIn('--timeout=600', cmd)
+        self.assertNotIn('-e', cmd)
+
+    def test_defaults(self):
+        cmd = self.ops('user@host:/mirror/')._cmd([], [])
+        self.assertEqual([_ for _ in cmd if 'timeout' in _.lower()], [])
+        self.assertNotIn('-e', cmd)
+
+    def test_shared_deadline(self):
+        ops = self.ops('rsync://host/module/', deadline=60)
+        self.assertIsInstance(ops.deadline, Deadline)
+        other = self.ops('rsync://host/module/', deadline=ops.deadline)
+        self.assertIs(other.deadline, ops.deadline)
+        self.assertIs(other._shell.deadline, ops.deadline)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015-2016, Mirantis, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import os
+import unittest
+
+from trsync.objects.fanout import Relay
+from trsync.objects.fanout import SshRelay
+from trsync.objects.rsync_mirror import TRsync
+from trsync.objects.rsync_ops import RsyncOps
+from trsync.utils.tempfiles import TempFiles
+from trsync.utils.utils import bunch
+
+
+class TestSshRelay(unittest.TestCase):
+
+    def setUp(self):
+        self.relay = SshRelay(RsyncOps('user@tier1:/mirror/',
+                                       ssh_multiplexing=False,
+                                       ssh_command='ssh -i key'))
+
+    def test_path(self):
+        self.assertEqual(self.relay.path('snapshots/repo-2016-01-20-000000'),
+                         '/mirror/snapshots/repo-2016-01-20-000000/')
+
+    def test_push_cmd(self):
+        ops = RsyncOps('rsync://tier2/mirror/', io_timeout=600)
+        cmd = ops._push_cmd('/mirror/snapshots/repo/', 'snapshots/repo',
+                            ['--archive'], ['--link-dest=../repo-latest'],
+                            relay=self.relay)
+        self.assertEqual(cmd[:4], ['ssh', '-i', 'key', 'user@tier1'])
+        self.assertEqual(len(cmd), 5)
+        self.assertTrue(cmd[4].startswith('rsync --archive --timeout=600 '))
+        self.assertTrue(cmd[4].endswith(
+            ' --link-dest=../repo-latest /mirror/snapshots/repo/ '
+            'rsync://tier2/mirror/snapshots/repo'))
+
+    def test_ssh_destination(self):
+        # the master connection of the local host is useless on the relay
+        ops = RsyncOps('user@tier2:/mirror/')
+        cmd = ops._push_cmd('/src/', 'dst', [], [], relay=self.relay)
+        self.assertNotIn('ControlPath', cmd[-1])
+        self.assertIn('--protect-args', cmd[-1])
+        ops.close()
+
+    def test_local_destination(self):
+        ops = RsyncOps('/mirror/')
+        self.assertRaises(RuntimeError, ops._push_cmd, '/src/', 'dst', [],
+                          [], relay=self.relay)
+
+
+class TestRelay(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = TempFiles()
+        self.root = self.temp_dir.last_temp_dir
+        self.results = {'repo': bunch(snapshot='snapshots/repo-1')}
+
+    def tearDown(self):
+        self.temp_dir.close()
+
+    def test_urls(self):
+        self.assertRaises(RuntimeError, Relay, 'rsync://tier1/mirror/',
+                          self.results)
+        with Relay('user@tier1:/mirror/', self.results,
+                   ssh_multiplexing=False) as relay:
+            self.assertEqual(relay.sources([('/src', 'repo')]),
+                             [('/mirror/snapshots/repo-1/', 'repo')])
+            self.assertEqual(str(relay.ssh), 'user@tier1:/mirror/')
+
+    def test_local_in_place(self):
+        with Relay(self.root, self.results) as relay:
+            self.assertEqual(relay.source('repo'),
+                             os.path.join(self.root, 'snapshots/repo-1/'))
+            self.assertIsNone(relay.ssh)
+
+    def test_second_tier_local(self):
+        source = os.path.join(self.root, 'source')
+        os.makedirs(os.path.join(source, 'dir'))
+        with open(os.path.join(source, 'dir', 'file'), 'w') as outfile:
+            outfile.write('data')
+        first, second = [os.path.join(self.root, _)
+                         for _ in ('first', 'second')]
+        options = dict(timestamp='2016-01-20-000000', catalog=False,
+                       engine='hardlink', snapshot_lifetime=None)
+        with TRsync(first, **options) as rsync:
+            results = rsync.push_many([(source, 'repo')], save_diff=False)
+        self.assertEqual(results['repo'].snapshot,
+                         'snapshots/repo-2016-01-20-000000')
+        with Relay(first, results) as relay:
+            with TRsync(second, **options) as rsync:
+                results = rsync.push_many(relay.sources([(source, 'repo')]),
+                                          save_diff=False)
+        snapshot = os.path.join(second, 'snapshots/repo-2016-01-20-000000')
+        with open(os.path.join(snapshot, 'dir', 'file')) as infile:
+            self.assertEqual(infile.read(), 'data')
+        self.assertEqual(os.readlink(os.path.join(second,
+                                                  'snapshots/repo-latest')),
+                         'repo-2016-01-20-000000')
+
+
+if __name__ == '__main__':
+    unittest.main()
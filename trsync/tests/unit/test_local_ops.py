@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015-2016, Mirantis, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import os
+import unittest
+
+from trsync.objects.local_ops import LocalOps
+from trsync.objects.local_ops import ops_for_url
+from trsync.objects.rsync_mirror import TRsync
+from trsync.objects.rsync_ops import RsyncOps
+from trsync.utils.tempfiles import TempFiles
+
+
+class TestLocalOps(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = TempFiles()
+        self.path = self.temp_dir.last_temp_dir
+        os.makedirs(os.path.join(self.path, 'snapshots/dir1/sub'))
+        with open(os.path.join(self.path, 'snapshots/dir1/file'), 'w') as f:
+            f.write('data')
+        os.makedirs(os.path.join(self.path, 'snapshots/dir2'))
+        os.symlink('dir1', os.path.join(self.path, 'snapshots/latest'))
+        self.ops = LocalOps(self.path, ls_cache=True)
+
+    def test_ops_for_url(self):
+        self.assertIsInstance(ops_for_url(self.path), LocalOps)
+        ops = ops_for_url('rsync://localhost/module/path')
+        self.assertIs(type(ops), RsyncOps)
+        self.assertIsInstance(
+            ops_for_url(self.path, rsync_extra_params='-v --no-owner'),
+            LocalOps)
+
+    def test_ops_for_url_extra(self):
+        # LocalOps would really remove files and switch symlinks
+        for ops in (ops_for_url(self.path, '--dry-run'),
+                    ops_for_url(self.path,
+                                rsync_extra_params='-v --dry-run'),
+                    TRsync(self.path, rsync_extra_params='--dry-run',
+                           init_directory_structure=False).rsync):
+            self.assertIs(type(ops), RsyncOps)
+            self.assertIn('--dry-run', ops._cmd([], [], ops.url))
+
+    def test_ls(self):
+        self.assertEqual(self.ops.ls('snapshots/'),
+                         ['dir1', 'dir2', 'latest'])
+        self.assertEqual(self.ops.ls_dirs('snapshots/'), ['dir1', 'dir2'])
+        self.assertEqual(self.ops.ls_symlinks('snapshots/'),
+                         [['latest', 'dir1']])
+        self.assertEqual(self.ops.ls('snapshots/latest/'), ['file', 'sub'])
+        mode, name, target = self.ops._list('snapshots/dir1/file')[0]
+        self.assertEqual((mode[0], name, target), ('-', 'file', None))
+        self.assertEqual(self.ops.ls('absent/'), [])
+        self.assertEqual(
+            self.ops._ls_paths(['snapshots/latest', 'absent']),
+            {'snapshots/latest': ('lrwxrwxrwx', 'dir1')})
+
+    def test_mk_dir_rm_all(self):
+        self.ops.mk_dir('new/dir')
+        self.assertTrue(os.path.isdir(os.path.join(self.path, 'new/dir')))
+        self.assertEqual(self.ops.ls_dirs('new/'), ['dir'])
+        self.assertEqual(
+            self.ops.rm_all(['snapshots/latest', 'snapshots/dir1', 'absent']),
+            {'snapshots/latest': True, 'snapshots/dir1': True,
+             'absent': True})
+        self.assertEqual(self.ops.ls('snapshots/'), ['dir2'])
+        self.assertRaises(RuntimeError, self.ops.rm_all, ['/'])
+        self.ops.clean_dir('new')
+        self.assertEqual(self.ops.ls('new/'), [])
+
+    def test_mk_dir_nested(self):
+        self.assertEqual(self.ops.ls(), ['snapshots'])
+        self.assertEqual(self.ops.ls('snapshots/'), ['dir1', 'dir2',
+                                                     'latest'])
+        self.ops.mk_dir('a/b/c')
+        self.ops.mk_dir('snapshots/dir3/sub')
+        # the listings of all the created directories are refreshed
+        self.assertEqual(self.ops.ls(), ['a', 'snapshots'])
+        self.assertEqual(self.ops.ls('a/'), ['b'])
+        self.assertEqual(self.ops.ls('snapshots/'), ['dir1', 'dir2', 'dir3',
+                                                     'latest'])
+
+    def test_mk_dir_args_invalidate(self):
+        ops = RsyncOps('rsync://localhost/module/', ls_cache=True)
+        for key in ('', 'a', 'a/b', 'a/b/c', 'other'):
+            ops._ls_cache_put(key, [])
+        ops._mk_dir_args(self.path, 'a/b/c')
+        self.assertEqual(list(ops._ls_cache), ['other'])
+
+    def test_symlinks(self):
+        transaction = list()
+        previous = self.ops.symlinks({'snapshots/latest': 'dir2',
+                                      'stable': 'snapshots/dir1'},
+                                     transaction=transaction)
+        self.assertEqual(previous, {'snapshots/latest': 'dir1',
+                                    'stable': None})
+        self.assertEqual(
+            os.readlink(os.path.join(self.path, 'snapshots/latest')), 'dir2')
+        self.assertEqual(self.ops.symlink_target('stable'), 'snapshots/dir1')
+        self.assertRaises(RuntimeError, self.ops.symlink, 'stable', 'absent')
+        self.assertRaises(RuntimeError, self.ops.symlink, 'stable',
+                          'snapshots/dir2', update=False)
+
+        transaction[-1]()
+        self.assertEqual(
+            os.readlink(os.path.join(self.path, 'snapshots/latest')), 'dir1')
+        self.assertFalse(os.path.lexists(os.path.join(self.path, 'stable')))
+        with open(os.path.join(self.path,
+                               'snapshots/latest.target.txt')) as f:
+            self.assertEqual(f.read().splitlines(), ['dir1', 'dir2'])
+        self.assertEqual([_ for _ in os.listdir(self.path)
+                          if _.endswith('.tmp')], [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015-2016, Mirantis, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import errno
+import os
+import unittest
+
+from trsync.objects.local_snapshot import copy_data
+from trsync.objects.local_snapshot import LocalSnapshot
+from trsync.utils.changes import ChangeRecords
+from trsync.utils.changes import ItemizeParser
+from trsync.utils.shell import LogTail
+from trsync.utils.stats import StatsParser
+from trsync.utils.tempfiles import TempFiles
+
+
+class TestLocalSnapshot(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = TempFiles()
+        self.root = self.temp_dir.last_temp_dir
+        self.source = os.path.join(self.root, 'source')
+        self.write('source/same.txt', 'same')
+        self.write('source/dir/changed.txt', 'new content')
+        self.write('source/dir/sub/new.txt', 'new')
+        os.symlink('dir/sub', os.path.join(self.source, 'link'))
+
+    def write(self, path, content, mtime=1451606400):
+        path = os.path.join(self.root, path)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as outfile:
+            outfile.write(content)
+        os.utime(path, (mtime, mtime))
+
+    def run_snapshot(self, dest, link_dest=None):
+        tail, records, stats = LogTail(), ChangeRecords(), StatsParser()
+        if isinstance(link_dest, list):
+            link_dest = [os.path.join(self.root, _) for _ in link_dest]
+        elif link_dest:
+            link_dest = os.path.join(self.root, link_dest)
+        LocalSnapshot(self.source, os.path.join(self.root, dest), link_dest,
+                      workers=4).run(
+            [ItemizeParser([tail, stats], [records])])
+        return dict([(_.path, _.change) for _ in records]), stats.stats, tail
+
+    def inode(self, path):
+        return os.stat(os.path.join(self.root, path)).st_ino
+
+    def test_first_snapshot(self):
+        changes, stats, tail = self.run_snapshot('snap1')
+        self.assertEqual(changes, {'.': 'created',
+                                   'same.txt': 'created',
+                                   'dir': 'created',
+                                   'dir/changed.txt': 'created',
+                                   'dir/sub': 'created',
+                                   'dir/sub/new.txt': 'created',
+                                   'link': 'created'})
+        self.assertEqual(tail.text.splitlines()[:2], ['./', 'dir/'])
+        self.assertEqual((stats.files, stats.files_transferred,
+                          stats.total_file_size), (7, 3, 18))
+        with open(os.path.join(self.root, 'snap1/dir/sub/new.txt')) as f:
+            self.assertEqual(f.read(), 'new')
+        self.assertEqual(os.readlink(os.path.join(self.root, 'snap1/link')),
+                         'dir/sub')
+        self.assertEqual(
+            int(os.stat(os.path.join(self.root, 'snap1/same.txt')).st_mtime),
+            1451606400)
+
+    def test_link_dest(self):
+        self.write('latest/same.txt', 'same')
+        self.write('latest/dir/changed.txt', 'old')
+        self.write('latest/removed.txt', 'removed')
+        os.symlink('dir/sub', os.path.join(self.root, 'latest/link'))
+        changes, stats, tail = self.run_snapshot('snap2', 'latest')
+        self.assertEqual(changes, {'.': 'created',
+                                   'dir': 'created',
+                                   'dir/changed.txt': 'updated',
+                                   'dir/sub': 'created',
+                                   'dir/sub/new.txt': 'created'})
+        self.assertEqual(self.inode('snap2/same.txt'),
+                         self.inode('latest/same.txt'))
+        self.assertNotEqual(self.inode('snap2/dir/changed.txt'),
+                            self.inode('latest/dir/changed.txt'))
+        self.assertIn('dir/changed.txt', tail.text.splitlines())
+        self.assertEqual(stats.files_transferred, 2)
+        self.assertFalse(os.path.exists(
+            os.path.join(self.root, 'snap2/removed.txt')))
+
+    def test_several_link_dests(self):
+        self.write('latest/same.txt', 'old', mtime=1451606000)
+        self.write('latest/dir/changed.txt', 'old')
+        self.write('sibling/same.txt', 'same')
+        self.write('sibling/dir/sub/new.txt', 'new')
+        changes, stats, tail = self.run_snapshot(
+            'snap5', ['latest', 'sibling', 'absent'])
+        self.assertEqual(self.inode('snap5/same.txt'),
+                         self.inode('sibling/same.txt'))
+        self.assertEqual(self.inode('snap5/dir/sub/new.txt'),
+                         self.inode('sibling/dir/sub/new.txt'))
+        self.assertEqual(changes['dir/changed.txt'], 'updated')
+        self.assertNotIn('same.txt', changes)
+        self.assertEqual((stats.files_transferred, stats.total_file_size,
+                          stats.transferred_file_size), (1, 18, 11))
+
+    def test_link_failed(self):
+        # the existing destination is removed before the link
+        self.write('latest/same.txt', 'same')
+        self.write('snap6/same.txt', 'same')
+
+        def link(src, dst):
+            raise OSError(errno.EMLINK, os.strerror(errno.EMLINK))
+
+        os_link, os.link = os.link, link
+        try:
+            changes, stats, tail = self.run_snapshot('snap6', 'latest')
+        finally:
+            os.link = os_link
+        with open(os.path.join(self.root, 'snap6/same.txt')) as f:
+            self.assertEqual(f.read(), 'same')
+        self.assertNotEqual(self.inode('snap6/same.txt'),
+                            self.inode('latest/same.txt'))
+
+    def test_delete(self):
+        self.write('snap3/dir/old.txt', 'old')
+        self.write('snap3/same.txt', 'same')
+        changes, stats, tail = self.run_snapshot('snap3')
+        self.assertEqual(changes['dir/old.txt'], 'deleted')
+        self.assertNotIn('same.txt', changes)
+        self.assertIn('deleting dir/old.txt', tail.text.splitlines())
+        self.assertEqual(stats.files_deleted, 1)
+
+    def test_failed(self):
+        self.assertRaises(RuntimeError, LocalSnapshot(
+            os.path.join(self.root, 'absent'),
+            os.path.join(self.root, 'snap4')).run, [])
+
+    def test_copy_data(self):
+        self.write('big', 'x' * 100000)
+        copy_data(os.path.join(self.root, 'big'),
+                  os.path.join(self.root, 'big.copy'), 100000)
+        with open(os.path.join(self.root, 'big.copy')) as f:
+            self.assertEqual(f.read(), 'x' * 100000)
+
+
+if __name__ == '__main__':
+    unittest.main()
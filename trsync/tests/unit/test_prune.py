@@ -0,0 +1,253 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015-2016, Mirantis, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import os
+import unittest
+
+from trsync.objects.catalog import Catalog
+from trsync.objects.rsync_mirror import TRsync
+from trsync.objects.rsync_url import RsyncUrl
+from trsync.utils.tempfiles import TempFiles
+
+
+class TestPrunePlan(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = TempFiles()
+        self.rsync = TRsync(self.temp_dir.last_temp_dir,
+                            init_directory_structure=False,
+                            timestamp='2016-01-20-000000')
+        self.snapshots = [
+            ('drwxr-xr-x', 'repo-2016-01-01-000000', None),
+            ('drwxr-xr-x', 'repo-2016-01-02-000000', None),
+            ('drwxr-xr-x', 'repo-2016-01-03-000000', None),
+            ('drwxr-xr-x', 'repo-2016-01-19-000000', None),
+            ('drwxr-xr-x', 'other-2016-01-01-000000', None),
+            ('-rw-r--r--', 'repo-2016-01-01-000000.diff.txt', None),
+            ('lrwxrwxrwx', 'repo-latest', 'repo-2016-01-19-000000'),
+            ('lrwxrwxrwx', 'repo-stable', 'repo-2016-01-02-000000/'),
+        ]
+        self.root = [
+            ('drwxr-xr-x', 'snapshots', None),
+            ('lrwxrwxrwx', 'repo', 'snapshots/repo-2016-01-03-000000'),
+        ]
+
+    def test_prune_dirs(self):
+        self.assertEqual(self.rsync._prune_dirs(), ['snapshots/', '/'])
+
+    def test_prune_plan(self):
+        plan = self.rsync._prune_plan('repo', 14,
+                                      [self.snapshots, self.root])
+        self.assertEqual(plan.remove, ['repo-2016-01-01-000000'])
+        self.assertEqual(plan.linked,
+                         {'repo-2016-01-02-000000': ['repo-stable'],
+                          'repo-2016-01-03-000000': ['repo']})
+        self.assertEqual(plan.new, ['repo-2016-01-19-000000'])
+        self.assertEqual(plan.paths,
+                         ['snapshots/repo-2016-01-01-000000',
+                          'snapshots/repo-2016-01-01-000000.changes.jsonl.gz',
+                          'snapshots/repo-2016-01-01-000000.diff.txt'])
+
+    def test_prune_plan_all(self):
+        plan = self.rsync._prune_plan('repo', -1, [self.snapshots, self.root])
+        self.assertEqual(plan.new, [])
+        self.assertEqual(plan.remove, ['repo-2016-01-01-000000'])
+        self.assertEqual(sorted(plan.linked),
+                         ['repo-2016-01-02-000000', 'repo-2016-01-03-000000',
+                          'repo-2016-01-19-000000'])
+
+    def test_prune_incomplete(self):
+        self.rsync._incomplete_max_age = 86400
+        snapshots = self.snapshots + [
+            ('drwxr-xr-x', 'repo-2016-01-19-120000', None),
+            ('-rw-r--r--', 'repo-2016-01-19-120000.incomplete', None),
+            ('-rw-r--r--', 'repo-2016-01-01-000000.incomplete', None)]
+        plan = self.rsync._prune_plan('repo', 14, [snapshots, self.root])
+        self.assertEqual(plan.remove, ['repo-2016-01-01-000000'])
+        self.assertEqual(plan.incomplete, ['repo-2016-01-19-120000'])
+        self.assertEqual(plan.paths[-1],
+                         'snapshots/repo-2016-01-01-000000.incomplete')
+        batches = self.rsync._prune_batches({'repo': plan}, 4)
+        self.assertEqual(len(batches), 1)
+        self.assertEqual(len(batches[0]), 4)
+        self.assertEqual(self.rsync._resume_snapshot('repo', snapshots),
+                         None)
+        self.rsync._resumable = True
+        self.assertEqual(self.rsync._resume_snapshot('repo', snapshots),
+                         'repo-2016-01-19-120000')
+        self.rsync._incomplete_max_age = 3600
+        self.assertEqual(self.rsync._resume_snapshot('repo', snapshots),
+                         None)
+
+    def test_listing_repos(self):
+        self.assertEqual(self.rsync._listing_repos(self.snapshots),
+                         ['other', 'repo'])
+
+    def test_prune_batches(self):
+        report = self.rsync._prune_report(None, 14,
+                                          [self.snapshots, self.root])
+        self.assertEqual(report.snapshots, ['other-2016-01-01-000000',
+                                            'repo-2016-01-01-000000'])
+        batches = self.rsync._prune_batches(report.plans, 4)
+        self.assertEqual(len(batches), 2)
+        self.assertEqual(batches[0][0], 'snapshots/other-2016-01-01-000000')
+        self.assertEqual(len(batches[1]), 3)
+        self.assertEqual(len(self.rsync._prune_batches(report.plans, 1)[0]),
+                         6)
+
+    def test_reclaimed_estimation(self):
+        catalog = Catalog.from_listings(self.snapshots, {})
+        for name, size in [('repo-2016-01-02-000000', 100),
+                           ('other-2016-01-01-000000', 7)]:
+            catalog.snapshots[name]['stats'] = dict(
+                transferred_file_size=size)
+        url = self.rsync.url
+        self.rsync.url = RsyncUrl('rsync://host/module')
+        try:
+            self.assertEqual(self.rsync._reclaimed_space(
+                ['repo-2016-01-01-000000', 'other-2016-01-01-000000'],
+                catalog), (107, False))
+            self.assertEqual(self.rsync._reclaimed_space(
+                ['repo-2016-01-01-000000']), (None, False))
+        finally:
+            self.rsync.url = url
+
+    def test_prune_repos_local(self):
+        root = self.temp_dir.last_temp_dir
+        for path, content in [('repo-2016-01-01-000000/a', 'a' * 10),
+                              ('repo-2016-01-01-000000.diff.txt', 'd' * 5),
+                              ('repo-2016-01-19-000000/c', 'c' * 1000),
+                              ('other-2016-01-01-000000/b', 'b' * 20)]:
+            path = os.path.join(root, 'snapshots', path)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'w') as outfile:
+                outfile.write(content)
+        os.link(os.path.join(root, 'snapshots/repo-2016-01-19-000000/c'),
+                os.path.join(root, 'snapshots/repo-2016-01-01-000000/c'))
+        os.link(os.path.join(root, 'snapshots/other-2016-01-01-000000/b'),
+                os.path.join(root, 'snapshots/other-2016-01-01-000000/b2'))
+        rsync = TRsync(root, init_directory_structure=False, catalog=False,
+                       timestamp='2016-01-20-000000', snapshot_lifetime=14)
+        report = rsync.prune_repos(dry_run=True)
+        self.assertEqual((report.snapshots, report.removed),
+                         (['other-2016-01-01-000000',
+                           'repo-2016-01-01-000000'], []))
+        self.assertEqual((report.reclaimed, report.exact), (35, True))
+        report = rsync.prune_repos(['repo'], io_workers=2)
+        self.assertEqual(report.removed, ['repo-2016-01-01-000000'])
+        self.assertEqual(sorted(os.listdir(os.path.join(root, 'snapshots'))),
+                         ['other-2016-01-01-000000',
+                          'repo-2016-01-19-000000'])
+
+    def test_prune_plan_catalog(self):
+        root = self.temp_dir.last_temp_dir
+        names = ['repo-2016-01-0{}-000000'.format(_) for _ in range(1, 4)]
+        for name in names:
+            os.makedirs(os.path.join(root, 'snapshots', name))
+        os.makedirs(os.path.join(root, 'pub'))
+        # made without the catalog
+        os.symlink('snapshots/' + names[0], os.path.join(root, 'stable'))
+        os.symlink('../snapshots/' + names[1],
+                   os.path.join(root, 'pub/repo'))
+        catalog = Catalog.from_listings([('d', _, None) for _ in names], {})
+        catalog.symlinks['pub/repo'] = names[1]
+        catalog.symlinks['pub/removed'] = names[2]
+        rsync = TRsync(root, init_directory_structure=False,
+                       timestamp='2016-01-20-000000', snapshot_lifetime=14)
+        rsync._catalog = catalog
+        plan = rsync.prune_plan('repo')
+        self.assertEqual(plan.remove, [names[2]])
+        self.assertEqual(plan.linked, {names[0]: ['stable'],
+                                       names[1]: ['pub/repo']})
+        self.assertEqual(rsync.resolve_many(['stable', 'pub/repo']),
+                         {'stable': 'snapshots/' + names[0],
+                          'pub/repo': '../snapshots/' + names[1]})
+
+
+class TestPushPlan(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = TempFiles()
+        self.snapshots = [
+            ('drwxr-xr-x', 'repo-2016-01-{:02}-000000'.format(_), None)
+            for _ in range(1, 8)] + [
+            ('drwxr-xr-x', 'repo-sec-2016-01-05-000000', None),
+            ('drwxr-xr-x', 'other-2016-01-05-000000', None),
+            ('-rw-r--r--', 'repo-2016-01-07-000000.diff.txt', None),
+            ('lrwxrwxrwx', 'repo-latest', 'repo-2016-01-05-000000'),
+        ]
+
+    def trsync(self, **kwargs):
+        return TRsync(self.temp_dir.last_temp_dir,
+                      init_directory_structure=False,
+                      timestamp='2016-01-20-000000', **kwargs)
+
+    def test_latest_only(self):
+        plan = self.trsync()._push_plan('repo', extra='--checksum')
+        self.assertEqual(plan.extra, ['--link-dest=../repo-latest',
+                                      '--checksum'])
+
+    def test_link_dests(self):
+        plan = self.trsync(link_dest_repos=['repo-sec', 'absent'],
+                           link_dest_depth=2)._push_plan(
+            'repo', snapshots_listing=self.snapshots)
+        self.assertEqual(plan.link_dests,
+                         ['snapshots/repo-latest',
+                          'snapshots/repo-2016-01-07-000000',
+                          'snapshots/repo-2016-01-06-000000',
+                          'snapshots/repo-sec-latest',
+                          'snapshots/repo-sec-2016-01-05-000000'])
+        self.assertEqual(plan.extra[1],
+                         '--link-dest=../repo-2016-01-07-000000')
+
+    def test_resume_plan(self):
+        snapshots = self.snapshots + [
+            ('-rw-r--r--', 'repo-2016-01-07-000000.incomplete', None)]
+        rsync = self.trsync(resumable=True, incomplete_max_age=14 * 86400)
+        plan = rsync._push_plan('repo', snapshots_listing=snapshots)
+        self.assertTrue(plan.resumed)
+        self.assertEqual(plan.resumed_from, 'repo-2016-01-07-000000')
+        # the same name as on the mirrors where the push did not fail
+        self.assertEqual(plan.snapshot_name, 'repo-2016-01-20-000000')
+        self.assertEqual(plan.marker,
+                         'snapshots/repo-2016-01-20-000000.incomplete')
+        self.assertEqual(plan.link_dests[0],
+                         'snapshots/repo-2016-01-07-000000')
+        self.assertEqual(plan.extra[0],
+                         '--link-dest=../repo-2016-01-07-000000')
+        self.assertEqual(len(plan.link_dests), 6)
+        self.assertIn('--partial-dir=.trsync-partial', plan.extra)
+        self.assertEqual(rsync._resumed_paths([plan]),
+                         ['snapshots/repo-2016-01-07-000000',
+                          'snapshots/repo-2016-01-07-000000.incomplete'])
+        plan = self.trsync(resumable=True)._push_plan(
+            'repo', snapshots_listing=snapshots)
+        self.assertFalse(plan.resumed)
+        self.assertEqual(plan.snapshot_name, 'repo-2016-01-20-000000')
+
+    def test_link_dest_limit(self):
+        rsync = self.trsync(link_dest_depth=10)
+        self.assertEqual(len(rsync._link_dests(
+            'repo', 'snapshots/repo-latest', self.snapshots)), 8)
+        plan = rsync._push_plan('repo', snapshots_listing=self.snapshots,
+                                extra=['--link-dest=/x'] * 17)
+        self.assertEqual(len(plan.link_dests), 3)
+        self.assertEqual(len(plan.extra), 20)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015-2016, Mirantis, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import os
+import unittest
+
+from trsync.objects.rsync_mirror import TRsync
+from trsync.utils.tempfiles import TempFiles
+
+
+class TestPushMany(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = TempFiles()
+        self.root = self.temp_dir.last_temp_dir
+        for repo in ('repo1', 'repo2'):
+            os.makedirs(os.path.join(self.root, 'source', repo))
+            with open(os.path.join(self.root, 'source', repo, 'file'),
+                      'w') as outfile:
+                outfile.write(repo)
+
+    def test_push_many_local(self):
+        dest = os.path.join(self.root, 'dest')
+        sources = [(os.path.join(self.root, 'source', _), _)
+                   for _ in ('repo1', 'repo2')]
+        for timestamp in ('2016-01-20-000000', '2016-01-21-000000'):
+            with TRsync(dest, timestamp=timestamp, catalog=False,
+                        engine='hardlink', snapshot_lifetime=None) as rsync:
+                results = rsync.push_many(sources, {'repo2': ['repo2']},
+                                          save_diff=False)
+        self.assertEqual(sorted(results), ['repo1', 'repo2'])
+        self.assertIn('symlinks', results['repo1'].timings)
+        self.assertEqual(results['repo1'].timings['symlinks'],
+                         results['repo2'].timings['symlinks'])
+        self.assertEqual(results['repo2'].stats.linked_file_size, 5)
+        self.assertEqual(os.readlink(os.path.join(dest, 'repo2')),
+                         'snapshots/repo2-2016-01-21-000000')
+        self.assertEqual(
+            os.readlink(os.path.join(dest, 'snapshots/repo1-latest')),
+            'repo1-2016-01-21-000000')
+        self.assertEqual(sorted(os.listdir(os.path.join(dest, 'snapshots'))),
+                         ['repo1-2016-01-21-000000', 'repo1-latest',
+                          'repo1-latest.target.txt',
+                          'repo2-2016-01-21-000000', 'repo2-latest',
+                          'repo2-latest.target.txt'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015-2016, Mirantis, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import os
+import random
+import unittest
+
+from trsync.utils import retry as retry
+from trsync.utils.shell import LogTail
+from trsync.utils.shell import Shell
+from trsync.utils.tempfiles import TempFiles
+
+
+class TestRetryPolicy(unittest.TestCase):
+
+    def test_delays(self):
+        policy = retry.RetryPolicy(attempts=5, backoff=1, max_backoff=5,
+                                   jitter=0)
+        self.assertEqual([policy.delay(_) for _ in range(1, 6)],
+                         [1, 2, 4, 5, 5])
+
+    def test_jitter(self):
+        policy = retry.RetryPolicy(attempts=3, backoff=2, jitter=0.5,
+                                   rand=random.Random(1))
+        delays = [policy.delay(1) for _ in range(100)]
+        self.assertTrue(all([1 <= _ <= 3 for _ in delays]))
+        self.assertGreater(len(set(delays)), 1)
+
+    def test_next_delay(self):
+        policy = retry.RetryPolicy(attempts=3, jitter=0)
+        self.assertEqual(policy.next_delay(1, 23), 1)
+        self.assertEqual(policy.next_delay(2, 10), 2)
+        self.assertIsNone(policy.next_delay(3, 10))
+        self.assertIsNone(policy.next_delay(1, 0))
+        self.assertIsNone(policy.next_delay(1, 1))
+        self.assertIsNone(retry.RetryPolicy().next_delay(1, 23))
+
+    def test_excluding(self):
+        policy = retry.RetryPolicy(attempts=3).excluding(
+            *retry.PARTIAL_TRANSFER)
+        self.assertEqual(policy.attempts, 3)
+        self.assertFalse(policy.retryable(23))
+        self.assertTrue(policy.retryable(30))
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, retry.RetryPolicy, attempts=0)
+        self.assertRaises(ValueError, retry.RetryPolicy, jitter=2)
+
+
+class TestShellRetry(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = TempFiles()
+        self.counter = os.path.join(self.temp_dir.last_temp_dir, 'counter')
+        self.policy = retry.RetryPolicy(attempts=3, backoff=0, jitter=0)
+
+    def tearDown(self):
+        self.temp_dir.close()
+
+    def flaky(self, failures, exitcode=23):
+        '''Returns command failing the first failures runs'''
+        return 'echo run >> {0}; echo out; ' \
+               'test $(wc -l < {0}) -gt {1} || exit {2}' \
+               ''.format(self.counter, failures, exitcode)
+
+    def test_retried(self):
+        result = Shell(retry=self.policy).shell(self.flaky(2))
+        self.assertEqual(result, (0, 'out\n', ''))
+        self.assertEqual([_.exitcode for _ in result.attempts], [23, 23, 0])
+        self.assertEqual([_.delay for _ in result.attempts], [0, 0, None])
+
+    def test_exhausted(self):
+        result = Shell(retry=self.policy).shell(self.flaky(5),
+                                                raise_error=False)
+        self.assertEqual(result.exitcode, 23)
+        self.assertEqual(len(result.attempts), 3)
+        self.assertRaises(RuntimeError, Shell(retry=self.policy).shell,
+                          self.flaky(10))
+
+    def test_not_transient(self):
+        result = Shell(retry=self.policy).shell(self.flaky(1, exitcode=1),
+                                                raise_error=False)
+        self.assertEqual(result.exitcode, 1)
+        self.assertEqual(len(result.attempts), 1)
+
+    def test_per_command(self):
+        result = Shell().shell(self.flaky(1), retry=self.policy)
+        self.assertEqual(len(result.attempts), 2)
+        result = Shell(retry=self.policy).shell(
+            self.flaky(5), raise_error=False,
+            retry=self.policy.excluding(23))
+        self.assertEqual(len(result.attempts), 1)
+
+    def test_consumers_reset(self):
+        tail = LogTail()
+        result = Shell(retry=self.policy).shell(self.flaky(2),
+                                                consumers=[tail])
+        self.assertEqual(len(result.attempts), 3)
+        self.assertEqual((tail.text, tail.lines_number), ('out\n', 1))
+
+    def test_consumers_without_reset(self):
+
+        class Lines(list):
+            feed = list.append
+
+            def close(self):
+                pass
+
+        lines = Lines()
+        result = Shell(retry=self.policy).shell(
+            self.flaky(2), raise_error=False, consumers=[lines])
+        self.assertEqual((result.exitcode, len(result.attempts)), (23, 1))
+        self.assertEqual(lines, ['out\n'])
+
+
+if __name__ == '__main__':
+    unittest.main()
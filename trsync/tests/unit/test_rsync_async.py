@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015-2016, Mirantis, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import os
+import sys
+import unittest
+
+from trsync.utils.tempfiles import TempFiles
+
+
+@unittest.skipIf(sys.version_info < (3, 5), 'asyncio is required')
+class TestAsyncRsyncOps(unittest.TestCase):
+
+    def test_start_master(self):
+        import asyncio
+        from trsync.objects.rsync_async import AsyncRsyncOps
+        loop = asyncio.get_event_loop()
+        # the master which takes a second to fail
+        ops = AsyncRsyncOps('user@host:/mirror/',
+                            ssh_command='sh -c "sleep 1; exit 1" --')
+        # the timer is late if the loop is blocked by the master
+        started, fired = loop.time(), list()
+        loop.call_later(0.1, lambda: fired.append(loop.time() - started))
+        loop.run_until_complete(ops._start_master())
+        self.assertLess(fired[0], 0.5)
+        self.assertFalse(ops.ssh_master.started)
+        self.assertEqual(ops._rsh_args()[1].split()[:2], ['sh', '-c'])
+        ops.close()
+
+
+@unittest.skipIf(sys.version_info < (3, 5), 'asyncio is required')
+class TestAsyncTRsync(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = TempFiles()
+        self.root = self.temp_dir.last_temp_dir
+        self.source = os.path.join(self.root, 'source')
+        os.makedirs(os.path.join(self.source, 'dir'))
+        with open(os.path.join(self.source, 'dir', 'file'), 'w') as outfile:
+            outfile.write('data')
+        self.mirror = os.path.join(self.root, 'mirror')
+
+    def tearDown(self):
+        self.temp_dir.close()
+
+    def run_async(self, coroutine):
+        import asyncio
+        return asyncio.get_event_loop().run_until_complete(coroutine)
+
+    def test_ops(self):
+        from trsync.objects.rsync_async import AsyncLocalOps
+        from trsync.objects.rsync_async import AsyncRsyncOps
+        from trsync.objects.rsync_async import AsyncTRsync
+        with AsyncTRsync(self.mirror) as rsync:
+            self.assertIs(type(rsync.rsync), AsyncLocalOps)
+        with AsyncTRsync(self.mirror, rsync_extra_params='--dry-run') as rsync:
+            self.assertIs(type(rsync.rsync), AsyncRsyncOps)
+
+    def test_hardlink_engine(self):
+        from trsync.objects.rsync_async import AsyncTRsync
+        with AsyncTRsync(self.mirror, timestamp='2016-01-20-000000',
+                         catalog=False, engine='hardlink',
+                         snapshot_lifetime=None) as rsync:
+            result = self.run_async(rsync.push(self.source, 'repo',
+                                               save_diff=False))
+        snapshot = os.path.join(self.mirror,
+                                'snapshots/repo-2016-01-20-000000')
+        self.assertEqual(result.snapshot, 'snapshots/repo-2016-01-20-000000')
+        self.assertEqual(result.attempts, [])
+        with open(os.path.join(snapshot, 'dir', 'file')) as infile:
+            self.assertEqual(infile.read(), 'data')
+        self.assertEqual(os.readlink(os.path.join(self.mirror,
+                                                  'snapshots/repo-latest')),
+                         'repo-2016-01-20-000000')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -160,6 +160,33 @@ class TestRsyncUrl(unittest.TestCase):
                                   default_flow_style=False))
             self.assertEqual(url.path_relative(par), er)
 
+    def test_value_type(self):
+        url = rsync_url.RsyncUrl('rsync://host/module/path')
+        same = rsync_url.RsyncUrl('rsync://host/module/path')
+        self.assertEqual(url, same)
+        self.assertEqual(len(set([url, same])), 1)
+        self.assertNotEqual(url, rsync_url.RsyncUrl('rsync://host/module'))
+        self.assertRaises(AttributeError, setattr, url, '_url', '/path')
+        self.assertEqual(url.url, 'rsync://host/module/path')
+
+    def test_parse_cache(self):
+        cache_size = rsync_url.RsyncUrl.cache_size
+        rsync_url.RsyncUrl.cache_size = 2
+        try:
+            for remote in ('/first', '/second', '/third', '/second'):
+                rsync_url.RsyncUrl(remote)
+            self.assertEqual(list(rsync_url.RsyncUrl._cache)[-2:],
+                             ['/third', '/second'])
+            self.assertNotIn('/first', rsync_url.RsyncUrl._cache)
+        finally:
+            rsync_url.RsyncUrl.cache_size = cache_size
+
+    def test_squash_slashes(self):
+        for path, expected in (('//a//b', '/a/b'),
+                               ('rsync://h//m', 'rsync://h/m'),
+                               ('a////b', 'a///b')):
+            self.assertEqual(rsync_url._squash_slashes(path), expected)
+
 
 cpath, cname = os.path.split(os.path.realpath(os.path.realpath(__file__)))
 cname = cname.split('.')
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015-2016, Mirantis, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import os
+import unittest
+
+from trsync.objects.source_cache import SourceCache
+from trsync.utils.tempfiles import TempFiles
+
+
+class TestSourceCache(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = TempFiles()
+        self.cache_dir = os.path.join(self.temp_dir.last_temp_dir, 'cache')
+        self.cache = SourceCache(self.cache_dir, max_size=None)
+
+    def tearDown(self):
+        self.cache.close()
+        self.temp_dir.close()
+
+    def generation(self, source, name, files, link_from=None):
+        '''Creates generation of source with files {name: size}'''
+        path = os.path.join(self.cache.source_dir(source), name)
+        os.makedirs(path)
+        for filename, size in files.items():
+            if link_from is not None:
+                os.link(os.path.join(self.cache.source_dir(source),
+                                     link_from, filename),
+                        os.path.join(path, filename))
+                continue
+            with open(os.path.join(path, filename), 'w') as outfile:
+                outfile.write('x' * size)
+        self.cache._switch_latest(self.cache.source_dir(source), name)
+        return path
+
+    def test_local_in_place(self):
+        self.assertEqual(self.cache.stage('/srv/repo'), '/srv/repo')
+        self.assertFalse(os.path.exists(self.cache_dir))
+        self.assertEqual(self.cache.sources([('/srv/repo', 'repo')]),
+                         [('/srv/repo', 'repo')])
+
+    def test_source_dir(self):
+        first = self.cache.source_dir('rsync://host/module/repo/')
+        self.assertEqual(os.path.dirname(first), self.cache_dir)
+        self.assertTrue(os.path.basename(first).startswith(
+            'rsync_host_module_repo-'))
+        self.assertNotEqual(first,
+                            self.cache.source_dir('rsync://host/module/repo'))
+
+    def test_generations(self):
+        source_dir = self.cache.source_dir('rsync://host/repo')
+        self.generation('rsync://host/repo', '2016-01-01-000000', {'a': 1})
+        self.generation('rsync://host/repo', '2016-01-02-000000', {'a': 1})
+        os.makedirs(os.path.join(source_dir, '.incoming-xyz'))
+        self.assertEqual(self.cache.generations(source_dir),
+                         ['2016-01-01-000000', '2016-01-02-000000'])
+        self.assertEqual(os.readlink(os.path.join(source_dir, 'latest')),
+                         '2016-01-02-000000')
+        self.assertGreater(SourceCache._new_generation(source_dir),
+                           '2016-01-02-000000')
+
+    def test_size_counts_hardlinks_once(self):
+        source = 'rsync://host/repo'
+        self.generation(source, '2016-01-01-000000', {'a': 10, 'b': 5})
+        self.generation(source, '2016-01-02-000000', {'a': 10, 'b': 5},
+                        link_from='2016-01-01-000000')
+        self.assertEqual(self.cache.size(), 15)
+
+    def test_evict(self):
+        old = self.generation('rsync://host/old', '2016-01-01-000000',
+                              {'a': 100})
+        previous = self.generation('rsync://host/repo', '2016-01-02-000000',
+                                   {'shared': 10, 'gone': 50})
+        os.link(os.path.join(previous, 'shared'),
+                os.path.join(self.temp_dir.last_temp_dir, 'shared'))
+        current = self.generation('rsync://host/repo', '2016-01-03-000000',
+                                  {'new': 20})
+        os.link(os.path.join(self.temp_dir.last_temp_dir, 'shared'),
+                os.path.join(current, 'shared'))
+        self.cache._staged['rsync://host/repo'] = current
+        self.assertEqual(self.cache.size(), 180)
+
+        self.cache.max_size = 150
+        # the previous generation of staged source goes first
+        self.assertEqual(self.cache.evict(), [previous])
+        self.assertTrue(os.path.isdir(old))
+        self.assertEqual(self.cache.size(), 130)
+
+        self.cache.max_size = 10
+        # then the sources not in use, staged one is kept anyway
+        self.assertEqual(self.cache.evict(),
+                         [self.cache.source_dir('rsync://host/old')])
+        self.assertTrue(os.path.isdir(current))
+        self.assertEqual(self.cache.size(), 30)
+
+    def test_no_limit(self):
+        self.generation('rsync://host/repo', '2016-01-01-000000', {'a': 10})
+        self.assertEqual(self.cache.evict(), [])
+
+    def test_keep(self):
+        self.assertRaises(ValueError, SourceCache, self.cache_dir, keep=0)
+
+
+if __name__ == '__main__':
+    unittest.main()
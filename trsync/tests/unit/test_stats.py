@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015-2016, Mirantis, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import unittest
+
+from trsync.objects.rsync_remote import PushResult
+from trsync.utils.retry import Attempt
+from trsync.utils.stats import StatsParser
+from trsync.utils.stats import linked_file_size
+
+
+class TestStats(unittest.TestCase):
+
+    output = [
+        'sending incremental file list\n',
+        '\n',
+        'Number of files: 1,205 (reg: 1,100, dir: 105)\n',
+        'Number of created files: 3 (reg: 3)\n',
+        'Number of deleted files: 0\n',
+        'Number of regular files transferred: 3\n',
+        'Total file size: 12,345,678 bytes\n',
+        'Total transferred file size: 4,096 bytes\n',
+        'Literal data: 4,000 bytes\n',
+        'Matched data: 96 bytes\n',
+        'File list size: 0\n',
+        'File list generation time: 0.001 seconds\n',
+        'File list transfer time: 0.000 seconds\n',
+        'Total bytes sent: 40,321\n',
+        'Total bytes received: 125\n',
+        '\n',
+        'sent 40,321 bytes  received 125 bytes  80,892.00 bytes/sec\n',
+        'total size is 12,345,678  speedup is 305.23\n',
+    ]
+
+    def test_stats_parser(self):
+        parser = StatsParser()
+        for line in self.output:
+            parser.feed(line)
+        parser.close()
+        self.assertEqual(parser.stats.files, 1205)
+        self.assertEqual(parser.stats.files_transferred, 3)
+        self.assertEqual(parser.stats.total_file_size, 12345678)
+        self.assertEqual((parser.stats.literal_data,
+                          parser.stats.matched_data), (4000, 96))
+        self.assertEqual((parser.stats.bytes_sent,
+                          parser.stats.bytes_received), (40321, 125))
+        self.assertEqual(parser.stats.file_list_generation_time, 0.001)
+        self.assertEqual(parser.stats.speedup, 305.23)
+
+    def test_stats_parser_old_rsync(self):
+        parser = StatsParser()
+        for line in ['Number of files transferred: 7\n',
+                     'total size is 100  speedup is 1.00 (DRY RUN)\n']:
+            parser.feed(line)
+        self.assertEqual(dict(parser.stats),
+                         {'files_transferred': 7, 'speedup': 1.0})
+
+    def test_linked_file_size(self):
+        self.assertEqual(linked_file_size(
+            {'total_file_size': 100, 'transferred_file_size': 30}), 70)
+        self.assertIsNone(linked_file_size({'total_file_size': 100}))
+
+    def test_push_result(self):
+        result = PushResult('out\n', changes=[], timings={'transfer': 1.5})
+        self.assertEqual(result, 'out\n')
+        self.assertEqual(result.output, 'out\n')
+        self.assertEqual(result.metrics(),
+                         {'stats': {}, 'timings': {'transfer': 1.5},
+                          'changes': 0})
+
+    def test_push_result_attempts(self):
+        result = PushResult('out\n', attempts=[Attempt(23, 2.0, 1.5),
+                                               Attempt(0, 3.0, None)])
+        self.assertEqual(result.metrics()['attempts'],
+                         [{'exitcode': 23, 'duration': 2.0, 'delay': 1.5},
+                          {'exitcode': 0, 'duration': 3.0, 'delay': None}])
+
+
+if __name__ == '__main__':
+    unittest.main()
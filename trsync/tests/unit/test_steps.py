@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015-2016, Mirantis, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import sys
+import unittest
+
+from trsync.utils.steps import Result
+from trsync.utils.steps import run_steps
+
+
+def fail():
+    raise RuntimeError('failed')
+
+
+def double(value):
+    result = yield lambda: value * 2
+    yield Result(result)
+
+
+def transaction(log):
+    undo = list()
+    try:
+        value = yield double(3)
+        log.append(value)
+        undo.append(lambda: log.append('undo'))
+        yield lambda: double(value)
+        yield fail
+        log.append('not reached')
+    except RuntimeError as e:
+        for func in reversed(undo):
+            yield func
+        raise e
+
+
+class TestSteps(unittest.TestCase):
+
+    def test_result(self):
+        self.assertEqual(run_steps(double(2)), 4)
+        # the generator is closed by the result
+        log = list()
+
+        def early():
+            try:
+                yield Result(1)
+                log.append('not reached')
+            finally:
+                log.append('closed')
+
+        self.assertEqual(run_steps(early()), 1)
+        self.assertEqual(log, ['closed'])
+
+    def test_no_result(self):
+        def steps():
+            yield lambda: None
+
+        self.assertIsNone(run_steps(steps()))
+
+    def test_error(self):
+        log = list()
+        self.assertRaises(RuntimeError, run_steps, transaction(log))
+        self.assertEqual(log, [6, 'undo'])
+
+    @unittest.skipIf(sys.version_info < (3, 5), 'asyncio is required')
+    def test_async(self):
+        import asyncio
+        from trsync.utils.steps_async import run_steps as run_async
+
+        log = list()
+
+        def steps():
+            yield lambda: asyncio.sleep(0)
+            result = yield transaction(log)
+            yield Result(result)
+
+        loop = asyncio.get_event_loop()
+        self.assertEqual(loop.run_until_complete(run_async(double(2))), 4)
+        self.assertRaises(RuntimeError, loop.run_until_complete,
+                          run_async(steps()))
+        self.assertEqual(log, [6, 'undo'])
+
+
+if __name__ == '__main__':
+    unittest.main()
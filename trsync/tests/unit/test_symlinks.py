@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015-2016, Mirantis, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import unittest
+
+from trsync.utils.symlinks import SymlinkResolver
+
+
+class TestSymlinkResolver(unittest.TestCase):
+
+    # stable -> release -> snapshots/repo-latest -> repo-2016-01-02-030405
+    listing = {
+        'stable': ('lrwxrwxrwx', 'release'),
+        'release': ('lrwxrwxrwx', 'snapshots/repo-latest'),
+        'snapshots/repo-latest': ('lrwxrwxrwx', 'repo-2016-01-02-030405'),
+        'snapshots/repo-2016-01-02-030405': ('drwxr-xr-x', None),
+        'snapshots/old': ('lrwxrwxrwx', '../release/'),
+        'outside': ('lrwxrwxrwx', '../../srv'),
+        'loop1': ('lrwxrwxrwx', 'loop2'),
+        'loop2': ('lrwxrwxrwx', 'loop1'),
+    }
+
+    def resolve(self, resolver, symlinks, recursive=True):
+        listed = list()
+        paths = resolver.pending(symlinks, recursive)
+        while paths:
+            listed.append(paths)
+            resolver.add_listing(paths, self.listing)
+            paths = resolver.pending(symlinks, recursive)
+        return listed
+
+    def test_resolve_many(self):
+        resolver = SymlinkResolver()
+        listed = self.resolve(resolver, ['stable', 'snapshots/old'])
+        self.assertEqual(listed, [['snapshots/old', 'stable'],
+                                  ['release'],
+                                  ['snapshots/repo-latest'],
+                                  ['snapshots/repo-2016-01-02-030405']])
+        for symlink in ('stable', 'snapshots/old'):
+            self.assertEqual(resolver.target(symlink),
+                             'snapshots/repo-2016-01-02-030405')
+
+    def test_memoized(self):
+        resolver = SymlinkResolver()
+        self.resolve(resolver, ['release'])
+        self.assertEqual(self.resolve(resolver, ['stable']), [['stable']])
+
+    def test_not_recursive(self):
+        resolver = SymlinkResolver()
+        self.assertEqual(self.resolve(resolver, ['stable'], False),
+                         [['stable']])
+        self.assertEqual(resolver.target('stable', recursive=False),
+                         'release')
+
+    def test_final(self):
+        resolver = SymlinkResolver()
+        self.resolve(resolver, ['outside', 'missing'])
+        self.assertEqual(resolver.target('outside'), '../../srv')
+        self.assertEqual(resolver.target('missing'), 'missing')
+
+    def test_loop(self):
+        resolver = SymlinkResolver()
+        self.resolve(resolver, ['loop1'])
+        with self.assertRaises(RuntimeError) as context:
+            resolver.target('loop1')
+        self.assertIn('loop1 -> loop2 -> loop1', str(context.exception))
+        self.assertEqual(resolver.target('loop1', recursive=False), 'loop2')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015-2016, Mirantis, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import os
+import unittest
+
+from trsync.utils.tempfiles import TempFiles
+
+
+class TestTempFiles(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = TempFiles()
+
+    def tearDown(self):
+        self.tmp.close()
+
+    def test_root_is_lazy(self):
+        self.assertIsNone(self.tmp._root)
+        temp_dir = self.tmp.get_temp_dir('a/b')
+        self.assertEqual(os.path.dirname(temp_dir), self.tmp.root)
+        self.assertTrue(os.path.isdir(os.path.join(temp_dir, 'a/b')))
+
+    def test_operation_recycles(self):
+        with self.tmp.operation() as temp_dirs:
+            first = self.tmp.get_temp_dir('sub')
+            self.tmp.get_file('data', temp_dir=first)
+            self.assertEqual(temp_dirs, [first])
+        self.assertEqual(os.listdir(first), [])
+        with self.tmp.operation():
+            self.assertEqual(self.tmp.get_temp_dir(), first)
+        self.assertEqual((self.tmp.created, self.tmp.reused), (1, 1))
+        self.assertEqual(os.listdir(self.tmp.root), [os.path.basename(first)])
+
+    def test_nested_operations(self):
+        with self.tmp.operation():
+            outer = self.tmp.get_temp_dir()
+            with self.tmp.operation():
+                inner = self.tmp.get_temp_dir()
+            self.assertEqual(self.tmp._free, [inner])
+        self.assertEqual(sorted(self.tmp._free), sorted([inner, outer]))
+
+    def test_outside_operation_kept(self):
+        kept = self.tmp.get_temp_dir()
+        filename = self.tmp.get_file('data', temp_dir=kept)
+        with self.tmp.operation():
+            self.assertNotEqual(self.tmp.get_temp_dir(), kept)
+        self.assertTrue(os.path.isfile(filename))
+        self.tmp.recycle(kept)
+        self.tmp.recycle(kept)
+        self.assertFalse(os.path.exists(filename))
+        self.assertEqual(self.tmp._free.count(kept), 1)
+
+    def test_empty_dir_not_recycled(self):
+        empty_dir = self.tmp.empty_dir
+        with self.tmp.operation():
+            self.assertNotEqual(self.tmp.get_temp_dir(), empty_dir)
+        self.tmp.recycle(empty_dir)
+        self.assertNotIn(empty_dir, self.tmp._free)
+        self.assertEqual(self.tmp.empty_dir, empty_dir)
+
+    def test_footprint(self):
+        self.assertEqual(self.tmp.footprint(), 0)
+        with self.tmp.operation():
+            temp_dir = self.tmp.get_temp_dir()
+            self.tmp.get_file('x' * 1000, temp_dir=temp_dir)
+            self.assertEqual(self.tmp.footprint(), 1000)
+        self.assertEqual(self.tmp.peak_footprint, 1000)
+        self.assertEqual(self.tmp.footprint(), 0)
+
+    def test_footprint_of_recycled(self):
+        # the kept directories are not measured by recycling
+        kept = self.tmp.get_temp_dir()
+        self.tmp.get_file('x' * 5000, temp_dir=kept)
+        with self.tmp.operation():
+            temp_dir = self.tmp.get_temp_dir()
+            self.tmp.get_file('x' * 1000, temp_dir=temp_dir)
+        self.assertEqual(self.tmp.peak_footprint, 1000)
+        self.assertEqual(self.tmp.footprint(), 5000)
+
+    def test_close(self):
+        with TempFiles() as tmp:
+            root = tmp.root
+            tmp.get_temp_dir()
+            last_temp_dir = tmp.last_temp_dir
+        self.assertFalse(os.path.exists(root))
+        self.assertNotEqual(tmp.last_temp_dir, last_temp_dir)
+        self.assertNotEqual(tmp.root, root)
+        tmp.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
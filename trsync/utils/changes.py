@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015-2016, Mirantis, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import collections
+import datetime
+import gzip
+import json
+import re
+
+
+# itemized changes (%i), size, mtime, name (%n%L is the last, so "|" in
+# names does not break the parsing)
+OUT_FORMAT = '%i|%l|%M|%n%L'
+ITEMIZE_OPTS = ['--out-format={}'.format(OUT_FORMAT)]
+
+KINDS = {
+    'f': 'file',
+    'd': 'dir',
+    'L': 'symlink',
+    'D': 'device',
+    'S': 'special',
+}
+
+_LINE_RE = re.compile(r'^([<>ch.*][^|]*)\|(\d*)\|([^|]*)\|(.*)$')
+
+
+class ChangeRecord(collections.namedtuple(
+        'ChangeRecord', ['path', 'change', 'kind', 'size', 'mtime', 'item'])):
+    '''Change of single path made by rsync
+
+    change is one of "created", "updated", "attributes" (only attributes
+    are changed), "hardlinked" and "deleted". size and mtime (ISO 8601) are
+    None for deleted paths, item is the raw rsync itemize string.
+    '''
+    __slots__ = ()
+
+    def to_dict(self):
+        return dict(self._asdict())
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(**data)
+
+
+def _change(item):
+    if item.startswith('*'):
+        return 'deleted'
+    if item[0] == 'h':
+        return 'hardlinked'
+    if item[2:] and item[2:].strip('+') == '':
+        return 'created'
+    if item[0] == '.':
+        return 'attributes'
+    return 'updated'
+
+
+def _mtime(value):
+    try:
+        return datetime.datetime.strptime(
+            value, '%Y/%m/%d-%H:%M:%S').isoformat()
+    except ValueError:
+        return None
+
+
+def parse_line(line):
+    '''Returns (ChangeRecord, legacy line) for rsync --out-format line
+
+    legacy line is the same line printed by rsync -v. Returns None if the
+    line is not itemized change (rsync messages, summary, etc.).
+    '''
+    match = _LINE_RE.match(line.rstrip('\n'))
+    if match is None:
+        return None
+    item, size, mtime, name = match.groups()
+    item = item.rstrip()
+    kind = KINDS.get(item[1:2], 'file') if not item.startswith('*') \
+        else None
+    path = name
+    if kind == 'symlink' and ' -> ' in path:
+        path = path.split(' -> ', 1)[0]
+    elif item[0] == 'h' and ' => ' in path:
+        path = path.split(' => ', 1)[0]
+    change = _change(item)
+    if change == 'deleted':
+        kind = 'dir' if path.endswith('/') else None
+        size, mtime, legacy = None, None, 'deleting {}'.format(name)
+    else:
+        size = int(size) if size else None
+        mtime, legacy = _mtime(mtime), name
+    record = ChangeRecord(path=path.rstrip('/') or path, change=change,
+                          kind=kind, size=size, mtime=mtime, item=item)
+    return record, legacy + '\n'
+
+
+class ItemizeParser(object):
+    '''Consumer of rsync output produced with ITEMIZE_OPTS
+
+    Itemized lines are parsed to ChangeRecords passed to record_consumers,
+    all the output with itemized lines rendered as rsync -v prints them is
+    passed to consumers.
+    '''
+
+    def __init__(self, consumers=(), record_consumers=()):
+        self._consumers = list(consumers)
+        self._record_consumers = list(record_consumers)
+
+    def feed(self, line):
+        parsed = parse_line(line)
+        if parsed is not None:
+            record, line = parsed
+            for consumer in self._record_consumers:
+                consumer.feed(record)
+        for consumer in self._consumers:
+            consumer.feed(line)
+
+    def close(self):
+        for consumer in self._consumers + self._record_consumers:
+            consumer.close()
+
+    def reset(self):
+        for consumer in self._consumers + self._record_consumers:
+            consumer.reset()
+
+
+class ChangeRecords(list):
+    '''Collects ChangeRecords'''
+
+    def feed(self, record):
+        self.append(record)
+
+    def close(self):
+        pass
+
+    def reset(self):
+        del self[:]
+
+
+class ChangesWriter(object):
+    '''Writes ChangeRecords to the compressed JSON lines file'''
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.records_number = 0
+        self._file = gzip.open(filename, 'wb')
+
+    def feed(self, record):
+        self._file.write((json.dumps(record.to_dict(), sort_keys=True) +
+                          '\n').encode('utf-8'))
+        self.records_number += 1
+
+    def close(self):
+        self._file.close()
+
+    def reset(self):
+        self._file.close()
+        self.records_number = 0
+        self._file = gzip.open(self.filename, 'wb')
+
+
+def read_changes(filename):
+    '''Yields ChangeRecords from the file written by ChangesWriter'''
+    with gzip.open(filename, 'rb') as infile:
+        for line in infile:
+            line = line.decode('utf-8').strip()
+            if line:
+                yield ChangeRecord.from_dict(json.loads(line))
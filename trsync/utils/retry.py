@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015-2016, Mirantis, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import collections
+import random
+
+
+# rsync exit codes of failures which may pass by themselves (see EXIT
+# VALUES in rsync(1))
+RSYNC_TRANSIENT = {
+    5: 'Error starting client-server protocol',
+    10: 'Error in socket I/O',
+    12: 'Error in rsync protocol data stream',
+    23: 'Partial transfer due to error',
+    24: 'Partial transfer due to vanished source files',
+    30: 'Timeout in data send/receive',
+    35: 'Timeout waiting for daemon connection',
+}
+# exit codes of failed connections (255 is returned by rsync when the
+# remote shell exits unexpectedly)
+RSYNC_UNREACHABLE = (5, 10, 12, 30, 35, 255)
+# partial transfer codes are also returned for missing source paths, which
+# is the expected answer of listings and lookups
+PARTIAL_TRANSFER = (23, 24)
+
+
+class Attempt(collections.namedtuple(
+        'Attempt', ['exitcode', 'duration', 'delay'])):
+    '''Single run of the command
+
+    duration is seconds of the run, delay is seconds waited before the
+    next attempt (None if the command was not retried after it).
+    '''
+    __slots__ = ()
+
+    def to_dict(self):
+        return dict(self._asdict())
+
+
+class RetryPolicy(object):
+    '''Retries of commands failed with transient exit codes
+
+    The command is run up to attempts times while it exits with one of
+    exitcodes (RSYNC_TRANSIENT by default). After failed attempt n it waits
+    backoff * factor ** (n - 1) seconds (at most max_backoff), the delay is
+    randomly changed by up to jitter share of it, so the clients failed at
+    the same time do not retry at the same time. The default policy makes
+    single attempt.
+    '''
+
+    def __init__(self, attempts=1, backoff=1.0, factor=2.0, max_backoff=60.0,
+                 jitter=0.5, exitcodes=None, rand=None):
+        if attempts < 1:
+            raise ValueError('At least one attempt is required, got {}'
+                             ''.format(attempts))
+        if not 0 <= jitter <= 1:
+            raise ValueError('jitter should be in [0, 1], got {}'
+                             ''.format(jitter))
+        self.attempts = attempts
+        self.backoff = backoff
+        self.factor = factor
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        if exitcodes is None:
+            exitcodes = RSYNC_TRANSIENT
+        self.exitcodes = frozenset(exitcodes)
+        self._random = rand or random.Random()
+
+    def __repr__(self):
+        return '{}(attempts={}, backoff={}, factor={}, max_backoff={}, ' \
+               'jitter={}, exitcodes={})'.format(
+                   self.__class__.__name__, self.attempts, self.backoff,
+                   self.factor, self.max_backoff, self.jitter,
+                   sorted(self.exitcodes))
+
+    def retryable(self, exitcode):
+        return exitcode in self.exitcodes
+
+    def delay(self, attempt):
+        '''Returns seconds to wait after failed attempt (counted from 1)'''
+        delay = min(self.max_backoff,
+                    self.backoff * self.factor ** (attempt - 1))
+        if self.jitter:
+            delay *= self._random.uniform(1 - self.jitter, 1 + self.jitter)
+        return max(0.0, delay)
+
+    def next_delay(self, attempts, exitcode):
+        '''Returns delay before the next attempt or None to stop
+
+        attempts is the number of attempts made, exitcode is the result
+        of the last one.
+        '''
+        if exitcode == 0 or attempts >= self.attempts or \
+                not self.retryable(exitcode):
+            return None
+        return self.delay(attempts)
+
+    def excluding(self, *exitcodes):
+        '''Returns the same policy which does not retry exitcodes'''
+        return self.__class__(attempts=self.attempts,
+                              backoff=self.backoff,
+                              factor=self.factor,
+                              max_backoff=self.max_backoff,
+                              jitter=self.jitter,
+                              exitcodes=self.exitcodes - set(exitcodes),
+                              rand=self._random)
@@ -15,35 +15,362 @@
 # under the License.
 
 
+import collections
+import contextlib
+import os
+import signal
 import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+try:
+    from shlex import quote
+except ImportError:
+    from pipes import quote
+
 from trsync.utils import utils as utils
 
+from trsync.utils.retry import Attempt
+from trsync.utils.retry import RetryPolicy
+
+
+def cmd_to_str(cmd):
+    '''Returns printable form of the command (string or argument vector)'''
+    if isinstance(cmd, (list, tuple)):
+        return ' '.join([quote(_) for _ in cmd])
+    return cmd
+
+
+class LogTail(object):
+    '''Keeps last maxlen lines of the output'''
+
+    def __init__(self, maxlen=1000):
+        self._lines = collections.deque(maxlen=maxlen)
+        self.maxlen = maxlen
+        self.lines_number = 0
+
+    def feed(self, line):
+        self._lines.append(line)
+        self.lines_number += 1
+
+    def close(self):
+        pass
+
+    def reset(self):
+        self._lines.clear()
+        self.lines_number = 0
+
+    @property
+    def text(self):
+        return ''.join(self._lines)
+
+    @property
+    def truncated(self):
+        return self.lines_number > len(self._lines)
+
+
+class FileWriter(object):
+    '''Writes the output to the file'''
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._file = open(filename, 'w')
+
+    def feed(self, line):
+        self._file.write(line)
+
+    def close(self):
+        self._file.close()
+
+    def reset(self):
+        self._file.close()
+        self._file = open(self.filename, 'w')
+
+
+class ProgressLogger(object):
+    '''Logs number of processed lines every "every" lines'''
+
+    def __init__(self, logger, every=10000):
+        self._logger = logger
+        self._every = every
+        self.lines_number = 0
+
+    def feed(self, line):
+        self.lines_number += 1
+        if self.lines_number % self._every == 0:
+            self._logger.info('{} lines of output processed'
+                              ''.format(self.lines_number))
+
+    def close(self):
+        self._logger.debug('{} lines of output processed'
+                           ''.format(self.lines_number))
+
+    def reset(self):
+        self.lines_number = 0
+
+
+class ShellResult(tuple):
+    '''(exitcode, stdout, stderr) of the command
+
+    attempts is the list of retry.Attempt, one per run of the command.
+    '''
+
+    def __new__(cls, exitcode, out, err, attempts=None):
+        result = super(ShellResult, cls).__new__(cls, (exitcode, out, err))
+        result.attempts = list(attempts or [])
+        return result
+
+    @property
+    def exitcode(self):
+        return self[0]
+
+
+class DeadlineExceeded(RuntimeError):
+    '''The command is killed because its deadline expired'''
+
+
+class Deadline(object):
+    '''Time limit of the operation made by several commands
+
+    The command running when the deadline expires is killed and
+    DeadlineExceeded is raised, as well as for the commands started later.
+    The commands started after the expiration (rollback of the operation)
+    are given grace seconds more.
+    '''
+
+    def __init__(self, seconds, grace=60):
+        self.seconds = seconds
+        self.grace = grace
+        self.expires_at = time.time() + seconds
+        self.expired = False
+
+    def remaining(self):
+        '''Returns seconds left for the commands'''
+        end = self.expires_at
+        if self.expired:
+            end += self.grace
+        return end - time.time()
+
+    def expire(self):
+        '''Marks the deadline expired, the grace period starts now'''
+        if not self.expired:
+            self.expired = True
+            self.expires_at = min(self.expires_at, time.time())
+
 
 class Shell(object):
 
-    def __init__(self, logger=None):
+    def __init__(self, logger=None, retry=None, deadline=None):
+        '''Runs commands
+
+        retry is RetryPolicy of all the commands. If deadline (Deadline)
+        is specified, the commands are run in their own process groups,
+        which are killed when it expires.
+        '''
         if logger is None:
             self.logger = utils.logger.getChild('Shell')
         else:
             self.logger = logger.getChild('Shell')
+        self.retry = retry if retry is not None else RetryPolicy()
+        self.deadline = deadline
+
+    def shell(self, cmd, raise_error=True, stdin=None, consumers=None,
+              retry=None):
+        '''Runs cmd, returns ShellResult (exitcode, stdout, stderr)
+
+        cmd may be argument vector (executed directly) or string (executed
+        by /bin/sh). If consumers (objects with feed(line) and close()
+        methods) are specified, stdout is passed to them line by line during
+        the execution and only the tail of stdout is returned.
 
-    def shell(self, cmd, raise_error=True):
-        self.logger.debug(cmd)
+        The command failed with transient exit code is run again according
+        to retry (RetryPolicy of the object by default). Consumers are
+        reset() before the next attempt, so the command streamed to
+        consumers without reset() is not retried. Raises DeadlineExceeded
+        (regardless of raise_error) if the deadline expires.
+        '''
+        retry = self.retry if retry is None else retry
+        attempts = list()
+        while True:
+            started = time.time()
+            exitcode, out, err = self._attempt(cmd, stdin, consumers)
+            delay = self._retry_delay(cmd, retry, attempts, exitcode,
+                                      time.time() - started, err, consumers)
+            if delay is None:
+                break
+            time.sleep(delay)
+        return self._result(cmd, raise_error, exitcode, out, err, attempts)
+
+    def _attempt(self, cmd, stdin, consumers):
+        '''Runs cmd once, returns (exitcode, stdout, stderr)'''
+        timeout = self._timeout(cmd)
+        if consumers is not None:
+            return self._stream(cmd, stdin, consumers, timeout)
+        self.logger.debug(cmd_to_str(cmd))
         process = subprocess.Popen(cmd,
                                    stdin=subprocess.PIPE,
                                    stdout=subprocess.PIPE,
                                    stderr=subprocess.PIPE,
-                                   shell=True)
-        out, err = process.communicate()
+                                   universal_newlines=True,
+                                   shell=not isinstance(cmd, (list, tuple)),
+                                   **self._session_kwargs(timeout))
+        with self._watchdog(cmd, process, timeout):
+            out, err = process.communicate(input=stdin)
+        return process.returncode, out, err
+
+    def _timeout(self, cmd):
+        '''Returns seconds left for cmd by the deadline or None'''
+        if self.deadline is None:
+            return None
+        timeout = self.deadline.remaining()
+        if timeout <= 0:
+            self._expired(cmd)
+        return timeout
+
+    @staticmethod
+    def _session_kwargs(timeout):
+        '''Returns Popen arguments starting the new process group'''
+        if timeout is None:
+            return dict()
+        if sys.version_info >= (3, 2):
+            return dict(start_new_session=True)
+        return dict(preexec_fn=os.setsid)
+
+    @contextlib.contextmanager
+    def _watchdog(self, cmd, process, timeout):
+        '''Kills the process group of process after timeout seconds'''
+        if timeout is None:
+            yield
+            return
+        fired = threading.Event()
+        timer = threading.Timer(timeout, self._kill, [process, fired])
+        timer.daemon = True
+        timer.start()
+        try:
+            yield
+        finally:
+            timer.cancel()
+        if fired.is_set():
+            self._expired(cmd)
+
+    @staticmethod
+    def _kill(process, fired=None):
+        if fired is not None:
+            fired.set()
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except OSError:
+            # the process has exited already
+            pass
+
+    def _expired(self, cmd):
+        self.deadline.expire()
+        msg = '"{}" is killed: deadline of {} seconds expired'\
+              ''.format(cmd_to_str(cmd), self.deadline.seconds)
+        self.logger.error(msg)
+        raise DeadlineExceeded(msg)
+
+    def _retry_delay(self, cmd, retry, attempts, exitcode, duration, err,
+                     consumers):
+        '''Records the attempt, returns delay before the next one or None
+
+        Consumers are reset for the next attempt.
+        '''
+        delay = retry.next_delay(len(attempts) + 1, exitcode)
+        if delay is not None and self.deadline is not None and \
+                delay >= self.deadline.remaining():
+            self.logger.warning('"{}" is not retried: the deadline expires '
+                                'sooner'.format(cmd_to_str(cmd)))
+            delay = None
+        if delay is not None and consumers is not None and \
+                not all([hasattr(_, 'reset') for _ in consumers]):
+            self.logger.warning('"{}" is not retried: its output consumers '
+                                'can not be reset'.format(cmd_to_str(cmd)))
+            delay = None
+        attempts.append(Attempt(exitcode, duration, delay))
+        if delay is None:
+            return None
+        self.logger.warning('"{}" failed with transient exit code {} '
+                            '(attempt {} of {}), retrying in {:.1f} seconds'
+                            '{}'.format(cmd_to_str(cmd), exitcode,
+                                        len(attempts), retry.attempts, delay,
+                                        '\n' + err if err else ''))
+        for consumer in consumers or []:
+            consumer.reset()
+        return delay
+
+    def _result(self, cmd, raise_error, exitcode, out, err, attempts=None):
         self.logger.debug(out)
         if err:
             self.logger.error(err)
-        exitcode = process.returncode
-        if process.returncode != 0 and raise_error:
-            msg = '"{cmd}" failed. Exit code == {exitcode}'\
-                  '\n\nSTDOUT: \n{out}'\
-                  '\n\nSTDERR: \n{err}'\
-                  .format(**(locals()))
-            self.logger.error(msg)
-            raise RuntimeError(msg)
-        return exitcode, out, err
+        if exitcode != 0 and raise_error:
+            self._raise(cmd, exitcode, out, err)
+        return ShellResult(exitcode, out, err, attempts)
+
+    @staticmethod
+    def _tail(consumers):
+        '''Returns (LogTail, consumers including it)'''
+        consumers = list(consumers)
+        tails = [_ for _ in consumers if isinstance(_, LogTail)]
+        if tails:
+            return tails[0], consumers
+        tail = LogTail()
+        return tail, [tail] + consumers
+
+    def _stream(self, cmd, stdin, consumers, timeout=None):
+        self.logger.debug(cmd_to_str(cmd))
+        tail, consumers = self._tail(consumers)
+        # stderr is spilled to disk, so it can not block the process while
+        # stdout is read
+        with tempfile.TemporaryFile(mode='w+') as errfile:
+            process = subprocess.Popen(cmd,
+                                       stdin=subprocess.PIPE,
+                                       stdout=subprocess.PIPE,
+                                       stderr=errfile,
+                                       universal_newlines=True,
+                                       shell=not isinstance(cmd,
+                                                            (list, tuple)),
+                                       **self._session_kwargs(timeout))
+            feeder = threading.Thread(target=self._feed_stdin,
+                                      args=(process.stdin, stdin))
+            feeder.daemon = True
+            feeder.start()
+            with self._watchdog(cmd, process, timeout):
+                try:
+                    for line in iter(process.stdout.readline, ''):
+                        for consumer in consumers:
+                            consumer.feed(line)
+                finally:
+                    process.stdout.close()
+                    process.wait()
+                    feeder.join()
+                    for consumer in consumers:
+                        consumer.close()
+            errfile.seek(0)
+            err = errfile.read()
+        return process.returncode, tail.text, err
+
+    @staticmethod
+    def _feed_stdin(pipe, data):
+        try:
+            if data:
+                pipe.write(data)
+        except (IOError, OSError):
+            # process exited without reading of the whole input
+            pass
+        finally:
+            try:
+                pipe.close()
+            except (IOError, OSError):
+                pass
+
+    def _raise(self, cmd, exitcode, out, err):
+        cmd = cmd_to_str(cmd)
+        msg = '"{cmd}" failed. Exit code == {exitcode}'\
+              '\n\nSTDOUT: \n{out}'\
+              '\n\nSTDERR: \n{err}'\
+              .format(**(locals()))
+        self.logger.error(msg)
+        raise RuntimeError(msg)
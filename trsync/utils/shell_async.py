@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015-2016, Mirantis, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import asyncio
+import locale
+import time
+
+from trsync.utils.shell import cmd_to_str
+from trsync.utils.shell import Shell
+
+
+class AsyncShell(Shell):
+    '''Shell which runs commands as asyncio subprocesses (python >= 3.5)
+
+    If semaphore (asyncio.Semaphore) is specified, it limits the number of
+    processes running at the same time. It may be shared between several
+    AsyncShell objects.
+    '''
+
+    def __init__(self, logger=None, semaphore=None, retry=None,
+                 deadline=None):
+        super(AsyncShell, self).__init__(logger, retry=retry,
+                                         deadline=deadline)
+        self._semaphore = semaphore
+        self._encoding = locale.getpreferredencoding(False)
+
+    async def shell(self, cmd, raise_error=True, stdin=None, consumers=None,
+                    retry=None):
+        '''Runs cmd, returns ShellResult (exitcode, stdout, stderr)
+
+        Same as Shell.shell, but the coroutine. The semaphore is not held
+        while waiting for the next attempt.
+        '''
+        retry = self.retry if retry is None else retry
+        attempts = list()
+        while True:
+            started = time.time()
+            exitcode, out, err = await self._attempt(cmd, stdin, consumers)
+            delay = self._retry_delay(cmd, retry, attempts, exitcode,
+                                      time.time() - started, err, consumers)
+            if delay is None:
+                break
+            await asyncio.sleep(delay)
+        return self._result(cmd, raise_error, exitcode, out, err, attempts)
+
+    async def _attempt(self, cmd, stdin, consumers):
+        if self._semaphore is None:
+            return await self._run(cmd, stdin, consumers)
+        async with self._semaphore:
+            return await self._run(cmd, stdin, consumers)
+
+    async def _run(self, cmd, stdin, consumers):
+        timeout = self._timeout(cmd)
+        self.logger.debug(cmd_to_str(cmd))
+        pipes = dict(stdin=asyncio.subprocess.PIPE,
+                     stdout=asyncio.subprocess.PIPE,
+                     stderr=asyncio.subprocess.PIPE,
+                     **self._session_kwargs(timeout))
+        if isinstance(cmd, (list, tuple)):
+            process = await asyncio.create_subprocess_exec(*cmd, **pipes)
+        else:
+            process = await asyncio.create_subprocess_shell(cmd, **pipes)
+        try:
+            return await asyncio.wait_for(
+                self._communicate(process, stdin, consumers), timeout)
+        except asyncio.TimeoutError:
+            self._kill(process)
+            await process.wait()
+            self._expired(cmd)
+
+    async def _communicate(self, process, stdin, consumers):
+        if stdin:
+            stdin = stdin.encode(self._encoding)
+
+        if consumers is None:
+            out, err = await process.communicate(stdin)
+            out = self._decode(out)
+        else:
+            tail, consumers = self._tail(consumers)
+            try:
+                _, err, _ = await asyncio.gather(
+                    self._read_lines(process.stdout, consumers),
+                    process.stderr.read(),
+                    self._feed_stdin(process.stdin, stdin))
+            finally:
+                for consumer in consumers:
+                    consumer.close()
+            await process.wait()
+            out = tail.text
+        return process.returncode, out, self._decode(err)
+
+    def _decode(self, data):
+        return data.decode(self._encoding, 'replace').replace('\r\n', '\n')
+
+    async def _read_lines(self, stream, consumers):
+        while True:
+            line = await stream.readline()
+            if not line:
+                break
+            line = self._decode(line)
+            for consumer in consumers:
+                consumer.feed(line)
+
+    @staticmethod
+    async def _feed_stdin(pipe, data):
+        try:
+            if data:
+                pipe.write(data)
+                await pipe.drain()
+        except (BrokenPipeError, ConnectionResetError):
+            # process exited without reading of the whole input
+            pass
+        finally:
+            pipe.close()
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015-2016, Mirantis, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import os
+import shlex
+import subprocess
+import tempfile
+import threading
+
+from trsync.utils import utils as utils
+
+from trsync.utils.shell import cmd_to_str
+from trsync.utils.tempfiles import TempFiles
+
+
+class SshMaster(object):
+    '''Persistent ssh master connection (ControlMaster) to the host
+
+    The master is started by the first call of rsh() and all the ssh
+    sessions started by the command returned by rsh() are multiplexed
+    over it, so the key exchange is performed once. If the master can not
+    be started, rsh() returns plain ssh command.
+
+    The master is stopped by close(). It also exits itself when it is idle
+    for "persist" seconds, so it does not outlive a killed process for long.
+    '''
+
+    def __init__(self, destination, ssh_command=None, persist=300,
+                 logger=None):
+        if logger is None:
+            logger = utils.logger
+        self.logger = logger.getChild('SshMaster.' + destination)
+        self.destination = destination
+        if not ssh_command:
+            ssh_command = 'ssh'
+        if not isinstance(ssh_command, (list, tuple)):
+            ssh_command = shlex.split(ssh_command)
+        self._ssh = list(ssh_command)
+        self._persist = persist
+        self._tmp = TempFiles()
+        # unix socket path is limited by ~100 chars, so it is kept short
+        self.control_path = os.path.join(self._tmp.get_temp_dir(), 'ctl')
+        self._lock = threading.Lock()
+        self._started = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
+
+    @property
+    def started(self):
+        return self._started is True
+
+    def _control(self, *opts):
+        return self._ssh + ['-o', 'ControlPath={}'.format(self.control_path)] \
+            + list(opts)
+
+    def _call(self, cmd):
+        with open(os.devnull, 'r+') as devnull, \
+                tempfile.TemporaryFile(mode='w+') as errfile:
+            # master is detached by -f and keeps its stdout/stderr, so
+            # they are not pipes which would never be closed
+            exitcode = subprocess.call(cmd, stdin=devnull, stdout=devnull,
+                                       stderr=errfile)
+            errfile.seek(0)
+            return exitcode, errfile.read()
+
+    def start(self):
+        '''Starts the master if it is not started yet, returns success'''
+        with self._lock:
+            if self._started is None:
+                cmd = self._control(
+                    '-o', 'ControlMaster=yes',
+                    '-o', 'ControlPersist={}'.format(self._persist),
+                    '-N', '-f', self.destination)
+                self.logger.debug(cmd_to_str(cmd))
+                exitcode, err = self._call(cmd)
+                self._started = exitcode == 0
+                if self._started:
+                    self.logger.info('ssh master connection to "{}" started'
+                                     ''.format(self.destination))
+                else:
+                    self.logger.warn('ssh master connection to "{}" is not '
+                                     'started (exit code == {}), every ssh '
+                                     'session will connect separately: {}'
+                                     ''.format(self.destination, exitcode,
+                                               err))
+            return self._started
+
+    def rsh(self):
+        '''Returns remote shell command (string) for rsync -e option'''
+        if not self.start():
+            return cmd_to_str(self._ssh)
+        # ControlMaster=no: sessions never become the master themselves
+        return cmd_to_str(self._control('-o', 'ControlMaster=no'))
+
+    def check(self):
+        '''Returns True if the master is running'''
+        if not self.started:
+            return False
+        return self._call(self._control('-O', 'check',
+                                        self.destination))[0] == 0
+
+    def close(self):
+        '''Stops the master, next rsh() starts it again'''
+        with self._lock:
+            if self._started is True:
+                exitcode, err = self._call(self._control('-O', 'exit',
+                                                         self.destination))
+                if exitcode == 0:
+                    self.logger.info('ssh master connection to "{}" stopped'
+                                     ''.format(self.destination))
+                else:
+                    self.logger.warn('Stopping of ssh master connection to '
+                                     '"{}" failed: {}'
+                                     ''.format(self.destination, err))
+            self._started = None
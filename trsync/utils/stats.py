@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015-2016, Mirantis, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import re
+
+from trsync.utils import utils as utils
+
+
+STATS_OPTS = ['--stats']
+
+# rsync --stats labels (rsync 3.0 and 3.1 wordings) and their keys
+STATS_FIELDS = {
+    'Number of files': 'files',
+    'Number of created files': 'files_created',
+    'Number of deleted files': 'files_deleted',
+    'Number of regular files transferred': 'files_transferred',
+    'Number of files transferred': 'files_transferred',
+    'Total file size': 'total_file_size',
+    'Total transferred file size': 'transferred_file_size',
+    'Literal data': 'literal_data',
+    'Matched data': 'matched_data',
+    'File list size': 'file_list_size',
+    'File list generation time': 'file_list_generation_time',
+    'File list transfer time': 'file_list_transfer_time',
+    'Total bytes sent': 'bytes_sent',
+    'Total bytes received': 'bytes_received',
+}
+
+_FIELD_RE = re.compile(r'^([A-Z][A-Za-z ]+): ([\d,.]+)')
+_SPEEDUP_RE = re.compile(r'speedup is ([\d,.]+)')
+
+
+def _number(value):
+    value = value.replace(',', '').rstrip('.')
+    if '.' in value:
+        return float(value)
+    return int(value)
+
+
+class StatsParser(object):
+    '''Consumer of rsync --stats output
+
+    stats is bunch {key: number} of the fields found in the output (see
+    STATS_FIELDS, also "speedup"), empty if rsync did not print them.
+    '''
+
+    def __init__(self):
+        self.stats = utils.bunch()
+
+    def feed(self, line):
+        match = _FIELD_RE.match(line)
+        if match is not None:
+            key = STATS_FIELDS.get(match.group(1))
+            if key is not None:
+                self.stats[key] = _number(match.group(2))
+            return
+        match = _SPEEDUP_RE.search(line)
+        if match is not None:
+            self.stats['speedup'] = _number(match.group(1))
+
+    def close(self):
+        pass
+
+    def reset(self):
+        self.stats.clear()
+
+
+def linked_file_size(stats):
+    '''Returns bytes of files not transferred by push to new directory
+
+    For push of snapshot with --link-dest they are hardlinked to the
+    previous snapshots. Returns None if stats has no file sizes.
+    '''
+    if 'total_file_size' not in stats or \
+            'transferred_file_size' not in stats:
+        return None
+    return max(0, stats['total_file_size'] - stats['transferred_file_size'])
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015-2016, Mirantis, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+'''Logic shared by the synchronous and asyncio classes as I/O steps
+
+The logic is written as generator which yields its I/O steps: callables
+(the calls of RsyncOps methods, so they return coroutines for
+AsyncRsyncOps) or nested generators of steps. The result of every step
+is sent back to the generator and its exception is thrown into it, so
+the generator handles them by try/except as usual. Callable may return
+generator of steps too (e.g. the functions of transaction).
+
+python 2 generators can not return values, so the result of the
+generator is yielded as Result(value), the generator is closed then.
+
+run_steps() runs the steps at once, steps_async.run_steps() awaits them.
+'''
+
+import sys
+import types
+
+
+class Result(object):
+    '''Result of generator of steps'''
+
+    def __init__(self, value=None):
+        self.value = value
+
+
+def run_steps(steps):
+    '''Runs generator of steps, returns its result'''
+    value, error = None, None
+    while True:
+        try:
+            if error is not None:
+                step = steps.throw(*error)
+            else:
+                step = steps.send(value)
+        except StopIteration:
+            return None
+        if isinstance(step, Result):
+            steps.close()
+            return step.value
+        value, error = None, None
+        try:
+            if not isinstance(step, types.GeneratorType):
+                step = step()
+            if isinstance(step, types.GeneratorType):
+                step = run_steps(step)
+            value = step
+        except Exception:
+            error = sys.exc_info()
@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015-2016, Mirantis, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import inspect
+import sys
+import types
+
+from trsync.utils.steps import Result
+
+
+async def run_steps(steps):
+    '''Same as steps.run_steps, the coroutines of the steps are awaited'''
+    value, error = None, None
+    while True:
+        try:
+            if error is not None:
+                step = steps.throw(*error)
+            else:
+                step = steps.send(value)
+        except StopIteration:
+            return None
+        if isinstance(step, Result):
+            steps.close()
+            return step.value
+        value, error = None, None
+        try:
+            if not isinstance(step, types.GeneratorType):
+                step = step()
+            if inspect.isawaitable(step):
+                step = await step
+            if isinstance(step, types.GeneratorType):
+                step = await run_steps(step)
+            value = step
+        except Exception:
+            error = sys.exc_info()
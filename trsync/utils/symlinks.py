@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2015-2016, Mirantis, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import os
+
+
+class SymlinkResolver(object):
+    '''Resolves chains of symlinks by listings of their hops
+
+    Paths are relative the rsync url. The caller lists the paths returned
+    by pending() (all of them at once) and passes the listing
+    {path: (mode, symlink target)} to add_listing() until nothing is
+    pending, then gets the targets. Every listed hop is memoized, so the
+    chains sharing hops list them once and the number of listings is the
+    length of the longest chain.
+    '''
+
+    def __init__(self):
+        # {path: next path of the chain or None if path is not a symlink}
+        self._hops = dict()
+
+    @staticmethod
+    def normpath(path):
+        return os.path.normpath(path).strip('/') if path else '.'
+
+    @staticmethod
+    def _final(path):
+        '''Returns True for paths which can't be listed on the rsync url'''
+        return path == '.' or path == '..' or path.startswith('../') or \
+            os.path.isabs(path)
+
+    def _walk(self, symlink, recursive=True):
+        '''Returns (chain of known hops, True if chain is complete)'''
+        chain = [self.normpath(symlink)]
+        while True:
+            path = chain[-1]
+            if self._final(path):
+                return chain, True
+            if path not in self._hops:
+                return chain, False
+            target = self._hops[path]
+            if target is None:
+                return chain, True
+            chain.append(target)
+            if not recursive or target in chain[:-1]:
+                return chain, True
+
+    def pending(self, symlinks, recursive=True):
+        '''Returns paths which should be listed to resolve symlinks'''
+        paths = set()
+        for symlink in symlinks:
+            chain, complete = self._walk(symlink, recursive)
+            if not complete:
+                paths.add(chain[-1])
+        return sorted(paths)
+
+    def add_listing(self, paths, listing):
+        '''Memoizes hops of listed paths, missing paths are not symlinks'''
+        for path in paths:
+            mode, target = listing.get(path, ('', None))
+            if mode.startswith('l') and target:
+                target = os.path.normpath(
+                    os.path.join(os.path.dirname(path), target))
+                self._hops[path] = target if os.path.isabs(target) \
+                    else target.strip('/')
+            else:
+                self._hops[path] = None
+
+    def target(self, symlink, recursive=True):
+        '''Returns target of symlink, raises RuntimeError on symlinks loop
+
+        The symlink itself is returned if it is not a symlink.
+        '''
+        chain, complete = self._walk(symlink, recursive)
+        if not complete:
+            raise RuntimeError('Symlink "{}" is not resolved yet'
+                               ''.format(symlink))
+        if recursive and len(chain) > 1 and chain[-1] in chain[:-1]:
+            raise RuntimeError('Symlinks loop: {}'.format(' -> '.join(chain)))
+        return chain[-1]
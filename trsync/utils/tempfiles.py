@@ -14,41 +14,166 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import contextlib
 import os
 import shutil
 import tempfile
+import threading
 
 from trsync.utils import utils as utils
 
 
 class TempFiles(object):
+    '''Arena of temporary directories under single root
+
+    The root (trsync-*) is created on demand. Directories got by
+    get_temp_dir inside operation() are emptied and recycled when the
+    operation ends, the others (e.g. kept result files) live until
+    close(). empty_dir is never recycled. created and reused count the
+    directories made and taken back from the free list, peak_footprint is
+    the largest size (bytes) of the directories recycled at once (only
+    they are measured, so recycling does not walk the kept ones). Use as
+    context manager or call close() for deterministic cleanup.
+    '''
+
+    prefix = 'trsync-'
+
     def __init__(self):
         self.logger = utils.logger.getChild('TempFiles')
-        self._temp_dirs = list()
-        self.empty_dir
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._root = None
+        self._free = list()
+        self._last = None
+        self._empty_dir = None
+        self.created = 0
+        self.reused = 0
+        self.peak_footprint = 0
 
     def __enter__(self):
         return self
 
     def __exit__(self, type, value, traceback):
-        self.__del__()
+        self.close()
 
     def __del__(self):
-        for d in self._temp_dirs:
-            if os.path.isdir(d):
-                shutil.rmtree(d)
-                self.logger.debug('Removed temporary directory "{}"'.format(d))
+        try:
+            self.close()
+        except Exception:
+            pass
+
+    def close(self):
+        '''Removes the root with all the temporary directories'''
+        with self._lock:
+            root, self._root = self._root, None
+            self._free, self._last, self._empty_dir = list(), None, None
+        if root is not None and os.path.isdir(root):
+            shutil.rmtree(root, ignore_errors=True)
+            self.logger.debug('Removed temporary directory "{}"'.format(root))
+
+    @property
+    def root(self):
+        with self._lock:
+            if self._root is None:
+                self._root = tempfile.mkdtemp(prefix=self.prefix)
+                self.logger.debug('Created temporary root "{}"'
+                                  ''.format(self._root))
+            return self._root
+
+    def _new_dir(self):
+        temp_dir = tempfile.mkdtemp(dir=self.root)
+        self.created += 1
+        return temp_dir
 
     @property
     def empty_dir(self):
-        if self.__dict__.get('_empty_dir') is None:
-            self._empty_dir = self.get_temp_dir()
+        if self._empty_dir is None or not os.path.isdir(self._empty_dir):
+            self._empty_dir = self._new_dir()
         return self._empty_dir
 
+    def _operations(self):
+        stack = getattr(self._local, 'operations', None)
+        if stack is None:
+            stack = self._local.operations = list()
+        return stack
+
+    @contextlib.contextmanager
+    def operation(self):
+        '''Recycles the directories got inside the block on exit
+
+        Yields list of the directories. Operations are tracked per thread,
+        coroutines should recycle their directories explicitly.
+        '''
+        stack = self._operations()
+        temp_dirs = list()
+        stack.append(temp_dirs)
+        try:
+            yield temp_dirs
+        finally:
+            stack.pop()
+            self.recycle(*temp_dirs)
+
+    def recycle(self, *temp_dirs):
+        '''Empties the directories and returns them to the free list'''
+        if not temp_dirs:
+            return
+        used = list()
+        for temp_dir in temp_dirs:
+            for operation in self._operations():
+                if temp_dir in operation:
+                    operation.remove(temp_dir)
+            if temp_dir == self._empty_dir or temp_dir in self._free or \
+                    not os.path.isdir(temp_dir) or temp_dir in used:
+                continue
+            used.append(temp_dir)
+        self.peak_footprint = max(self.peak_footprint,
+                                  sum([self._size(_) for _ in used]))
+        for temp_dir in used:
+            for name in os.listdir(temp_dir):
+                path = os.path.join(temp_dir, name)
+                if os.path.isdir(path) and not os.path.islink(path):
+                    shutil.rmtree(path)
+                else:
+                    os.unlink(path)
+            with self._lock:
+                if self._root is not None and \
+                        os.path.dirname(temp_dir) == self._root:
+                    self._free.append(temp_dir)
+        self.logger.debug('Recycled temporary directories "{}"'
+                          ''.format(', '.join(temp_dirs)))
+
+    def footprint(self):
+        '''Returns size (bytes) of all the files under the root'''
+        root = self._root
+        if root is None:
+            return 0
+        return self._size(root)
+
+    @staticmethod
+    def _size(path):
+        '''Returns size (bytes) of all the files under path'''
+        total = 0
+        for dirpath, dirnames, filenames in os.walk(path):
+            for name in filenames:
+                try:
+                    total += os.lstat(os.path.join(dirpath, name)).st_size
+                except OSError:
+                    pass
+        return total
+
     def get_temp_dir(self, subdirs=None):
-        temp_dir = tempfile.mkdtemp()
-        self._temp_dirs.append(temp_dir)
-        msg = 'Created temporary directory "{}"'.format(temp_dir)
+        with self._lock:
+            temp_dir = self._free.pop() if self._free else None
+        if temp_dir is None:
+            temp_dir = self._new_dir()
+            msg = 'Created temporary directory "{}"'.format(temp_dir)
+        else:
+            self.reused += 1
+            msg = 'Reused temporary directory "{}"'.format(temp_dir)
+        stack = self._operations()
+        if stack:
+            stack[-1].append(temp_dir)
+        self._last = temp_dir
         if subdirs:
             self.create_subdirs(subdirs, temp_dir)
             msg += ' including subdirs "{}"'.format(subdirs)
@@ -57,7 +182,9 @@ class TempFiles(object):
 
     @property
     def last_temp_dir(self):
-        return self._temp_dirs[-1]
+        if self._last is None or not os.path.isdir(self._last):
+            return self.get_temp_dir()
+        return self._last
 
     def create_subdirs(self, subdirs, temp_dir):
         if not os.path.isdir(temp_dir):
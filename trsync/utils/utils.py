@@ -14,11 +14,16 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import contextlib
 import datetime
+import functools
 import logging
 import os
+import threading
 import time
 
+from multiprocessing.pool import ThreadPool
+
 
 def singleton(class_):
     instances = {}
@@ -145,3 +150,76 @@ class bunch(dict):
     def __init__(self, *args, **kwargs):
         super(bunch, self).__init__(*args, **kwargs)
         self.__dict__ = self
+
+
+@contextlib.contextmanager
+def timed(timings, name):
+    '''Stores wall-clock duration (seconds) of the block as timings[name]'''
+    started = time.time()
+    try:
+        yield
+    finally:
+        timings[name] = time.time() - started
+
+
+_log_context = threading.local()
+
+
+def log_context():
+    '''Returns logging context of the current thread (None if not set)'''
+    return getattr(_log_context, 'value', None)
+
+
+@contextlib.contextmanager
+def logging_context(value):
+    '''Sets logging context of the current thread inside the block
+
+    The context tells whose work the records are (e.g. the destination
+    server, see cli.ThreadLogHandler). Functions run by other threads get
+    it by with_log_context().
+    '''
+    previous = log_context()
+    _log_context.value = value
+    try:
+        yield
+    finally:
+        _log_context.value = previous
+
+
+def with_log_context(function):
+    '''Returns function running in the logging context of the caller'''
+    context = log_context()
+
+    @functools.wraps(function)
+    def wrapped(*args, **kwargs):
+        with logging_context(context):
+            return function(*args, **kwargs)
+    return wrapped
+
+
+def run_parallel(function, items, workers=1):
+    '''Calls function(item) for every item using a pool of worker threads
+
+    Returns list of (item, success, result) tuples in the order of items.
+    For failed calls result is the raised exception. The workers run in
+    the logging context of the caller.
+    '''
+
+    def call(item):
+        try:
+            return item, True, function(item)
+        except Exception as e:
+            logger.debug('{}({}) failed: {}'.format(function.__name__,
+                                                    item, str(e)))
+            return item, False, e
+
+    items = list(items)
+    workers = max(1, min(int(workers), len(items)))
+    if workers == 1:
+        return [call(_) for _ in items]
+    pool = ThreadPool(workers)
+    try:
+        return pool.map(with_log_context(call), items)
+    finally:
+        pool.close()
+        pool.join()